@@ -0,0 +1,219 @@
+"""
+Measure the per-request overhead of RateLimitMiddleware and its parts.
+
+    python -m benchmarks.middleware --routes 50 --users 1000 --periods 2
+
+Every result is one JSON object per line on stdout (or `--output`),
+`ns` is the mean time per operation, `per_second` the operations per
+second on one core and `peak_bytes` the mean peak of traced memory
+per operation.
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+import tracemalloc
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from ratelimit import RateLimitMiddleware, Rule
+from ratelimit.backends.simple import MemoryBackend
+from ratelimit.backends.sketch import SketchBackend
+from ratelimit.backends.slidingmemory import SlidingMemoryBackend
+from ratelimit.rule import RULENAMES
+from ratelimit.types import Message, Scope
+
+Operation = Callable[[int], Awaitable[Any]]
+
+
+async def app(scope: Scope, receive: Any, send: Any) -> None:
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+async def receive() -> Message:
+    return {"type": "http.request", "body": b"", "more_body": False}
+
+
+async def send(message: Message) -> None:
+    pass
+
+
+async def authenticate(scope: Scope) -> Tuple[str, str]:
+    return scope["user"], "default"
+
+
+def make_config(routes: int, periods: int) -> Dict[str, Sequence[Rule]]:
+    # Huge limits so that the allowed path is measured
+    limits = {name: 10**9 for name in RULENAMES[:periods]}
+    return {
+        rf"^/route{index}/\d+": [Rule(**limits), Rule(group="admin")]
+        for index in range(routes)
+    }
+
+
+def make_scopes(routes: int, users: int) -> List[Scope]:
+    # The last route is the worst case for matching
+    return [
+        {
+            "type": "http",
+            "method": "GET",
+            "path": f"/route{routes - 1}/{index}",
+            "headers": [],
+            "client": ("1.1.1.1", 8000),
+            "user": f"user{index}",
+        }
+        for index in range(users)
+    ]
+
+
+async def measure(name: str, operation: Operation, iterations: int) -> dict:
+    for index in range(min(iterations, 1000)):  # warm up
+        await operation(index)
+
+    started = time.perf_counter_ns()
+    for index in range(iterations):
+        await operation(index)
+    elapsed = time.perf_counter_ns() - started
+
+    samples = min(iterations, 1000)
+    tracemalloc.start()
+    peak = 0
+    for index in range(samples):
+        tracemalloc.clear_traces()
+        current, _ = tracemalloc.get_traced_memory()
+        await operation(index)
+        _, operation_peak = tracemalloc.get_traced_memory()
+        peak += operation_peak - current
+    tracemalloc.stop()
+
+    return {
+        "name": name,
+        "iterations": iterations,
+        "ns": elapsed / iterations,
+        "per_second": iterations * 10**9 / elapsed,
+        "peak_bytes": peak / samples,
+    }
+
+
+async def make_backends(names: Sequence[str], url: Optional[str]) -> Dict[str, Any]:
+    backends: Dict[str, Any] = {}
+    if "memory" in names:
+        backends["memory"] = MemoryBackend()
+    if "slidingmemory" in names:
+        backends["slidingmemory"] = SlidingMemoryBackend()
+    if "sketch" in names:
+        backends["sketch"] = SketchBackend()
+    if not {"redis", "slidingredis"} & set(names):
+        return backends
+
+    from ratelimit.backends.redis import RedisBackend
+    from ratelimit.backends.slidingredis import SlidingRedisBackend
+
+    if url is not None:
+        from redis.asyncio import StrictRedis
+
+        redis = StrictRedis.from_url(url)
+    else:
+        from fakeredis.aioredis import FakeRedis
+
+        redis = FakeRedis()
+
+    await redis.flushdb()
+    if "redis" in names:
+        backends["redis"] = RedisBackend(redis)
+    if "slidingredis" in names:
+        backends["slidingredis"] = SlidingRedisBackend(redis)
+    return backends
+
+
+async def run(args: argparse.Namespace) -> List[dict]:
+    config = make_config(args.routes, args.periods)
+    scopes = make_scopes(args.routes, args.users)
+    rule = next(iter(config.values()))[0]
+    iterations = args.iterations
+    results = []
+
+    middleware = RateLimitMiddleware(app, authenticate, MemoryBackend(), config)
+
+    async def route_match(index: int) -> Any:
+        path = scopes[index % len(scopes)]["path"]
+        for pattern in middleware.config:
+            if pattern.match(path):
+                return pattern
+
+    async def auth(index: int) -> Any:
+        return await authenticate(scopes[index % len(scopes)])
+
+    async def ruleset(index: int) -> Any:
+        return rule.ruleset("/route", f"user{index % args.users}")
+
+    results.append(await measure("route_match", route_match, iterations))
+    results.append(await measure("authenticate", auth, iterations))
+    results.append(await measure("ruleset", ruleset, iterations))
+
+    # Every user is blocked, as during a flood
+    blocking = MemoryBackend()
+    for index in range(args.users):
+        blocking.set_blocked_user(f"user{index}", 3600)
+    blocked_middleware = RateLimitMiddleware(app, authenticate, blocking, config)
+
+    async def blocked(index: int) -> Any:
+        return await blocked_middleware(scopes[index % len(scopes)], receive, send)
+
+    results.append(await measure("blocked.middleware", blocked, iterations))
+
+    backends = await make_backends(args.backends, args.redis_url)
+    for name, backend in backends.items():
+
+        async def retry_after(index: int, backend: Any = backend) -> Any:
+            return await backend.retry_after(
+                "/route", f"user{index % args.users}", rule
+            )
+
+        middleware = RateLimitMiddleware(app, authenticate, backend, config)
+
+        async def request(index: int, middleware: Any = middleware) -> Any:
+            return await middleware(scopes[index % len(scopes)], receive, send)
+
+        count = args.redis_iterations if name.endswith("redis") else iterations
+        results.append(await measure(f"{name}.retry_after", retry_after, count))
+        results.append(await measure(f"{name}.middleware", request, count))
+
+    parameters = {
+        "routes": args.routes,
+        "users": args.users,
+        "periods": args.periods,
+        "python": sys.version.split()[0],
+    }
+    return [dict(result, **parameters) for result in results]
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--routes", type=int, default=20)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--periods", type=int, default=1, choices=range(1, 6))
+    parser.add_argument("--iterations", type=int, default=100000)
+    parser.add_argument("--redis-iterations", type=int, default=5000)
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        default=["memory"],
+        choices=["memory", "slidingmemory", "sketch", "redis", "slidingredis"],
+    )
+    parser.add_argument(
+        "--redis-url",
+        default=None,
+        help="redis server to use, fakeredis is used if not given",
+    )
+    parser.add_argument("--output", type=argparse.FileType("w"), default=sys.stdout)
+    args = parser.parse_args(argv)
+
+    for result in asyncio.run(run(args)):
+        args.output.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
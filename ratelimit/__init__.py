@@ -1,4 +1,6 @@
+from .bypass import Bypass
 from .core import RateLimitMiddleware
+from .responses import BlockedResponses
 from .rule import Rule
 
-__all__ = ("RateLimitMiddleware", "Rule")
+__all__ = ("BlockedResponses", "Bypass", "RateLimitMiddleware", "Rule")
@@ -0,0 +1,103 @@
+import asyncio
+from dataclasses import replace
+from typing import Dict, Optional, Sequence
+
+from .rule import Rule
+
+
+class AdaptiveController:
+    """
+    scale the limits of `groups` with AIMD: when the application is
+    overloaded the factor of each group is multiplied by `decrease`,
+    otherwise `increase` is added back until it reaches 1.
+
+    * target_lag: overloaded when the event loop lag exceeds it (seconds)
+    * target_latency: overloaded when the average response time exceeds it (seconds)
+    * interval: seconds between two adjustments
+    * min_factor: lower bound of the factors
+
+    Backend keys are not changed. The fixed window backends storing the
+    units left (`MemoryBackend`, `RedisBackend` with the "keys" layout)
+    apply scaled limits when a new window starts, the other backends
+    compare the units used with the scaled limits at once.
+    """
+
+    def __init__(
+        self,
+        groups: Sequence[str] = ("default",),
+        *,
+        target_lag: Optional[float] = 0.1,
+        target_latency: Optional[float] = None,
+        interval: float = 1,
+        decrease: float = 0.5,
+        increase: float = 0.1,
+        min_factor: float = 0.1,
+    ) -> None:
+        self.factors: Dict[str, float] = {group: 1.0 for group in groups}
+        self.target_lag = target_lag
+        self.target_latency = target_latency
+        self.interval = interval
+        self.decrease = decrease
+        self.increase = increase
+        self.min_factor = min_factor
+
+        # exponentially weighted moving average of response times
+        self.latency = 0.0
+        self._next_adjust = 0.0
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    def scale(self, rule: Rule) -> Rule:
+        factor = self.factors.get(rule.group, 1.0)
+        if factor >= 1:
+            return rule
+
+        def scaled(limit: Optional[int]) -> Optional[int]:
+            # a limit of 0 denies all requests and stays 0
+            if limit is None:
+                return None
+            return max(int(limit * factor), min(limit, 1))
+
+        return replace(
+            rule,
+            second=scaled(rule.second),
+            minute=scaled(rule.minute),
+            hour=scaled(rule.hour),
+            day=scaled(rule.day),
+            month=scaled(rule.month),
+        )
+
+    def adjust(self, overloaded: bool) -> None:
+        for group, factor in self.factors.items():
+            if overloaded:
+                self.factors[group] = max(factor * self.decrease, self.min_factor)
+            else:
+                self.factors[group] = min(factor + self.increase, 1.0)
+
+    def observe_latency(self, seconds: float) -> None:
+        if self.target_latency is None:
+            return
+        self.latency += (seconds - self.latency) * 0.1
+        now = asyncio.get_event_loop().time()
+        if now >= self._next_adjust:
+            self._next_adjust = now + self.interval
+            self.adjust(self.latency > self.target_latency)
+
+    def start(self) -> None:
+        """
+        start sampling the event loop lag, if `target_lag` is set
+        """
+        if self._task is None and self.target_lag is not None:
+            self._task = asyncio.ensure_future(self.sample_lag())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def sample_lag(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = loop.time() - started - self.interval
+            self.adjust(lag > self.target_lag)  # type: ignore
@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+from typing import List, Optional, Sequence, Tuple
 
 from ..rule import Rule
 
@@ -11,3 +12,44 @@ class BaseBackend(ABC):
     @abstractmethod
     async def retry_after(self, path: str, user: str, rule: Rule) -> int:
         raise NotImplementedError
+
+    async def startup(self) -> None:
+        """
+        called before the first request, on ASGI lifespan startup.
+        Every middleware sharing the backend calls it, the calls after
+        the first one must do nothing.
+        """
+
+    async def shutdown(self) -> None:
+        """
+        called after the last request, on ASGI lifespan shutdown,
+        the calls after the first one must do nothing
+        """
+
+    async def retry_after_many(
+        self, checks: Sequence[Tuple[str, str, Rule]]
+    ) -> List[int]:
+        """
+        evaluate many (path, user, rule) checks for one request and
+        return the retry after of each check, in order.
+
+        The default implementation evaluates the checks one by one, so a
+        check rejecting the request does not give back the cost taken by
+        the previous ones. The backends of this package take the cost of
+        all checks only if none of them rejects the request.
+        """
+        return [await self.retry_after(path, user, rule) for path, user, rule in checks]
+
+    async def acquire(self, path: str, user: str, rule: Rule) -> Optional[str]:
+        """
+        take one of the `rule.concurrency` slots, return a token
+        to release it or None if no slot is free. The middleware refuses
+        concurrency rules if the backend does not override this method.
+        """
+        raise NotImplementedError
+
+    async def release(self, path: str, user: str, rule: Rule, token: str) -> None:
+        """
+        release the slot taken by `acquire`
+        """
+        raise NotImplementedError
@@ -0,0 +1,271 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import math
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from ..rule import TTL
+from .simple import MemoryBackend
+
+logger = logging.getLogger(__name__)
+
+Address = Tuple[str, int]
+
+# Keep datagrams under the usual UDP payload limit
+MAX_DATAGRAM = 60000
+# Signed datagrams start with the HMAC-SHA256 of the message
+_DIGEST_SIZE = hashlib.sha256().digest_size
+
+
+class Counter:
+    """
+    grow-only counter (G-Counter) of one window: each node only increases
+    its own count, merging keeps the highest count seen for every node
+    """
+
+    __slots__ = ("window", "counts")
+
+    def __init__(self, window: int) -> None:
+        self.window = window
+        # node: count
+        self.counts: Dict[str, int] = {}
+
+    @property
+    def value(self) -> int:
+        return sum(self.counts.values())
+
+    def merge(self, node: str, count: int) -> None:
+        if count > self.counts.get(node, 0):
+            self.counts[node] = count
+
+
+class _Protocol(asyncio.DatagramProtocol):
+    def __init__(self, backend: "GossipBackend") -> None:
+        self.backend = backend
+
+    def datagram_received(self, data: bytes, addr: Address) -> None:
+        self.backend.receive_datagram(data, addr)
+
+
+class GossipBackend(MemoryBackend):
+    """
+    fixed windows counted by every node in memory and shared with
+    `peers` over UDP, without a central storage.
+
+    * node: unique name of this node
+    * bind: (host, port) receiving the counts of the peers
+    * peers: (host, port) of the other nodes
+    * interval: seconds between two batches of changed counts
+    * sync_every: every `sync_every` batches, all the counts of
+      this node are sent again in case datagrams were lost
+    * secret: shared by all the nodes to sign the datagrams,
+      datagrams without a valid signature are dropped
+
+    Limits are enforced against the counts received so far, a node
+    may admit requests of other nodes not yet received. Windows are
+    aligned on the clock, the clocks of the nodes must be synchronized.
+    Concurrency rules are enforced by each node for its own requests.
+    The decisions are made by `MemoryBackend` on the merged counters.
+
+    Every accepted datagram is trusted: anyone able to send one can raise
+    the counts or block users. Bind to a private address reachable only by
+    the nodes, and set `secret` unless the network is trusted.
+    """
+
+    def __init__(
+        self,
+        node: str,
+        bind: Address,
+        peers: Sequence[Address],
+        *,
+        interval: float = 0.1,
+        sync_every: int = 10,
+        secret: Optional[bytes] = None,
+    ) -> None:
+        super().__init__()
+        self.node = node
+        self.bind = bind
+        self.peers = list(peers)
+        self.interval = interval
+        self.sync_every = sync_every
+        self.secret = secret
+        # key: counter of the current window
+        self.counters: Dict[str, Counter] = {}
+        # user: deadline (unix time), merged by keeping the latest one
+        self.blocked_users: Dict[str, float] = {}
+        # keys and users changed since the last batch
+        self._changed: Dict[str, None] = {}
+        self._blocked: Dict[str, None] = {}
+        self._transport: Optional[asyncio.DatagramTransport] = None
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    async def startup(self) -> None:
+        if self._transport is not None:
+            return
+        loop = asyncio.get_event_loop()
+        self._transport, _ = await loop.create_datagram_endpoint(
+            lambda: _Protocol(self), local_addr=self.bind
+        )
+        self._task = asyncio.ensure_future(self.gossip())
+
+    async def shutdown(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._transport is not None:
+            self.send(list(self._changed), list(self._blocked))
+            self._transport.close()
+            self._transport = None
+
+    def counter(self, key: str, window: int) -> Counter:
+        counter = self.counters.get(key)
+        if counter is None or counter.window < window:
+            counter = self.counters[key] = Counter(window)
+        return counter
+
+    def is_blocking(self, user: str) -> int:
+        return max(math.ceil(self.blocked_users.get(user, 0) - time.time()), 0)
+
+    def set_blocked_user(self, user: str, block_time: int) -> int:
+        self.blocked_users[user] = time.time() + block_time
+        self._blocked[user] = None
+        return block_time
+
+    def check_limit(
+        self, path: str, key: str, limit: int, seconds: int, cost: int
+    ) -> int:
+        now = time.time()
+        window = int(now // seconds)
+        if self.counter(key, window).value + cost > limit:
+            return max(math.ceil((window + 1) * seconds - now), 1)
+        return 0
+
+    def take(self, path: str, key: str, seconds: int, cost: int) -> None:
+        counter = self.counter(key, int(time.time() // seconds))
+        counter.merge(self.node, counter.counts.get(self.node, 0) + cost)
+        self._changed[key] = None
+
+    def sign(self, message: bytes) -> bytes:
+        assert self.secret is not None
+        return hmac.new(self.secret, message, hashlib.sha256).digest()
+
+    def receive_datagram(self, data: bytes, addr: Address) -> None:
+        """
+        check the signature and the format of a datagram before merging it
+        """
+        if self.secret is not None:
+            digest, data = data[:_DIGEST_SIZE], data[_DIGEST_SIZE:]
+            if not hmac.compare_digest(digest, self.sign(data)):
+                logger.warning("Unauthenticated rate limit gossip from %s", addr)
+                return
+        try:
+            message = json.loads(data)
+            _validate(message)
+        except (ValueError, TypeError, KeyError):
+            logger.warning("Invalid rate limit gossip from %s", addr)
+            return
+        self.receive(message)
+
+    def receive(self, message: Dict[str, Any]) -> None:
+        node = message["node"]
+        for key, window, count in message["counts"]:
+            counter = self.counter(key, window)
+            # counts of a past window are late
+            if counter.window == window:
+                counter.merge(node, count)
+        for user, deadline in message["blocked"]:
+            if deadline > self.blocked_users.get(user, 0):
+                self.blocked_users[user] = deadline
+
+    def send(self, keys: List[str], users: List[str]) -> None:
+        """
+        send the counts of this node for `keys` and the deadlines of
+        `users` to every peer, split in datagrams small enough for UDP
+        """
+        if self._transport is None:
+            return
+        counts = [
+            [key, counter.window, counter.counts[self.node]]
+            for key, counter in ((key, self.counters.get(key)) for key in keys)
+            if counter is not None and self.node in counter.counts
+        ]
+        blocked = [
+            [user, self.blocked_users[user]]
+            for user in users
+            if user in self.blocked_users
+        ]
+        for message in _batches(self.node, counts, blocked):
+            if self.secret is not None:
+                message = self.sign(message) + message
+            for peer in self.peers:
+                self._transport.sendto(message, peer)
+
+    def expire(self, now: float) -> None:
+        for key, counter in list(self.counters.items()):
+            # "path:method:user:period"
+            seconds = TTL[key.rsplit(":", 1)[1]]
+            if (counter.window + 1) * seconds <= now:
+                del self.counters[key]
+        for user, deadline in list(self.blocked_users.items()):
+            if deadline <= now:
+                del self.blocked_users[user]
+
+    async def gossip(self) -> None:
+        rounds = 0
+        while True:
+            await asyncio.sleep(self.interval)
+            rounds += 1
+            if rounds % self.sync_every == 0:
+                self.expire(time.time())
+                keys, users = list(self.counters), list(self.blocked_users)
+            else:
+                keys, users = list(self._changed), list(self._blocked)
+            self._changed.clear()
+            self._blocked.clear()
+            try:
+                self.send(keys, users)
+            except Exception:
+                logger.exception("Failed to send rate limit gossip")
+
+
+def _validate(message: Any) -> None:
+    """
+    raise ValueError, TypeError or KeyError unless `message` can be merged
+    """
+    if not isinstance(message, dict) or not isinstance(message["node"], str):
+        raise ValueError("invalid node")
+    for key, window, count in message["counts"]:
+        if not (
+            isinstance(key, str)
+            and isinstance(window, int)
+            and isinstance(count, int)
+            # expired by the period at the end of the key
+            and key.rsplit(":", 1)[-1] in TTL
+        ):
+            raise ValueError("invalid count")
+    for user, deadline in message["blocked"]:
+        if not (isinstance(user, str) and isinstance(deadline, (int, float))):
+            raise ValueError("invalid blocked user")
+
+
+def _batches(
+    node: str, counts: List[List[Any]], blocked: List[List[Any]]
+) -> List[bytes]:
+    if not counts and not blocked:
+        return []
+    message = json.dumps(
+        {"node": node, "counts": counts, "blocked": blocked}, separators=(",", ":")
+    ).encode("utf8")
+    # leave room for the signature
+    if len(message) <= MAX_DATAGRAM - _DIGEST_SIZE or len(counts) + len(blocked) == 1:
+        return [message]
+    if len(counts) > 1:
+        half = len(counts) // 2
+        return _batches(node, counts[:half], []) + _batches(
+            node, counts[half:], blocked
+        )
+    half = len(blocked) // 2
+    return _batches(node, counts, blocked[:half]) + _batches(node, [], blocked[half:])
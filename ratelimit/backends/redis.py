@@ -1,57 +1,638 @@
+import asyncio
+import hashlib
 import json
+import logging
+import math
+import time
+import uuid
+from abc import abstractmethod
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
 
 from redis.asyncio import StrictRedis
+from redis.exceptions import NoScriptError, RedisError
 
 from ..rule import Rule
 from . import BaseBackend
 
-SCRIPT = """
-local ruleset = cjson.decode(ARGV[1])
+logger = logging.getLogger(__name__)
+
+BLOCKING_PREFIX = "blocking:"
+HEARTBEAT_KEY = "ratelimit:heartbeat"
+
+# Prefix of the limit scripts: the last ARGV[1] keys are the block keys of
+# the users, the TTL of every blocked user is returned with the negative
+# index of its block key before any limit is checked. `limits` is the
+# number of limit keys.
+BLOCKED_USERS = """
+local limits = #KEYS - tonumber(ARGV[1])
+local blocked = {}
+for i = limits + 1, #KEYS do
+    local ttl = redis.call('TTL', KEYS[i])
+    if ttl > 0 then
+        table.insert(blocked, ttl)
+        table.insert(blocked, limits - i)
+    end
+end
+if #blocked > 0 then
+    return blocked
+end
+"""
+
+SCRIPT = BLOCKED_USERS + """
+local ruleset = cjson.decode(ARGV[2])
+-- ruleset looks like this:
+-- {key: [limit, ttl, cost, shadow], ...}
 
 -- Set limits
-for i, key in pairs(KEYS) do
+for i = 1, limits do
+    local key = KEYS[i]
     redis.call('SET', key, ruleset[key][1], 'EX', ruleset[key][2], 'NX')
 end
 
--- Check limits
-for i = 1, #KEYS do
+-- Check limits, keys of shadow rules are reported but never reject
+local rejected = {}
+local passed = {}
+for i = 1, limits do
     local value = redis.call('GET', KEYS[i])
-    if value and tonumber(value) < 1 then
-        return ruleset[KEYS[i]][2]
+    if value and tonumber(value) < ruleset[KEYS[i]][3] then
+        table.insert(rejected, ruleset[KEYS[i]][2])
+        table.insert(rejected, i)
+        if ruleset[KEYS[i]][4] == 0 then
+            return rejected
+        end
+    else
+        table.insert(passed, KEYS[i])
     end
 end
 
--- Decrease limits
-for i, key in pairs(KEYS) do
-    redis.call('DECR', key)
+-- Decrease limits by the cost
+for i, key in ipairs(passed) do
+    redis.call('DECRBY', key, ruleset[key][3])
+end
+return rejected
+"""
+
+HASH_SCRIPT = BLOCKED_USERS + """
+local now = tonumber(ARGV[2])
+local entries = cjson.decode(ARGV[3])
+-- entries look like this:
+-- [[key index, period, limit, ttl, cost, shadow], ...]
+-- each hash has a "period" field with the used amount
+-- and a "period:start" field with the start of its window
+
+-- Check limits, periods of shadow rules are reported but never reject
+local rejected = {}
+local passed = {}
+for i, entry in ipairs(entries) do
+    local key = KEYS[entry[1]]
+    local values = redis.call('HMGET', key, entry[2], entry[2] .. ':start')
+    local used = tonumber(values[1]) or 0
+    local start = tonumber(values[2])
+    if start == nil or start + entry[4] <= now then
+        -- the window is over, a new one starts with this request
+        used = 0
+        start = nil
+    end
+    if used + entry[5] > entry[3] then
+        table.insert(rejected, math.ceil((start or now) + entry[4] - now))
+        table.insert(rejected, i)
+        if entry[6] == 0 then
+            return rejected
+        end
+    else
+        table.insert(passed, {entry, start})
+    end
+end
+
+-- Add the cost to the windows
+for i, item in ipairs(passed) do
+    local entry = item[1]
+    local key = KEYS[entry[1]]
+    if item[2] == nil then
+        redis.call('HSET', key, entry[2], entry[5])
+        redis.call('HSET', key, entry[2] .. ':start', string.format('%.3f', now))
+        if redis.call('TTL', key) < entry[4] then
+            redis.call('EXPIRE', key, entry[4])
+        end
+    else
+        redis.call('HINCRBY', key, entry[2], entry[5])
+    end
+end
+return rejected
+"""
+
+LAYOUTS = ("keys", "hash")
+
+CONCURRENCY_SCRIPT = """
+local now = tonumber(ARGV[1])
+local limit = tonumber(ARGV[2])
+local lease = tonumber(ARGV[3])
+-- each member is a slot that expires at its score
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) < limit then
+    redis.call('ZADD', KEYS[1], now + lease, ARGV[4])
+    redis.call('EXPIRE', KEYS[1], lease)
+    return 1
 end
 return 0
 """
 
 
-class RedisBackend(BaseBackend):
-    def __init__(self, redis: StrictRedis) -> None:
+class Script:
+    """
+    lua script run by EVALSHA, after a NOSCRIPT error (redis restart, failover
+    or SCRIPT FLUSH) the script is loaded again once for all waiting calls
+    """
+
+    def __init__(self, redis: StrictRedis, script: str) -> None:
+        self._redis = redis
+        self.script = script
+        self.sha = hashlib.sha1(script.encode("utf8")).hexdigest()
+        self._loading: Optional["asyncio.Future[Any]"] = None
+
+    async def load(self) -> None:
+        if self._loading is None:
+            self._loading = asyncio.ensure_future(self._load())
+        await asyncio.shield(self._loading)
+
+    async def _load(self) -> None:
+        try:
+            await self._redis.script_load(self.script)
+        finally:
+            self._loading = None
+
+    async def __call__(self, keys: Sequence[str], args: Sequence[Any]) -> Any:
+        try:
+            return await self._redis.evalsha(self.sha, len(keys), *keys, *args)
+        except NoScriptError:
+            await self.load()
+            return await self._redis.evalsha(self.sha, len(keys), *keys, *args)
+
+
+class BlockCache:
+    """
+    local copy of the block times, kept up to date by redis client tracking
+    in broadcast mode: redis pushes an invalidation on `__redis__:invalidate`
+    whenever a `blocking:` key is set, deleted or expires.
+
+    * maxsize: the cache is cleared when it holds more users
+    """
+
+    def __init__(self, redis: StrictRedis, maxsize: int = 100000) -> None:
+        self._redis = redis
+        self.maxsize = maxsize
+        # user: deadline in loop time, 0 if not blocked
+        self.users: Dict[str, float] = {}
+        # changed by every invalidation, a block time read from redis
+        # before an invalidation must not be cached
+        self.generation = 0
+        self.active = False
+        self._pubsub: Any = None
+        self._tracking: Any = None
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    def get(self, user: str) -> Optional[int]:
+        deadline = self.users.get(user)
+        if deadline is None:
+            return None
+        remaining = deadline - asyncio.get_event_loop().time()
+        return max(math.ceil(remaining), 0)
+
+    def set(self, user: str, block_time: int, generation: int) -> None:
+        if not self.active or generation != self.generation:
+            return
+        if len(self.users) >= self.maxsize:
+            self.users.clear()
+        if block_time > 0:
+            self.users[user] = asyncio.get_event_loop().time() + block_time
+        else:
+            self.users[user] = 0
+
+    def invalidate(self, keys: Optional[Sequence[Union[bytes, str]]]) -> None:
+        self.generation += 1
+        if keys is None:
+            # FLUSHDB, FLUSHALL or the tracking connection was lost
+            self.users.clear()
+            return
+        for key in keys:
+            if isinstance(key, bytes):
+                key = key.decode("utf8")
+            self.users.pop(key[len(BLOCKING_PREFIX) :], None)
+
+    async def start(self) -> None:
+        """
+        enable the tracking, raise ResponseError if redis does not support it
+        """
+        await self.connect()
+        self._task = asyncio.ensure_future(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.close()
+
+    async def connect(self) -> None:
+        self._pubsub = self._redis.pubsub()
+        try:
+            await self._pubsub.execute_command("CLIENT", "ID")
+            client_id = await self._pubsub.parse_response()
+            await self._pubsub.subscribe("__redis__:invalidate")
+            # the tracking lasts as long as this connection
+            self._tracking = self._redis.client()
+            await self._tracking.execute_command(
+                "CLIENT",
+                "TRACKING",
+                "ON",
+                "REDIRECT",
+                client_id,
+                "BCAST",
+                "PREFIX",
+                BLOCKING_PREFIX,
+            )
+        except Exception:
+            await self.close()
+            raise
+        self.active = True
+
+    async def close(self) -> None:
+        self.active = False
+        self.invalidate(None)
+        if self._pubsub is not None:
+            # `aclose` replaces `close` since redis-py 5.0.1
+            await getattr(self._pubsub, "aclose", self._pubsub.close)()
+            self._pubsub = None
+        if self._tracking is not None:
+            # drop the socket, a pooled connection must not keep the tracking
+            connection = self._tracking.connection
+            if connection is not None:
+                await connection.disconnect()
+                await self._tracking.connection_pool.release(connection)
+            self._tracking = None
+
+    async def run(self) -> None:
+        while True:
+            try:
+                subscribed = False
+                async for message in self._pubsub.listen():
+                    if message["type"] == "message":
+                        self.invalidate(message["data"])
+                    elif message["type"] == "subscribe":
+                        # redis-py subscribes again when it reconnects, but
+                        # the tracking still redirects to the lost connection
+                        if subscribed:
+                            raise ConnectionError("the connection was reset")
+                        subscribed = True
+            except Exception:
+                logger.exception("Lost the redis connection tracking block keys")
+            # block times are read from redis until the tracking is back
+            await self.close()
+            await asyncio.sleep(1)
+            try:
+                await self.connect()
+            except Exception:
+                logger.exception("Failed to enable the redis client tracking")
+                await self.close()
+
+
+class Replicas:
+    """
+    read-only replicas of the primary redis, picked in turn.
+
+    A background task increments a heartbeat key on the primary every
+    `max_staleness / 3` seconds. A replica is used only if it has received
+    the increment of the previous check, and only until `max_staleness`
+    seconds after that increment was sent, so what is read from it is at
+    most `max_staleness` seconds behind the primary.
+    """
+
+    def __init__(
+        self,
+        primary: StrictRedis,
+        replicas: Sequence[StrictRedis],
+        max_staleness: float = 1,
+    ) -> None:
+        self._primary = primary
+        self.replicas = list(replicas)
+        self.max_staleness = max_staleness
+        self.healthy: List[StrictRedis] = []
+        # (value, loop time it was sent at) of the last heartbeat
+        self._heartbeat: Optional[Tuple[int, float]] = None
+        # loop time the heartbeat received by the healthy replicas was sent at
+        self._written = 0.0
+        self._index = 0
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self.run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.healthy = []
+        self._heartbeat = None
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.check()
+            except Exception:
+                logger.exception("Failed to check the redis replicas")
+                # the primary is read until a heartbeat is received again
+                self.healthy = []
+                self._heartbeat = None
+            await asyncio.sleep(self.max_staleness / 3)
+
+    def pick(self) -> Optional[StrictRedis]:
+        if not self.healthy:
+            return None
+        loop = asyncio.get_event_loop()
+        if loop.time() - self._written > self.max_staleness:
+            # the check is late, the replicas may be behind
+            return None
+        self._index = (self._index + 1) % len(self.healthy)
+        return self.healthy[self._index]
+
+    async def check(self) -> None:
+        values = await asyncio.gather(
+            *(replica.get(HEARTBEAT_KEY) for replica in self.replicas),
+            return_exceptions=True,
+        )
+        loop = asyncio.get_event_loop()
+        if self._heartbeat is None:
+            self.healthy = []
+        else:
+            heartbeat, self._written = self._heartbeat
+            self.healthy = [
+                replica
+                for replica, value in zip(self.replicas, values)
+                if isinstance(value, (bytes, str)) and int(value) >= heartbeat
+            ]
+        written = loop.time()
+        self._heartbeat = (await self._primary.incr(HEARTBEAT_KEY), written)
+
+    def discard(self, replica: StrictRedis) -> None:
+        if replica in self.healthy:
+            self.healthy.remove(replica)
+
+
+class BaseRedisBackend(BaseBackend):
+    """
+    Common block handling and batching for the redis backends
+
+    * warm_connections: connections opened by `startup`
+    * cache_blocks: cache the block times in memory with redis client tracking
+      (redis >= 6), otherwise the limit script of every request reads the
+      TTL of the block keys
+    * replicas: read the block times from these replicas of `redis`,
+      the limit scripts always run on `redis`
+    * max_staleness: seconds a replica may lag behind `redis` to be read,
+      the replicas are checked in the background after `startup`
+    """
+
+    def __init__(
+        self,
+        redis: StrictRedis,
+        *,
+        warm_connections: int = 1,
+        cache_blocks: bool = False,
+        replicas: Union[StrictRedis, Sequence[StrictRedis], None] = None,
+        max_staleness: float = 1,
+    ) -> None:
         self._redis = redis
-        self.lua_script = self._redis.register_script(SCRIPT)
+        self.warm_connections = warm_connections
+        self.block_cache = BlockCache(redis) if cache_blocks else None
+        if isinstance(replicas, StrictRedis):
+            replicas = [replicas]
+        self.replicas = Replicas(redis, replicas, max_staleness) if replicas else None
+        self.scripts: List[Script] = []
+        self.concurrency_script = self.register_script(CONCURRENCY_SCRIPT)
+        self._started = False
+
+    def register_script(self, script: str) -> Script:
+        obj = Script(self._redis, script)
+        self.scripts.append(obj)
+        return obj
+
+    async def startup(self) -> None:
+        """
+        load the scripts in one pipeline and open `warm_connections` connections.
+        If redis is unavailable, the application starts and the scripts are
+        loaded by the first requests.
+        """
+        if self._started:
+            return
+        self._started = True
+        try:
+            async with self._redis.pipeline(transaction=False) as pipe:
+                pipe.ping()
+                for script in self.scripts:
+                    pipe.script_load(script.script)
+                await pipe.execute()
+            await asyncio.gather(
+                *(self._redis.ping() for _ in range(self.warm_connections - 1))
+            )
+        except RedisError:
+            logger.exception("Failed to prepare the redis connections")
+        if self.block_cache is not None:
+            try:
+                await self.block_cache.start()
+            except RedisError:
+                logger.warning("Redis client tracking is unavailable")
+        if self.replicas is not None:
+            self.replicas.start()
+
+    async def shutdown(self) -> None:
+        if not self._started:
+            return
+        self._started = False
+        if self.block_cache is not None:
+            await self.block_cache.stop()
+        if self.replicas is not None:
+            self.replicas.stop()
 
     async def set_block_time(self, user: str, block_time: int) -> None:
-        await self._redis.set(f"blocking:{user}", 1, block_time)
+        await self._redis.set(f"{BLOCKING_PREFIX}{user}", 1, block_time)
+        cache = self.block_cache
+        if cache is not None:
+            # do not wait for the invalidation of this write
+            cache.set(user, block_time, cache.generation)
 
     async def is_blocking(self, user: str) -> int:
-        return int(await self._redis.ttl(f"blocking:{user}"))
+        block_time = (await self.known_block_times([user])).get(user)
+        if block_time is None:
+            cache = self.block_cache
+            generation = 0 if cache is None else cache.generation
+            # a replica may not have the change the invalidation was sent for
+            block_time = int(await self._redis.ttl(f"{BLOCKING_PREFIX}{user}"))
+            if cache is not None:
+                cache.set(user, block_time, generation)
+        return block_time
 
-    async def retry_after(self, path: str, user: str, rule: Rule) -> int:
-        block_time = await self.is_blocking(user)
-        if block_time > 0:
-            return block_time
+    async def known_block_times(self, users: Sequence[str]) -> Dict[str, int]:
+        """
+        block times of `users` read without the primary, from the cache
+        or from a replica, the others are read by the limit script
+        """
+        cache = self.block_cache
+        if cache is not None and cache.active:
+            block_times = {user: cache.get(user) for user in users}
+            return {
+                user: block_time
+                for user, block_time in block_times.items()
+                if block_time is not None
+            }
+        replicas = self.replicas
+        replica = None if replicas is None else replicas.pick()
+        if replicas is None or replica is None:
+            return {}
+        try:
+            async with replica.pipeline(transaction=False) as pipe:
+                for user in users:
+                    pipe.ttl(f"{BLOCKING_PREFIX}{user}")
+                ttls = await pipe.execute()
+        except RedisError:
+            replicas.discard(replica)
+            return {}
+        return {user: int(ttl) for user, ttl in zip(users, ttls)}
 
-        ruleset = rule.ruleset(path, user)
-        retry_after = int(
-            await self.lua_script(keys=list(ruleset.keys()), args=[json.dumps(ruleset)])
+    async def acquire(self, path: str, user: str, rule: Rule) -> Optional[str]:
+        token = uuid.uuid4().hex
+        acquired = await self.concurrency_script(
+            keys=[rule.concurrency_key(path, user)],
+            args=[time.time(), rule.concurrency, rule.lease, token],
         )
+        return token if acquired else None
+
+    async def release(self, path: str, user: str, rule: Rule, token: str) -> None:
+        await self._redis.zrem(rule.concurrency_key(path, user), token)
+
+    @abstractmethod
+    async def evaluate(
+        self, ruleset: Dict[str, Tuple[int, int, int, int]], users: Sequence[str]
+    ) -> Tuple[Dict[str, int], List[Tuple[int, str]]]:
+        """
+        run the limit script over all keys of `ruleset` in one invocation,
+        unless one of `users` is blocked. Return the {user: block time} of
+        the blocked users, or the (retry after, key) of the keys that
+        rejected the request.
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def split_rejected(
+        rejected: Sequence[Any], keys: Sequence[str], users: Sequence[str]
+    ) -> Tuple[Dict[str, int], List[Tuple[int, str]]]:
+        """
+        decode the (retry after, index) pairs returned by the limit scripts,
+        negative indexes are the block keys of `users`
+        """
+        blocked: Dict[str, int] = {}
+        rejections: List[Tuple[int, str]] = []
+        for retry_after, index in zip(rejected[::2], rejected[1::2]):
+            if int(index) < 0:
+                blocked[users[-int(index) - 1]] = int(retry_after)
+            else:
+                rejections.append((int(retry_after), keys[int(index) - 1]))
+        return blocked, rejections
+
+    async def retry_after(self, path: str, user: str, rule: Rule) -> int:
+        return (await self.retry_after_many([(path, user, rule)]))[0]
+
+    async def retry_after_many(
+        self, checks: Sequence[Tuple[str, str, Rule]]
+    ) -> List[int]:
+        users = list(dict.fromkeys(user for _, user, _ in checks))
+        block_times = await self.known_block_times(users)
+        if any(block_time > 0 for block_time in block_times.values()):
+            return [max(block_times.get(user, 0), 0) for _, user, _ in checks]
+        # read in the same round trip as the limits
+        unknown = [user for user in users if user not in block_times]
+
+        # key: (limit, ttl, cost, shadow), checks sharing a key take the sum
+        # of their costs from it, the key is shadow only if all of them are
+        ruleset: Dict[str, Tuple[int, int, int, int]] = {}
+        owners: Dict[str, List[int]] = {}
+        for index, (path, user, rule) in enumerate(checks):
+            for key, (limit, ttl) in rule.ruleset(path, user).items():
+                cost, shadow = rule.cost, int(rule.shadow)
+                if key in ruleset:
+                    cost += ruleset[key][2]
+                    shadow &= ruleset[key][3]
+                ruleset[key] = (limit, ttl, cost, shadow)
+                owners.setdefault(key, []).append(index)
+
+        retry_afters = [0] * len(checks)
+        if not ruleset and not unknown:
+            return retry_afters
 
-        if retry_after > 0 and rule.block_time:
-            await self.set_block_time(user, rule.block_time)
-            retry_after = rule.block_time
+        cache = self.block_cache
+        generation = 0 if cache is None else cache.generation
+        blocked, rejections = await self.evaluate(ruleset, unknown)
+        if cache is not None:
+            for user in unknown:
+                cache.set(user, blocked.get(user, 0), generation)
+        if blocked:
+            return [blocked.get(user, 0) for _, user, _ in checks]
 
-        return retry_after
+        for retry_after, key in rejections:
+            for index in owners[key]:
+                _, user, rule = checks[index]
+                check_retry_after = retry_after
+                if rule.block_time and not rule.shadow:
+                    await self.set_block_time(user, rule.block_time)
+                    check_retry_after = rule.block_time
+                retry_afters[index] = max(retry_afters[index], check_retry_after)
+
+        return retry_afters
+
+
+class RedisBackend(BaseRedisBackend):
+    """
+    fixed windows in redis
+
+    * layout: "keys" stores every period of a rule in its own key,
+      "hash" stores all the periods of a rule for one user in one hash
+    """
+
+    def __init__(
+        self, redis: StrictRedis, *, layout: str = "keys", **kwargs: Any
+    ) -> None:
+        if layout not in LAYOUTS:
+            raise ValueError(f"layout must be one of {LAYOUTS}")
+        super().__init__(redis, **kwargs)
+        self.layout = layout
+        if layout == "hash":
+            self.hash_script = self.register_script(HASH_SCRIPT)
+        else:
+            self.lua_script = self.register_script(SCRIPT)
+
+    async def evaluate(
+        self, ruleset: Dict[str, Tuple[int, int, int, int]], users: Sequence[str]
+    ) -> Tuple[Dict[str, int], List[Tuple[int, str]]]:
+        if self.layout == "hash":
+            return await self.evaluate_hash(ruleset, users)
+        keys = list(ruleset.keys())
+        rejected = await self.lua_script(
+            keys=keys + [f"{BLOCKING_PREFIX}{user}" for user in users],
+            args=[len(users), json.dumps(ruleset)],
+        )
+        return self.split_rejected(rejected, keys, users)
+
+    async def evaluate_hash(
+        self, ruleset: Dict[str, Tuple[int, int, int, int]], users: Sequence[str]
+    ) -> Tuple[Dict[str, int], List[Tuple[int, str]]]:
+        # "path:method:user:period" is the period field of "path:method:user"
+        keys: Dict[str, int] = {}
+        entries = []
+        for key, (limit, ttl, cost, shadow) in ruleset.items():
+            hash_key, period = key.rsplit(":", 1)
+            index = keys.setdefault(hash_key, len(keys) + 1)
+            entries.append((index, period, limit, ttl, cost, shadow))
+        rejected = await self.hash_script(
+            keys=list(keys) + [f"{BLOCKING_PREFIX}{user}" for user in users],
+            args=[len(users), time.time(), json.dumps(entries)],
+        )
+        return self.split_rejected(rejected, list(ruleset.keys()), users)
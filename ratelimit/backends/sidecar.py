@@ -0,0 +1,229 @@
+import asyncio
+import itertools
+import struct
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from ..rule import RULENAMES, Rule
+from . import BaseBackend
+
+# Every frame is its length then its body, integers are little endian.
+# request: id, operation, then the arguments of the operation
+# response: id, status 0 and the result, or status 1 and the error message
+# Strings are prefixed by their length, missing numbers are -1.
+_LENGTH = struct.Struct("<I")
+_HEADER = struct.Struct("<IB")
+_COUNT = struct.Struct("<H")
+_STR_LENGTH = struct.Struct("<H")
+_RULE = struct.Struct("<5qqqIIB")
+_RETRY_AFTER = struct.Struct("<i")
+
+RETRY_AFTER, ACQUIRE, RELEASE = range(3)
+OK, ERROR = range(2)
+
+Check = Tuple[str, str, Rule]
+
+
+class SidecarError(Exception):
+    """
+    the backend of the sidecar raised an exception
+    """
+
+
+def pack_str(value: str) -> bytes:
+    data = value.encode("utf8")
+    return _STR_LENGTH.pack(len(data)) + data
+
+
+def unpack_str(data: bytes, offset: int) -> Tuple[str, int]:
+    (length,) = _STR_LENGTH.unpack_from(data, offset)
+    offset += _STR_LENGTH.size
+    return data[offset : offset + length].decode("utf8"), offset + length
+
+
+def pack_checks(checks: Sequence[Check]) -> bytes:
+    chunks = [_COUNT.pack(len(checks))]
+    for path, user, rule in checks:
+        numbers = [getattr(rule, name) for name in RULENAMES]
+        numbers += [rule.block_time, rule.concurrency]
+        chunks += [
+            pack_str(path),
+            pack_str(user),
+            pack_str(rule.method),
+            _RULE.pack(
+                *(-1 if number is None else number for number in numbers),
+                rule.lease,
+                rule.cost,  # resolved by the middleware before the backend
+                rule.shadow,
+            ),
+        ]
+    return b"".join(chunks)
+
+
+def unpack_checks(data: bytes, offset: int) -> Tuple[List[Check], int]:
+    (count,) = _COUNT.unpack_from(data, offset)
+    offset += _COUNT.size
+    checks: List[Check] = []
+    for _ in range(count):
+        path, offset = unpack_str(data, offset)
+        user, offset = unpack_str(data, offset)
+        method, offset = unpack_str(data, offset)
+        *limits, block_time, concurrency, lease, cost, shadow = _RULE.unpack_from(
+            data, offset
+        )
+        offset += _RULE.size
+        rule = Rule(
+            method=method,
+            block_time=None if block_time < 0 else block_time,
+            concurrency=None if concurrency < 0 else concurrency,
+            lease=lease,
+            cost=cost,
+            shadow=bool(shadow),
+            **{name: limit for name, limit in zip(RULENAMES, limits) if limit >= 0},
+        )
+        checks.append((path, user, rule))
+    return checks, offset
+
+
+def frame(request_id: int, code: int, payload: bytes) -> bytes:
+    """
+    a request (`code` is the operation) or a response (`code` is the status)
+    """
+    return (
+        _LENGTH.pack(_HEADER.size + len(payload))
+        + _HEADER.pack(request_id, code)
+        + payload
+    )
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Tuple[int, int, bytes]:
+    """
+    (id, code, payload) of the next frame
+    """
+    (length,) = _LENGTH.unpack(await reader.readexactly(_LENGTH.size))
+    body = await reader.readexactly(length)
+    request_id, code = _HEADER.unpack_from(body)
+    return request_id, code, body[_HEADER.size :]
+
+
+def pack_retry_afters(retry_afters: Sequence[int]) -> bytes:
+    return _COUNT.pack(len(retry_afters)) + b"".join(
+        map(_RETRY_AFTER.pack, retry_afters)
+    )
+
+
+def unpack_retry_afters(data: bytes) -> List[int]:
+    (count,) = _COUNT.unpack_from(data)
+    return [value for (value,) in _RETRY_AFTER.iter_unpack(data[_COUNT.size :])][:count]
+
+
+class SidecarBackend(BaseBackend):
+    """
+    ask a sidecar (`python -m ratelimit.sidecar`) for the decisions,
+    concurrent requests are pipelined on one connection.
+
+    * path: unix socket of the sidecar
+    * host, port: TCP address of the sidecar, if `path` is not given
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        *,
+        host: str = "127.0.0.1",
+        port: Optional[int] = None,
+    ) -> None:
+        if path is None and port is None:
+            raise ValueError("path or port must be given")
+        self.path = path
+        self.host = host
+        self.port = port
+        self._ids = itertools.count()
+        # id: response waited for
+        self._waiters: Dict[int, "asyncio.Future[bytes]"] = {}
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._connecting: Optional["asyncio.Future[asyncio.StreamWriter]"] = None
+        self._task: Optional["asyncio.Future[None]"] = None
+
+    async def connect(self) -> asyncio.StreamWriter:
+        if self._writer is not None:
+            return self._writer
+        # The calls made while connecting share the same connection
+        if self._connecting is None:
+            self._connecting = asyncio.ensure_future(self._connect())
+            self._connecting.add_done_callback(self._connected)
+        return await asyncio.shield(self._connecting)
+
+    def _connected(self, future: "asyncio.Future[asyncio.StreamWriter]") -> None:
+        self._connecting = None
+
+    async def _connect(self) -> asyncio.StreamWriter:
+        if self.path is not None:
+            reader, writer = await asyncio.open_unix_connection(self.path)
+        else:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+        self._writer = writer
+        self._task = asyncio.ensure_future(self.read_responses(reader, writer))
+        return writer
+
+    async def read_responses(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        error: Exception = ConnectionError("the sidecar closed the connection")
+        try:
+            while True:
+                request_id, status, payload = await read_frame(reader)
+                exception = None
+                if status != OK:
+                    exception = SidecarError(unpack_str(payload, 0)[0])
+                waiter = self._waiters.pop(request_id, None)
+                if waiter is None or waiter.done():
+                    continue
+                if exception is None:
+                    waiter.set_result(payload)
+                else:
+                    waiter.set_exception(exception)
+        except asyncio.IncompleteReadError:
+            pass
+        except Exception as exc:
+            error = exc
+        finally:
+            if self._writer is writer:
+                self._writer = None
+            writer.close()
+            # Requests sent on this connection will never be answered
+            waiters, self._waiters = self._waiters, {}
+            for waiter in waiters.values():
+                if not waiter.done():
+                    waiter.set_exception(error)
+
+    async def shutdown(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def request(self, operation: int, payload: bytes) -> bytes:
+        writer = await self.connect()
+        request_id = next(self._ids) % 2**32
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters[request_id] = waiter
+        try:
+            writer.write(frame(request_id, operation, payload))
+            return await waiter
+        finally:
+            self._waiters.pop(request_id, None)
+
+    async def retry_after(self, path: str, user: str, rule: Rule) -> int:
+        return (await self.retry_after_many([(path, user, rule)]))[0]
+
+    async def retry_after_many(self, checks: Sequence[Check]) -> List[int]:
+        return unpack_retry_afters(await self.request(RETRY_AFTER, pack_checks(checks)))
+
+    async def acquire(self, path: str, user: str, rule: Rule) -> Optional[str]:
+        payload = await self.request(ACQUIRE, pack_checks([(path, user, rule)]))
+        return unpack_str(payload, 0)[0] if payload else None
+
+    async def release(self, path: str, user: str, rule: Rule, token: str) -> None:
+        await self.request(RELEASE, pack_checks([(path, user, rule)]) + pack_str(token))
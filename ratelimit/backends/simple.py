@@ -1,32 +1,90 @@
 import asyncio
+import logging
+import math
+import mmap
+import os
+import struct
+import time
 from collections import defaultdict
 from dataclasses import dataclass
 from threading import Lock
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 
 from ..rule import Rule
 from . import BaseBackend
 
+logger = logging.getLogger(__name__)
+
+# Snapshot layout, all integers are little endian:
+# magic, blocked users count, (user, deadline) * count,
+# limits count, (path, rule key, count, deadline) * count
+# strings are prefixed by their length, deadlines are unix timestamps
+_MAGIC = b"RLM2"
+_HEADER = struct.Struct("<4sI")
+_COUNT = struct.Struct("<I")
+_STR_LENGTH = struct.Struct("<I")
+_DEADLINE = struct.Struct("<d")
+_LIMIT = struct.Struct("<qd")
+
+
+def _pack_str(value: str) -> bytes:
+    data = value.encode("utf8")
+    return _STR_LENGTH.pack(len(data)) + data
+
+
+def _unpack_str(data: Union[bytes, mmap.mmap], offset: int) -> Tuple[str, int]:
+    (length,) = _STR_LENGTH.unpack_from(data, offset)
+    offset += _STR_LENGTH.size
+    if offset + length > len(data):
+        raise ValueError("truncated memory backend snapshot")
+    return data[offset : offset + length].decode("utf8"), offset + length
+
+
+def _write_file(path: str, data: bytes) -> None:
+    # Replace the snapshot at once, a crash never leaves a partial file
+    with open(path + ".tmp", "wb") as file:
+        file.write(data)
+    os.replace(path + ".tmp", path)
+
 
 @dataclass
 class Limit:
     count: int
     timestamp: int
 
-    def decr(self) -> bool:
-        self.count -= 1
-        return self.count >= 0
+    def decr(self, cost: int = 1) -> None:
+        # the cost is checked by `check_limit` before it is taken
+        self.count -= cost
 
 
 class MemoryBackend(BaseBackend):
-    """simple limiter with memory"""
+    """
+    simple limiter with memory
+
+    * snapshot_path: file the state is restored from on startup
+      and saved to on shutdown
+    * snapshot_interval: seconds between two periodic snapshots
+    """
+
+    def __init__(
+        self,
+        *,
+        snapshot_path: Optional[str] = None,
+        snapshot_interval: Optional[float] = None,
+    ) -> None:
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self._snapshot_task: Optional["asyncio.Task[None]"] = None
+        self._started = False
 
-    def __init__(self):
         # user: deadline
-        self.blocked_users: Dict[str, int] = {}
+        self.blocked_users: Dict[str, float] = {}
         # path: {rule_key: (limit, timestamp)}
         self.blocks: Dict[str, Dict[str, Limit]] = defaultdict(dict)
 
+        # concurrency key: requests in flight
+        self.concurrency: Dict[str, int] = {}
+
         self.blocks_lock = Lock()
         self.blocked_users_lock = Lock()
 
@@ -41,10 +99,10 @@ class MemoryBackend(BaseBackend):
         return loop.call_later(later, callback, *args)
 
     def is_blocking(self, user: str) -> int:
-        end_ts: int = self.blocked_users.get(user, 0)
-        return max(end_ts - self.now(), 0)
+        end_ts = self.blocked_users.get(user, 0)
+        return max(math.ceil(end_ts - self.now()), 0)
 
-    def remove_user(self, user: str) -> Optional[int]:
+    def remove_user(self, user: str) -> Optional[float]:
         with self.blocked_users_lock:
             return self.blocked_users.pop(user, None)
 
@@ -78,30 +136,198 @@ class MemoryBackend(BaseBackend):
         self.remove_rule_later(path, rule)
         return obj
 
-    async def retry_after(self, path: str, user: str, rule: Rule) -> int:
-        block_time = self.is_blocking(user)
-        if block_time > 0:
-            return block_time
-        ruleset = rule.ruleset(path, user)
-
+    def check_limit(
+        self, path: str, key: str, limit: int, seconds: int, cost: int
+    ) -> int:
+        """
+        retry after of the limit `key` if `cost` can not be taken from it, else 0
+        """
         now = self.now()
         rules = self.blocks.setdefault(path, {})
+        exist_rule = rules.get(key)
+        # A window ending now is over, its retry after would be 0
+        if exist_rule is None or exist_rule.timestamp <= now:
+            exist_rule = self.set_rule(rules, path, key, limit, now + seconds)
+        if exist_rule.count < cost:
+            return exist_rule.timestamp - now
+        return 0
 
-        retry_after: int = 0
+    def take(self, path: str, key: str, seconds: int, cost: int) -> None:
+        """
+        take `cost` from the limit `key` checked by `check_limit`
+        """
+        self.blocks[path][key].decr(cost)
 
-        for rule_, (limit, seconds) in ruleset.items():
-            exist_rule = rules.get(rule_) or self.set_rule(
-                rules, path, rule_, limit, now + seconds
-            )
-            if exist_rule.timestamp < now:
-                exist_rule = self.set_rule(rules, path, rule_, limit, now + seconds)
-            if exist_rule.decr():
-                continue
+    async def retry_after(self, path: str, user: str, rule: Rule) -> int:
+        return (await self.retry_after_many([(path, user, rule)]))[0]
+
+    async def retry_after_many(
+        self, checks: Sequence[Tuple[str, str, Rule]]
+    ) -> List[int]:
+        """
+        take the cost from the limits of every check only if no check
+        rejects the request, checks of shadow rules are reported but never reject
+        """
+        block_times = [self.is_blocking(user) for _, user, _ in checks]
+        if any(block_time > 0 for block_time in block_times):
+            return block_times
+
+        retry_afters = [0] * len(checks)
+        # key: cost taken from it by the previous checks of this request
+        costs: Dict[str, int] = {}
+        taken: List[Tuple[str, str, int, int]] = []
+        for index, (path, user, rule) in enumerate(checks):
+            passed: List[Tuple[str, str, int, int]] = []
+            for key, (limit, seconds) in rule.ruleset(path, user).items():
+                retry_after = self.check_limit(
+                    path, key, limit, seconds, costs.get(key, 0) + rule.cost
+                )
+                if retry_after > 0:
+                    retry_afters[index] = retry_after
+                    break
+                passed.append((path, key, seconds, rule.cost))
             else:
-                retry_after = exist_rule.timestamp - now
-                break
+                for item in passed:
+                    costs[item[1]] = costs.get(item[1], 0) + item[3]
+                taken.extend(passed)
+                continue
+
+            if not rule.shadow:
+                if rule.block_time:
+                    retry_afters[index] = self.set_blocked_user(user, rule.block_time)
+                return retry_afters
+
+        for path, key, seconds, cost in taken:
+            self.take(path, key, seconds, cost)
+        return retry_afters
+
+    async def startup(self) -> None:
+        if self._started:
+            return
+        self._started = True
+        if self.snapshot_path is None:
+            return
+        if os.path.exists(self.snapshot_path):
+            try:
+                self.load(self.snapshot_path)
+            except (struct.error, ValueError, OSError):
+                logger.exception(
+                    "Invalid memory backend snapshot %s, starting empty",
+                    self.snapshot_path,
+                )
+        if self.snapshot_interval is not None:
+            self._snapshot_task = asyncio.ensure_future(
+                self.save_periodically(self.snapshot_path, self.snapshot_interval)
+            )
+
+    async def shutdown(self) -> None:
+        if not self._started:
+            return
+        self._started = False
+        if self._snapshot_task is not None:
+            self._snapshot_task.cancel()
+            self._snapshot_task = None
+        if self.snapshot_path is not None:
+            self.dump(self.snapshot_path)
+
+    async def save_periodically(self, path: str, interval: float) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                data = self.dumps()
+                await loop.run_in_executor(None, _write_file, path, data)
+            except Exception:
+                logger.exception("Failed to save the memory backend snapshot %s", path)
+
+    def dumps(self) -> bytes:
+        """
+        serialize the blocked users and the limits, deadlines are
+        stored as unix timestamps so that they survive a restart
+        """
+        now = self.now()
+        wall_now = time.time()
+        users = [
+            (user, deadline)
+            for user, deadline in self.blocked_users.items()
+            if deadline > now
+        ]
+        chunks = [_HEADER.pack(_MAGIC, len(users))]
+        for user, deadline in users:
+            chunks.append(_pack_str(user))
+            chunks.append(_DEADLINE.pack(wall_now + deadline - now))
+        limits = [
+            (path, rule_key, limit)
+            for path, rules in self.blocks.items()
+            for rule_key, limit in rules.items()
+            if limit.timestamp > now
+        ]
+        chunks.append(_COUNT.pack(len(limits)))
+        for path, rule_key, limit in limits:
+            chunks.append(_pack_str(path))
+            chunks.append(_pack_str(rule_key))
+            chunks.append(_LIMIT.pack(limit.count, wall_now + limit.timestamp - now))
+        return b"".join(chunks)
+
+    def dump(self, path: str) -> None:
+        _write_file(path, self.dumps())
+
+    def loads(self, data: Union[bytes, mmap.mmap]) -> None:
+        """
+        restore the state saved by `dumps`, expired entries are skipped.
+        Nothing is restored if `data` is invalid or truncated.
+        """
+        magic, count = _HEADER.unpack_from(data, 0)
+        if magic != _MAGIC:
+            raise ValueError("invalid memory backend snapshot")
+        offset = _HEADER.size
+        users: List[Tuple[str, float]] = []
+        for _ in range(count):
+            user, offset = _unpack_str(data, offset)
+            (deadline,) = _DEADLINE.unpack_from(data, offset)
+            offset += _DEADLINE.size
+            users.append((user, deadline))
+
+        (count,) = _COUNT.unpack_from(data, offset)
+        offset += _COUNT.size
+        limits: List[Tuple[str, str, int, float]] = []
+        for _ in range(count):
+            path, offset = _unpack_str(data, offset)
+            rule_key, offset = _unpack_str(data, offset)
+            limit_count, deadline = _LIMIT.unpack_from(data, offset)
+            offset += _LIMIT.size
+            limits.append((path, rule_key, limit_count, deadline))
+
+        now = self.now()
+        wall_now = time.time()
+        for user, deadline in users:
+            remaining = round(deadline - wall_now)
+            if remaining > 0:
+                self.blocked_users[user] = now + remaining
+                self.remove_blocked_user_later(user)
+        for path, rule_key, limit_count, deadline in limits:
+            remaining = round(deadline - wall_now)
+            if remaining > 0:
+                self.set_rule(
+                    self.blocks[path], path, rule_key, limit_count, now + remaining
+                )
+
+    def load(self, path: str) -> None:
+        with open(path, "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                self.loads(data)
 
-        if retry_after > 0 and rule.block_time:
-            retry_after = self.set_blocked_user(user, rule.block_time)
+    async def acquire(self, path: str, user: str, rule: Rule) -> Optional[str]:
+        key = rule.concurrency_key(path, user)
+        count = self.concurrency.get(key, 0)
+        if count >= rule.concurrency:  # type: ignore
+            return None
+        self.concurrency[key] = count + 1
+        return key
 
-        return retry_after
+    async def release(self, path: str, user: str, rule: Rule, token: str) -> None:
+        count = self.concurrency.pop(token, 0) - 1
+        if count > 0:
+            self.concurrency[token] = count
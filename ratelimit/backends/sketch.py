@@ -0,0 +1,91 @@
+import asyncio
+import math
+from array import array
+from typing import Any, Dict, List, Tuple
+
+from .simple import MemoryBackend
+
+
+class CountMinSketch:
+    """
+    approximate counters in `depth` rows of `width` counters,
+    an estimate is never lower than the real count
+    """
+
+    __slots__ = ("width", "depth", "counters")
+
+    def __init__(self, width: int, depth: int) -> None:
+        self.width = width
+        self.depth = depth
+        self.counters = array("I", bytes(4 * width * depth))
+
+    def indexes(self, key: str) -> List[int]:
+        width = self.width
+        return [row * width + hash((row, key)) % width for row in range(self.depth)]
+
+    def estimate(self, indexes: List[int]) -> int:
+        counters = self.counters
+        return min(counters[index] for index in indexes)
+
+    def add(self, indexes: List[int], cost: int) -> None:
+        # conservative update: only raise the counters below the new estimate
+        counters = self.counters
+        value = self.estimate(indexes) + cost
+        for index in indexes:
+            if counters[index] < value:
+                counters[index] = value
+
+    def clear(self) -> None:
+        self.counters[:] = array("I", bytes(4 * self.width * self.depth))
+
+
+class SketchBackend(MemoryBackend):
+    """
+    fixed windows counted in Count-Min Sketches, the memory does not grow
+    with the number of users.
+
+    * error: with probability `confidence`, a count exceeds the real count
+      by at most `error` times the total cost counted in the window
+
+    Windows are aligned on the clock, for example a minute window starts
+    every minute. Blocked users are kept exactly.
+    """
+
+    def __init__(
+        self, *, error: float = 0.001, confidence: float = 0.99, **kwargs: Any
+    ) -> None:
+        super().__init__(**kwargs)
+        self.width = math.ceil(math.e / error)
+        self.depth = math.ceil(math.log(1 / (1 - confidence)))
+        # seconds: (window number, sketch of the window, cleared spare sketch)
+        self.sketches: Dict[int, Tuple[int, CountMinSketch, CountMinSketch]] = {}
+
+    def sketch(self, seconds: int, number: int) -> CountMinSketch:
+        if seconds not in self.sketches:
+            self.sketches[seconds] = (
+                number,
+                CountMinSketch(self.width, self.depth),
+                CountMinSketch(self.width, self.depth),
+            )
+        current_number, current, spare = self.sketches[seconds]
+        if current_number != number:
+            # the spare is cleared out of the request path
+            self.sketches[seconds] = (number, spare, current)
+            asyncio.get_event_loop().call_soon(current.clear)
+            current = spare
+        return current
+
+    def check_limit(
+        self, path: str, key: str, limit: int, seconds: int, cost: int
+    ) -> int:
+        now = asyncio.get_event_loop().time()
+        number = int(now // seconds)
+        sketch = self.sketch(seconds, number)
+        if sketch.estimate(sketch.indexes(key)) + cost > limit:
+            return max(math.ceil((number + 1) * seconds - now), 1)
+        return 0
+
+    def take(self, path: str, key: str, seconds: int, cost: int) -> None:
+        # the sketch of the window seen by `check_limit`
+        sketch = self.sketches[seconds][1]
+        sketch.add(sketch.indexes(key), cost)
@@ -0,0 +1,86 @@
+import asyncio
+import math
+from array import array
+from typing import Any, Dict
+
+from .simple import MemoryBackend
+
+
+class Window:
+    """
+    costs of the last `len(buckets)` sub windows of a limit,
+    `head` is the number of the newest sub window
+    """
+
+    __slots__ = ("buckets", "head", "total")
+
+    def __init__(self, size: int, head: int) -> None:
+        self.buckets = array("I", bytes(4 * size))
+        self.head = head
+        self.total = 0
+
+    def advance(self, head: int) -> None:
+        size = len(self.buckets)
+        # clear the sub windows that left the window, at most `size`
+        for number in range(max(self.head + 1, head - size + 1), head + 1):
+            self.total -= self.buckets[number % size]
+            self.buckets[number % size] = 0
+        self.head = max(self.head, head)
+
+    def add(self, cost: int) -> None:
+        self.buckets[self.head % len(self.buckets)] += cost
+        self.total += cost
+
+    def free_at(self, amount: int) -> int:
+        """
+        number of the sub window from which `amount` has left the window
+        """
+        size = len(self.buckets)
+        freed = 0
+        for number in range(self.head - size + 1, self.head + 1):
+            freed += self.buckets[number % size]
+            if freed >= amount:
+                return number + size
+        return self.head + size
+
+
+class SlidingMemoryBackend(MemoryBackend):
+    """
+    sliding windows in memory, each window is divided in `buckets`
+    sub windows so that every limit takes a fixed amount of memory
+
+    Blocked users are kept in snapshots, windows are not.
+    """
+
+    def __init__(self, *, buckets: int = 10, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.buckets = buckets
+        # rule key: window
+        self.windows: Dict[str, Window] = {}
+
+    def expire_window(self, key: str, seconds: int) -> None:
+        window = self.windows[key]
+        loop = asyncio.get_event_loop()
+        window.advance(int(loop.time() // (seconds / self.buckets)))
+        if window.total == 0:
+            del self.windows[key]
+        else:
+            self.call_later(seconds, self.expire_window, key, seconds)
+
+    def check_limit(
+        self, path: str, key: str, limit: int, seconds: int, cost: int
+    ) -> int:
+        now = asyncio.get_event_loop().time()
+        width = seconds / self.buckets
+        window = self.windows.get(key)
+        if window is None:
+            window = self.windows[key] = Window(self.buckets, int(now // width))
+            self.call_later(seconds, self.expire_window, key, seconds)
+        window.advance(int(now // width))
+        if window.total + cost > limit:
+            number = window.free_at(window.total + cost - limit)
+            return max(math.ceil(number * width - now), 1)
+        return 0
+
+    def take(self, path: str, key: str, seconds: int, cost: int) -> None:
+        self.windows[key].add(cost)
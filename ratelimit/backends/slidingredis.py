@@ -1,78 +1,98 @@
 import json
 import time
+from typing import Any, Dict, List, Sequence, Tuple
 
 from redis.asyncio import StrictRedis
 
-from ..rule import Rule
-from . import BaseBackend
+from .redis import BLOCKED_USERS, BLOCKING_PREFIX, BaseRedisBackend
 
-SLIDING_WINDOW_SCRIPT = """
+SLIDING_WINDOW_SCRIPT = BLOCKED_USERS + """
 -- Set variables from arguments
-local now = tonumber(ARGV[1])
-local ruleset = cjson.decode(ARGV[2])
-local result = {}
+local now = tonumber(ARGV[2])
+local ruleset = cjson.decode(ARGV[3])
 -- ruleset looks like this:
--- {key: [limit, window_size], ...}
-local scores = {}
-local min = {}
-local expire_in = {}
-for i, pgname in ipairs(KEYS) do
-    -- we remove keys older than now - window_size
-    local clearBefore = now - ruleset[pgname][2]
-    redis.call('ZREMRANGEBYSCORE', pgname, 0, clearBefore)
-    -- we get the count
-    local amount = redis.call('ZCARD', pgname)
-    -- we add to sorted set if allowed ie the amount < limit
-    if amount < ruleset[pgname][1] then
-        redis.call('ZADD', pgname, now, now)
+-- {key: [limit, window_size, cost, shadow], ...}
+-- the first half of the limit keys are sorted sets, each member is
+-- "timestamp:used:cost", the second half are the counters of the total
+-- cost of the members of each set
+local sets = limits / 2
+
+-- Check every window before recording the request in any of them,
+-- windows of shadow rules are reported but never reject
+local rejected = {}
+local passed = {}
+for i = 1, sets do
+    local pgname = KEYS[i]
+    local used = KEYS[sets + i]
+    local window = ruleset[pgname][2]
+    local cost = ruleset[pgname][3]
+    -- we remove members older than now - window_size and their cost
+    local clearBefore = now - window
+    local expired = redis.call('ZRANGEBYSCORE', pgname, 0, clearBefore)
+    if #expired > 0 then
+        local removed = 0
+        for _, member in ipairs(expired) do
+            removed = removed + (tonumber(string.match(member, ':(%d+)$')) or 1)
+        end
+        redis.call('ZREMRANGEBYSCORE', pgname, 0, clearBefore)
+        if redis.call('DECRBY', used, removed) < 0 then
+            redis.call('SET', used, 0)
+        end
+    end
+    local amount = tonumber(redis.call('GET', used) or '0')
+    local excess = amount + cost - ruleset[pgname][1]
+    if excess > 0 then
+        -- the request is allowed again when the oldest members leaving
+        -- the window free enough of the limit for its cost
+        local members = redis.call('ZRANGE', pgname, 0, excess - 1, 'WITHSCORES')
+        local freed = 0
+        local free_at = now
+        for j = 1, #members, 2 do
+            freed = freed + (tonumber(string.match(members[j], ':(%d+)$')) or 1)
+            free_at = tonumber(members[j + 1])
+            if freed >= excess then
+                break
+            end
+        end
+        table.insert(rejected, math.ceil(free_at + window - now))
+        table.insert(rejected, i)
+        if ruleset[pgname][4] == 0 then
+            return rejected
+        end
+    else
+        table.insert(passed, i)
     end
-    -- cleanup, this expires the whole set in window_size secs
-    redis.call('EXPIRE', pgname, ruleset[pgname][2])
-    -- calculate the remaining amount of requests. If >= 0 then request for that window is allowed
-    scores[i] = ruleset[pgname][1] - amount
-    min[i] = redis.call('ZRANGE', pgname, 0, 0)[1]
-    expire_in[i] = - now + tonumber(min[i]) + ruleset[pgname][2]
 end
-result['scores'] = scores
-result['expire_in'] = expire_in
-return cjson.encode(result)
+
+-- Record the request, the sets expire when their window is over
+for _, i in ipairs(passed) do
+    local pgname = KEYS[i]
+    local used = KEYS[sets + i]
+    local window = ruleset[pgname][2]
+    local cost = ruleset[pgname][3]
+    local amount = redis.call('INCRBY', used, cost)
+    redis.call('ZADD', pgname, now, now .. ':' .. amount .. ':' .. cost)
+    redis.call('EXPIRE', pgname, window)
+    redis.call('EXPIRE', used, window)
+end
+return rejected
 """
 
 
-class SlidingRedisBackend(BaseBackend):
-    def __init__(self, redis: StrictRedis) -> None:
-        self._redis = redis
-        self.sliding_function = self._redis.register_script(SLIDING_WINDOW_SCRIPT)
+class SlidingRedisBackend(BaseRedisBackend):
+    def __init__(self, redis: StrictRedis, **kwargs: Any) -> None:
+        super().__init__(redis, **kwargs)
+        self.sliding_function = self.register_script(SLIDING_WINDOW_SCRIPT)
 
-    async def get_limits(self, path: str, user: str, rule: Rule) -> dict:
-        epoch = time.time()
-        ruleset = rule.ruleset(path, user)
-        r = await self.sliding_function(
-            keys=list(ruleset.keys()), args=[epoch, json.dumps(ruleset)]
+    async def evaluate(
+        self, ruleset: Dict[str, Tuple[int, int, int, int]], users: Sequence[str]
+    ) -> Tuple[Dict[str, int], List[Tuple[int, str]]]:
+        keys = list(ruleset.keys())
+        rejected = await self.sliding_function(
+            keys=keys
+            + [f"{key}:used" for key in keys]
+            + [f"{BLOCKING_PREFIX}{user}" for user in users],
+            args=[len(users), time.time(), json.dumps(ruleset)],
         )
-        mr = json.loads(r.decode())
-        # we need that in case redis returns no values for a given key, "scores" or "expire_in"
-        # if that is the case the corresponding value will be {} and we transform it to []
-        mr = {k: (v if v != {} else []) for k, v in mr.items()}
-        mr["epoch"] = epoch
-        return mr
-
-    async def set_block_time(self, user: str, block_time: int) -> None:
-        await self._redis.set(f"blocking:{user}", 1, block_time)
-
-    async def is_blocking(self, user: str) -> int:
-        return int(await self._redis.ttl(f"blocking:{user}"))
-
-    async def retry_after(self, path: str, user: str, rule: Rule) -> int:
-        block_time = await self.is_blocking(user)
-        if block_time > 0:
-            return block_time
-
-        limits = await self.get_limits(path, user, rule)
-        retry_after = limits["expire_in"][0] if not all(limits["scores"]) else 0
-
-        if retry_after > 0 and rule.block_time:
-            await self.set_block_time(user, rule.block_time)
-            retry_after = rule.block_time
-
-        return round(retry_after)
+        blocked, rejections = self.split_rejected(rejected, keys, users)
+        return blocked, [(max(retry_after, 1), key) for retry_after, key in rejections]
@@ -0,0 +1,50 @@
+from functools import lru_cache
+from ipaddress import ip_address, ip_network
+from typing import Sequence
+
+from .types import Scope
+
+
+class Bypass:
+    """
+    precompiled predicates of the requests that are never limited,
+    a request is bypassed if any predicate matches
+
+    * paths: path prefixes, like "/static/"
+    * methods: http methods, like "OPTIONS"
+    * clients: client networks, like "10.0.0.0/8"
+    * headers: header names, like "x-internal-token"
+    """
+
+    def __init__(
+        self,
+        *,
+        paths: Sequence[str] = (),
+        methods: Sequence[str] = (),
+        clients: Sequence[str] = (),
+        headers: Sequence[str] = (),
+    ) -> None:
+        self.paths = tuple(paths)
+        self.methods = frozenset(method.upper() for method in methods)
+        self.networks = tuple(ip_network(client) for client in clients)
+        self.headers = frozenset(header.lower().encode("latin-1") for header in headers)
+        self.is_bypassed_client = lru_cache(maxsize=4096)(self._is_bypassed_client)
+
+    def _is_bypassed_client(self, host: str) -> bool:
+        try:
+            address = ip_address(host)
+        except ValueError:
+            return False
+        return any(address in network for network in self.networks)
+
+    def __call__(self, scope: Scope) -> bool:
+        if self.paths and scope["path"].startswith(self.paths):
+            return True
+        if self.methods and scope.get("method") in self.methods:
+            return True
+        if self.networks and scope.get("client"):
+            if self.is_bypassed_client(scope["client"][0]):
+                return True
+        if self.headers:
+            return any(name in self.headers for name, _ in scope["headers"])
+        return False
@@ -1,26 +1,91 @@
 import asyncio
 import re
-from typing import Awaitable, Callable, Dict, Optional, Sequence, Tuple
+from dataclasses import replace
+from time import monotonic, perf_counter
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Match,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+)
 
+from .adaptive import AdaptiveController
 from .backends import BaseBackend
-from .rule import RULENAMES, Rule
-from .types import ASGIApp, Receive, Scope, Send
-
-
-def _on_blocked(retry_after: int) -> ASGIApp:
-    async def default_429(scope: Scope, receive: Receive, send: Send) -> None:
-        await send(
-            {
-                "type": "http.response.start",
-                "status": 429,
-                "headers": [
-                    (b"retry-after", str(retry_after).encode("ascii")),
-                ],
-            }
+from .instruments import Instrument
+from .queue import AdmissionQueue
+from .responses import BlockedResponses
+from .rule import RULENAMES, TTL, Rule
+from .types import ASGIApp, Message, Receive, Scope, Send
+
+Authenticate = Callable[[Scope], Awaitable[Tuple[str, str]]]
+# A (path, user, rule) check with concurrency and the token of its slot
+Lease = Tuple[Tuple[str, str, Rule], str]
+
+
+# The default response of blocked requests, built once for each retry after
+_on_blocked = BlockedResponses()
+
+
+def _key_path(rule: Rule, match: Match[str]) -> str:
+    """
+    build the path part of the backend key for the matched rule
+    """
+    if rule.zone is not None:
+        return rule.zone
+    if rule.path_key == "pattern":
+        return match.re.pattern
+    if rule.path_key == "groups":
+        groups = ",".join(
+            f"{name}={value or ''}" for name, value in match.groupdict().items()
         )
-        await send({"type": "http.response.body", "body": b"", "more_body": False})
+        return f"{match.re.pattern}:{groups}"
+    return match.string
+
+
+def _periodic(rule: Rule) -> bool:
+    return any(getattr(rule, name) is not None for name in RULENAMES)
+
+
+def _limited(rule: Rule) -> bool:
+    return rule.concurrency is not None or _periodic(rule)
+
+
+class Layer(NamedTuple):
+    authenticate: Authenticate
+    config: Dict[re.Pattern, Sequence[Rule]]
+    # {pattern without limited rules: later patterns with limited rules},
+    # authentication is skipped if none of the later patterns matches
+    unlimited: Dict[re.Pattern, Tuple[re.Pattern, ...]]
 
-    return default_429
+
+def _compile(
+    authenticate: Authenticate, config: Dict[str, Sequence[Rule]], backend: BaseBackend
+) -> Layer:
+    if not asyncio.iscoroutinefunction(authenticate):
+        raise ValueError(f"invalid authenticate function: {authenticate}")
+    if type(backend).acquire is BaseBackend.acquire and any(
+        rule.concurrency is not None for rules in config.values() for rule in rules
+    ):
+        raise ValueError(f"{type(backend).__name__} does not support concurrency rules")
+
+    patterns = {re.compile(path): value for path, value in config.items()}
+    limited = [
+        (pattern, any(_limited(rule) for rule in rules))
+        for pattern, rules in patterns.items()
+    ]
+    unlimited = {
+        pattern: tuple(
+            later for later, is_limited in limited[index + 1 :] if is_limited
+        )
+        for index, (pattern, is_limited) in enumerate(limited)
+        if not is_limited
+    }
+    return Layer(authenticate, patterns, unlimited)
 
 
 class RateLimitMiddleware:
@@ -31,67 +96,536 @@ class RateLimitMiddleware:
     def __init__(
         self,
         app: ASGIApp,
-        authenticate: Callable[[Scope], Awaitable[Tuple[str, str]]],
+        authenticate: Authenticate,
         backend: BaseBackend,
         config: Dict[str, Sequence[Rule]],
         *,
+        layers: Sequence[Tuple[Authenticate, Dict[str, Sequence[Rule]]]] = (),
+        bypass: Optional[Callable[[Scope], bool]] = None,
         on_auth_error: Optional[Callable[[Exception], Awaitable[ASGIApp]]] = None,
         on_blocked: Callable[[int], ASGIApp] = _on_blocked,
+        instrument: Optional[Instrument] = None,
+        shadow: bool = False,
+        on_shadow_blocked: Optional[
+            Callable[[Scope, str, str, Rule, int], None]
+        ] = None,
+        websocket_close_code: int = 1008,
+        websocket_batch: int = 10,
+        controller: Optional[AdaptiveController] = None,
+        queue: Optional[AdmissionQueue] = None,
     ) -> None:
         self.app = app
-        self.authenticate = authenticate
         self.backend = backend
 
-        if not asyncio.iscoroutinefunction(self.authenticate):
-            raise ValueError(f"invalid authenticate function: {self.authenticate}")
-
         assert isinstance(backend, BaseBackend), f"invalid backend: {self.backend}"
 
-        self.config: Dict[re.Pattern, Sequence[Rule]] = {
-            re.compile(path): value for path, value in config.items()
-        }
+        # Every layer is evaluated for each request, the first one is
+        # `authenticate` with `config`. The whole list is replaced at once
+        # by `update_config`, requests in flight keep the list they started with.
+        self.layers = [
+            _compile(*layer, backend) for layer in ((authenticate, config), *layers)
+        ]
 
+        # Requests for which `bypass` returns True are never limited
+        self.bypass = bypass
         self.on_auth_error = on_auth_error
         self.on_blocked = on_blocked
+        self.instrument = instrument
+        # In shadow mode every matched rule is replaced by a shadow rule
+        self.shadow = shadow
+        self.on_shadow_blocked = on_shadow_blocked
+        self.websocket_close_code = websocket_close_code
+        self.websocket_batch = websocket_batch
+        # {backend keys of the message checks: (messages left, expiry)}
+        self.websocket_tokens: Dict[Tuple[str, ...], Tuple[int, float]] = {}
+        # Scales the limits with the load of the application
+        self.controller = controller
+        # Delays blocked http requests instead of rejecting them
+        self.queue = queue
+
+    @property
+    def authenticate(self) -> Authenticate:
+        return self.layers[0].authenticate
+
+    @property
+    def config(self) -> Dict[re.Pattern, Sequence[Rule]]:
+        return self.layers[0].config
+
+    def update_config(
+        self,
+        config: Dict[str, Sequence[Rule]],
+        *,
+        layers: Optional[
+            Sequence[Tuple[Authenticate, Dict[str, Sequence[Rule]]]]
+        ] = None,
+    ) -> None:
+        """
+        replace `config`, and the other layers if `layers` is given,
+        without interrupting requests in flight
+        """
+        new_layers = [_compile(self.authenticate, config, self.backend)]
+        if layers is None:
+            new_layers.extend(self.layers[1:])
+        else:
+            new_layers.extend(_compile(*layer, self.backend) for layer in layers)
+        self.layers = new_layers
 
     async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
-        if scope["type"] != "http":  # pragma: no cover
+        if scope["type"] == "http":
+            methods: Tuple[str, ...] = (scope["method"].lower(), "*")
+        elif scope["type"] == "websocket":
+            # Only rules of method "websocket" limit the connections
+            methods = ("websocket",)
+        elif scope["type"] == "lifespan":
+            return await self.app(scope, self.lifespan_receive(receive), send)
+        else:  # pragma: no cover
             return await self.app(scope, receive, send)
 
+        if self.bypass is not None and self.bypass(scope):
+            return await self.app(scope, receive, send)
+
+        controller = self.controller
+        if controller is not None:
+            controller.start()
+
+        users: Dict[Authenticate, Tuple[str, str]] = {}
+        try:
+            checks = await self.find_checks(scope, methods, users)
+        except Exception as exc:
+            if self.on_auth_error is not None:
+                response = await self.on_auth_error(exc)
+                if scope["type"] == "websocket":
+                    return await self.refuse_websocket(
+                        scope, receive, send, response, None
+                    )
+                return await response(scope, receive, send)
+            raise exc
+
+        # Slots are taken first, a request refused for concurrency
+        # takes nothing from the rate limits
+        leases: List[Lease] = []
+        if any(rule.concurrency is not None for _, _, rule in checks):
+            acquired = await self.acquire_slots(scope, checks)
+            if acquired is None:
+                return await self.refuse(scope, receive, send, 1)
+            leases = acquired
+
+        checks = [check for check in checks if _periodic(check[2])]
+        queued = self.queue is not None and scope["type"] == "http"
+        # the key of the check blocking the longest, to wait in its line
+        blocking = [""] if queued else None
+        retry_after = await self.decide(scope, checks, blocking) if checks else 0
+
+        if retry_after > 0 and queued:
+            # The slots are kept while waiting, the request is in flight
+            retry_after = await self.wait_admission(
+                scope, checks, retry_after, blocking[0]  # type: ignore
+            )
+
+        if retry_after > 0:
+            if leases:
+                await self.release_slots(leases)
+            return await self.refuse(scope, receive, send, retry_after)
+
+        if scope["type"] == "websocket":
+            return await self.websocket(scope, receive, send, users, leases)
+
+        if controller is not None and controller.target_latency is not None:
+            started = perf_counter()
+            try:
+                return await self.run_app(scope, receive, send, leases)
+            finally:
+                controller.observe_latency(perf_counter() - started)
+        return await self.run_app(scope, receive, send, leases)
+
+    async def refuse(
+        self, scope: Scope, receive: Receive, send: Send, retry_after: int
+    ) -> None:
+        """
+        answer a blocked request or websocket connection
+        """
+        response = self.on_blocked(retry_after)
+        if scope["type"] == "websocket":
+            return await self.refuse_websocket(
+                scope, receive, send, response, self.websocket_close_code
+            )
+        return await response(scope, receive, send)
+
+    async def wait_admission(
+        self,
+        scope: Scope,
+        checks: List[Tuple[str, str, Rule]],
+        retry_after: int,
+        key: str,
+    ) -> int:
+        """
+        wait in the line of `key` in `self.queue` while the request is blocked,
+        return the last retry after
+        """
+        queue: AdmissionQueue = self.queue  # type: ignore
+        return await queue.admit(
+            checks[0][2].group, key, retry_after, lambda: self.decide(scope, checks)
+        )
+
+    async def acquire_slots(
+        self, scope: Scope, checks: List[Tuple[str, str, Rule]]
+    ) -> Optional[List[Lease]]:
+        """
+        take a slot of every concurrency rule of `checks`, return the
+        slots taken, or None after releasing them if the request is blocked
+        """
+        checks = [check for check in checks if check[2].concurrency is not None]
+        tokens = await asyncio.gather(
+            *(self.backend.acquire(*check) for check in checks)
+        )
+        leases = [(check, token) for check, token in zip(checks, tokens) if token]
+
+        blocked = False
+        for (path, user, rule), token in zip(checks, tokens):
+            if token is not None:
+                continue
+            if rule.shadow:
+                if self.on_shadow_blocked is not None:
+                    self.on_shadow_blocked(scope, path, user, rule, 1)
+            else:
+                blocked = True
+        if blocked:
+            await self.release_slots(leases)
+            return None
+        return leases
+
+    async def release_slots(self, leases: List[Lease]) -> None:
+        await asyncio.gather(
+            *(self.backend.release(*check, token) for check, token in leases)
+        )
+
+    async def run_app(
+        self, scope: Scope, receive: Receive, send: Send, leases: List[Lease]
+    ) -> None:
+        """
+        run `self.app` while holding the slots of `leases`, they are
+        released after the last http body message or when the app returns
+        """
+        if not leases:
+            return await self.app(scope, receive, send)
+
+        released = False
+
+        async def release() -> None:
+            nonlocal released
+            if not released:
+                released = True
+                await self.release_slots(leases)
+
+        async def wrapped_send(message: Message) -> None:
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get(
+                "more_body", False
+            ):
+                await release()
+
+        try:
+            await self.app(scope, receive, wrapped_send)
+        finally:
+            await release()
+
+    async def find_checks(
+        self,
+        scope: Scope,
+        methods: Tuple[str, ...],
+        users: Dict[Authenticate, Tuple[str, str]],
+    ) -> List[Tuple[str, str, Rule]]:
+        """
+        find the (path, user, rule) checks of all layers for rules of `methods`
+        """
+        instrument = self.instrument
+        # seconds spent in authentication, only measured with an instrument
+        timings = None if instrument is None else [0.0]
+        started = 0.0 if instrument is None else perf_counter()
+
+        checks: List[Tuple[str, str, Rule]] = []
+        for layer in self.layers:
+            check = await self.match(scope, layer, methods, users, timings)
+            if check is not None:
+                checks.append(check)
+
+        if instrument is not None:
+            authenticated = timings[0]  # type: ignore
+            instrument.on_request(
+                authenticated, perf_counter() - started - authenticated
+            )
+        return checks
+
+    async def decide(
+        self,
+        scope: Scope,
+        checks: List[Tuple[str, str, Rule]],
+        blocking: Optional[List[str]] = None,
+    ) -> int:
+        """
+        evaluate `checks` with the backend, return the retry after of
+        the request, 0 if it is allowed. `blocking[0]` is set to the key
+        of the check with the longest retry after.
+        """
+        instrument = self.instrument
+        if instrument is None:
+            retry_afters = await self.backend.retry_after_many(checks)
+        else:
+            retry_afters = await self.instrumented_retry_after(checks, instrument)
+
+        retry_after = 0
+        for (path, user, rule), check_retry_after in zip(checks, retry_afters):
+            if check_retry_after == 0:
+                continue
+            if rule.shadow:
+                if self.on_shadow_blocked is not None:
+                    self.on_shadow_blocked(scope, path, user, rule, check_retry_after)
+            elif check_retry_after > retry_after:
+                retry_after = check_retry_after
+                if blocking is not None:
+                    blocking[0] = f"{path}:{rule.method}:{user}"
+        return retry_after
+
+    async def websocket(
+        self,
+        scope: Scope,
+        receive: Receive,
+        send: Send,
+        users: Dict[Authenticate, Tuple[str, str]],
+        leases: List[Lease],
+    ) -> None:
+        """
+        run an allowed websocket connection, limiting the received messages
+        with the rules of method "message"
+        """
+        checks = await self.find_checks(scope, ("message",), users)
+        checks = [check for check in checks if _periodic(check[2])]
+        if not checks:
+            return await self.run_app(scope, receive, send, leases)
+        receive, finish = self.websocket_receive(scope, receive, send, checks)
+        try:
+            return await self.run_app(scope, receive, send, leases)
+        finally:
+            finish()
+
+    async def refuse_websocket(
+        self,
+        scope: Scope,
+        receive: Receive,
+        send: Send,
+        response: ASGIApp,
+        close_code: Optional[int],
+    ) -> None:
+        """
+        answer the http `response` if the server supports the websocket
+        http response extension, otherwise accept the connection and close it
+        with `close_code`, or close it before accepting it if `close_code` is None
+        """
+        message = await receive()
+        if message["type"] != "websocket.connect":
+            return
+
+        if "websocket.http.response" in (scope.get("extensions") or {}):
+
+            async def wrapped_send(message: Message) -> None:
+                await send({**message, "type": "websocket." + message["type"]})
+
+            return await response(scope, receive, wrapped_send)
+
+        if close_code is None:
+            return await send({"type": "websocket.close"})
+        await send({"type": "websocket.accept"})
+        await send({"type": "websocket.close", "code": close_code})
+
+    def websocket_receive(
+        self,
+        scope: Scope,
+        receive: Receive,
+        send: Send,
+        checks: List[Tuple[str, str, Rule]],
+    ) -> Tuple[Receive, Callable[[], None]]:
+        """
+        take the cost of `websocket_batch` messages at once from the backend,
+        and count the messages of the batch locally. The returned function
+        keeps the messages left in the batch for the next connection with
+        the same checks, until the shortest period of the rules has passed.
+        Rules with `block_time` are checked message by message, since a refused
+        batch would block a user who did not go over the limit.
+        """
+        batch = min(
+            [self.websocket_batch]
+            + [1 for _, _, rule in checks if rule.block_time]
+            + [
+                max(getattr(rule, name) // rule.cost, 1)
+                for _, _, rule in checks
+                for name in RULENAMES
+                if getattr(rule, name) is not None
+            ]
+        )
+        batch_checks = [
+            (path, user, replace(rule, cost=rule.cost * batch))
+            for path, user, rule in checks
+        ]
+        period = min(
+            (
+                TTL[name]
+                for _, _, rule in checks
+                for name in RULENAMES
+                if getattr(rule, name) is not None
+            ),
+            default=0,
+        )
+        key = tuple(
+            sorted(
+                key for path, user, rule in checks for key in rule.ruleset(path, user)
+            )
+        )
+        disconnect = {"type": "websocket.disconnect", "code": self.websocket_close_code}
+        tokens, expires = self.websocket_tokens.pop(key, (0, 0.0))
+        if expires <= monotonic():
+            tokens = 0
+        closed = False
+
+        async def wrapped_receive() -> Message:
+            nonlocal tokens, expires, closed
+            if closed:
+                return dict(disconnect)
+
+            message = await receive()
+            if message["type"] != "websocket.receive":
+                return message
+
+            if tokens == 0:
+                # The last messages of a period are taken one by one
+                if await self.decide(scope, batch_checks) == 0:
+                    tokens = batch
+                elif batch == 1 or await self.decide(scope, checks) > 0:
+                    closed = True
+                    await send(
+                        {"type": "websocket.close", "code": self.websocket_close_code}
+                    )
+                    return dict(disconnect)
+                else:
+                    tokens = 1
+                expires = monotonic() + period
+            tokens -= 1
+            return message
+
+        def finish() -> None:
+            if tokens == 0 or expires <= monotonic():
+                return
+            now = monotonic()
+            carried = self.websocket_tokens
+            left, left_expires = carried.pop(key, (0, expires))
+            if left_expires <= now:
+                left, left_expires = 0, expires
+            # Entries are mostly kept in the order they expire
+            while carried:
+                old_key = next(iter(carried))
+                if carried[old_key][1] > now:
+                    break
+                del carried[old_key]
+            carried[key] = (tokens + left, min(expires, left_expires))
+
+        return wrapped_receive, finish
+
+    def lifespan_receive(self, receive: Receive) -> Receive:
+        """
+        start and shut down the backend with the ASGI lifespan messages
+        """
+
+        async def wrapped_receive() -> Message:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await self.backend.startup()
+                if self.controller is not None:
+                    self.controller.start()
+            elif message["type"] == "lifespan.shutdown":
+                await self.backend.shutdown()
+                if self.controller is not None:
+                    self.controller.stop()
+            return message
+
+        return wrapped_receive
+
+    async def match(
+        self,
+        scope: Scope,
+        layer: Layer,
+        methods: Tuple[str, ...],
+        users: Dict[Authenticate, Tuple[str, str]],
+        timings: Optional[List[float]] = None,
+    ) -> Optional[Tuple[str, str, Rule]]:
+        """
+        find the (path, user, rule) check of one layer for rules of `methods`,
+        `users` caches the authentication results of this request
+        and `timings[0]` accumulates the authentication time
+        """
+        authenticate = layer.authenticate
         url_path = scope["path"]
-        for pattern, rules in self.config.items():
-            if not pattern.match(url_path):
+        for pattern, rules in layer.config.items():
+            match = pattern.match(url_path)
+            if match is None:
                 continue
+            # No need to know the user if no rule can limit this request
+            if pattern in layer.unlimited and not any(
+                later.match(url_path) for later in layer.unlimited[pattern]
+            ):
+                return None
             # After finding the first rule that can match the path,
             # calculate the user ID and group
-            try:
-                user, group = await self.authenticate(scope)
-            except Exception as exc:
-                if self.on_auth_error is not None:
-                    response = await self.on_auth_error(exc)
-                    return await response(scope, receive, send)
-                raise exc
+            if authenticate not in users:
+                if timings is None:
+                    users[authenticate] = await authenticate(scope)
+                else:
+                    authenticating = perf_counter()
+                    users[authenticate] = await authenticate(scope)
+                    timings[0] += perf_counter() - authenticating
+            user, group = users[authenticate]
 
             # Select the first rule that can be matched
-            method = scope["method"].lower()
             match_rule = list(
                 filter(
-                    lambda r: r.group == group and r.method.lower() in [method, "*"],
+                    lambda r: r.group == group and r.method.lower() in methods,
                     rules,
                 )
             )
             if match_rule:
                 rule = match_rule[0]
                 break
-        else:  # If no rule can match, run `self.app` and return
-            return await self.app(scope, receive, send)
+        else:  # If no rule can match, no limit in this layer
+            return None
 
-        if not any(getattr(rule, name) is not None for name in RULENAMES):
-            return await self.app(scope, receive, send)
+        if not _limited(rule):
+            return None
 
-        path: str = url_path if rule.zone is None else rule.zone
-        retry_after = await self.backend.retry_after(path, user, rule)
-        if retry_after == 0:
-            return await self.app(scope, receive, send)
+        if self.controller is not None:
+            rule = self.controller.scale(rule)
+
+        # Backends only receive rules with an integer cost
+        if rule.cost_function is not None:
+            rule = replace(rule, cost=rule.cost_function(scope), cost_function=None)
+
+        # Backends never block users for shadow rules
+        if self.shadow and not rule.shadow:
+            rule = replace(rule, shadow=True)
+
+        return _key_path(rule, match), user, rule
+
+    async def instrumented_retry_after(
+        self, checks: List[Tuple[str, str, Rule]], instrument: Instrument
+    ) -> List[int]:
+        """
+        call `backend.retry_after_many` and report to `instrument`
+        """
+        started = perf_counter()
+        try:
+            retry_afters = await self.backend.retry_after_many(checks)
+        except Exception as exc:
+            instrument.on_backend_error(exc)
+            raise exc
+        instrument.on_backend(perf_counter() - started)
 
-        return await self.on_blocked(retry_after)(scope, receive, send)
+        for (path, user, rule), retry_after in zip(checks, retry_afters):
+            instrument.on_check(path, user, rule, retry_after)
+        return retry_afters
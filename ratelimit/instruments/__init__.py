@@ -0,0 +1,28 @@
+from ..rule import Rule
+
+
+class Instrument:
+    """
+    Receive the measurements of `RateLimitMiddleware`,
+    every method does nothing by default.
+    """
+
+    def on_request(self, authenticate: float, match: float) -> None:
+        """
+        seconds spent in authentication and rule matching for one request
+        """
+
+    def on_backend(self, seconds: float) -> None:
+        """
+        seconds spent in one backend call, evaluating all the checks of a decision
+        """
+
+    def on_check(self, path: str, user: str, rule: Rule, retry_after: int) -> None:
+        """
+        result of one (path, user, rule) check, `retry_after` is 0 if allowed
+        """
+
+    def on_backend_error(self, exc: Exception) -> None:
+        """
+        the backend raised `exc`
+        """
@@ -0,0 +1,135 @@
+import asyncio
+import math
+from typing import Dict, List, Tuple
+
+from ..rule import Rule
+from . import Instrument
+
+
+class SpaceSaving:
+    """
+    the `capacity` most frequent keys of a stream (Space-Saving algorithm).
+
+    A key missing from the counters replaces one with the lowest count,
+    its count is then over-estimated by at most that lowest count.
+    Keys are grouped by count so that every update takes O(1).
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        # key: (count, error)
+        self.counters: Dict[str, Tuple[int, int]] = {}
+        # count: keys with this count, in insertion order
+        self.buckets: Dict[int, Dict[str, None]] = {}
+        self.min_count = 0
+
+    def add(self, key: str) -> None:
+        if key in self.counters:
+            count, error = self.counters[key]
+            self._remove(key, count)
+        elif len(self.counters) < self.capacity:
+            count, error = 0, 0
+        else:
+            count = error = self.min_count
+            evicted = next(iter(self.buckets[count]))
+            del self.counters[evicted]
+            self._remove(evicted, count)
+
+        self.counters[key] = (count + 1, error)
+        self.buckets.setdefault(count + 1, {})[key] = None
+        if count == 0:
+            self.min_count = 1
+        elif count == self.min_count and count not in self.buckets:
+            self.min_count = count + 1
+
+    def _remove(self, key: str, count: int) -> None:
+        keys = self.buckets[count]
+        del keys[key]
+        if not keys:
+            del self.buckets[count]
+
+    def top(self, n: int) -> List[Tuple[str, int, int]]:
+        """
+        (key, count, error) of the `n` keys with the highest counts
+        """
+        result: List[Tuple[str, int, int]] = []
+        for count in sorted(self.buckets, reverse=True):
+            for key in self.buckets[count]:
+                if len(result) == n:
+                    return result
+                result.append((key, count, self.counters[key][1]))
+        return result
+
+
+class OffendersInstrument(Instrument):
+    """
+    track the users rejected most often in each zone and the users
+    currently blocked, without reading the backend.
+
+    A zone is the `zone` of the rule, or the matched pattern for rules with
+    `path_key="pattern"`, otherwise "group:method" of the rule, so that
+    the zones do not grow with the request paths. Shadow rules are ignored.
+
+    * capacity: users tracked per zone
+    * max_blocked: blocked users tracked at the same time
+    * max_zones: zones tracked, the rejections of new zones are ignored
+    """
+
+    def __init__(
+        self, capacity: int = 100, max_blocked: int = 10000, max_zones: int = 1000
+    ) -> None:
+        self.capacity = capacity
+        self.max_blocked = max_blocked
+        self.max_zones = max_zones
+        # zone: rejected users
+        self.zones: Dict[str, SpaceSaving] = {}
+        # user: deadline in loop time
+        self.blocked_users: Dict[str, float] = {}
+
+    def on_check(self, path: str, user: str, rule: Rule, retry_after: int) -> None:
+        if retry_after <= 0 or rule.shadow:
+            return
+        if rule.zone is not None or rule.path_key == "pattern":
+            name = path
+        else:
+            name = f"{rule.group}:{rule.method}"
+        zone = self.zones.get(name)
+        if zone is None and len(self.zones) < self.max_zones:
+            zone = self.zones[name] = SpaceSaving(self.capacity)
+        if zone is not None:
+            zone.add(user)
+
+        if rule.block_time:
+            now = asyncio.get_event_loop().time()
+            if len(self.blocked_users) >= self.max_blocked:
+                self._prune(now)
+            if len(self.blocked_users) < self.max_blocked:
+                self.blocked_users[user] = now + retry_after
+
+    def _prune(self, now: float) -> None:
+        self.blocked_users = {
+            user: deadline
+            for user, deadline in self.blocked_users.items()
+            if deadline > now
+        }
+
+    async def top(self, n: int = 10) -> Dict[str, List[Tuple[str, int]]]:
+        """
+        {zone: [(user, rejections), ...]} of the `n` users rejected most often,
+        rejections may be over-estimated when a zone has more than `capacity` users
+        """
+        return {
+            name: [(user, count) for user, count, _ in zone.top(n)]
+            for name, zone in self.zones.items()
+        }
+
+    async def blocked(self) -> Dict[str, int]:
+        """
+        {user: seconds} of the users blocked by this process
+        """
+        now = asyncio.get_event_loop().time()
+        self._prune(now)
+        return {
+            user: math.ceil(deadline - now)
+            for user, deadline in self.blocked_users.items()
+        }
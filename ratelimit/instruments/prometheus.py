@@ -0,0 +1,59 @@
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Histogram
+
+from ..rule import Rule
+from . import Instrument
+
+
+class PrometheusInstrument(Instrument):
+    """
+    export the measurements as prometheus metrics
+
+    The `zone` label is the key path of the check, use `zone` or `path_key`
+    in your rules to keep its cardinality bounded.
+    """
+
+    def __init__(
+        self, namespace: str = "ratelimit", registry: CollectorRegistry = REGISTRY
+    ) -> None:
+        self.latency = Histogram(
+            "decision_seconds",
+            "Time spent deciding whether to limit a request",
+            ["stage"],
+            namespace=namespace,
+            registry=registry,
+        )
+        self.decisions = Counter(
+            "decisions_total",
+            "Rate limit decisions",
+            ["zone", "group", "result"],
+            namespace=namespace,
+            registry=registry,
+        )
+        self.backend_batches = Counter(
+            "backend_batches_total",
+            "Batches of checks sent to the rate limit backend, one per decision",
+            namespace=namespace,
+            registry=registry,
+        )
+        self.backend_errors = Counter(
+            "backend_errors_total",
+            "Errors raised by the rate limit backend",
+            ["error"],
+            namespace=namespace,
+            registry=registry,
+        )
+
+    def on_request(self, authenticate: float, match: float) -> None:
+        self.latency.labels("authenticate").observe(authenticate)
+        self.latency.labels("match").observe(match)
+
+    def on_backend(self, seconds: float) -> None:
+        self.latency.labels("backend").observe(seconds)
+        self.backend_batches.inc()
+
+    def on_check(self, path: str, user: str, rule: Rule, retry_after: int) -> None:
+        result = "blocked" if retry_after else "allowed"
+        self.decisions.labels(path, rule.group, result).inc()
+
+    def on_backend_error(self, exc: Exception) -> None:
+        self.backend_errors.labels(type(exc).__name__).inc()
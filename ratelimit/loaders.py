@@ -0,0 +1,79 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+from .core import RateLimitMiddleware
+from .rule import Rule
+
+logger = logging.getLogger(__name__)
+
+
+def parse_config(data: Dict[str, List[Dict[str, Any]]]) -> Dict[str, Sequence[Rule]]:
+    """
+    build a config from JSON data like `{"^/towns": [{"second": 1}]}`
+    """
+    return {path: [Rule(**rule) for rule in rules] for path, rules in data.items()}
+
+
+def _decode(value: Union[bytes, str]) -> str:
+    return value.decode("utf8") if isinstance(value, bytes) else value
+
+
+def _read_file(path: str) -> Tuple[float, Dict[str, Sequence[Rule]]]:
+    mtime = os.stat(path).st_mtime
+    with open(path, encoding="utf8") as file:
+        return mtime, parse_config(json.load(file))
+
+
+async def watch_file(
+    middleware: RateLimitMiddleware, path: str, interval: float = 5
+) -> None:
+    """
+    poll the JSON file at `path` every `interval` seconds and
+    update the config of `middleware` when it changes.
+
+    Errors are logged and the current config is kept.
+    """
+    loop = asyncio.get_event_loop()
+    last_mtime: Optional[float] = None
+    while True:
+        try:
+            mtime = os.stat(path).st_mtime
+            if mtime != last_mtime:
+                last_mtime, config = await loop.run_in_executor(None, _read_file, path)
+                middleware.update_config(config)
+        except Exception:
+            logger.exception("Failed to load rate limit config from %s", path)
+        await asyncio.sleep(interval)
+
+
+async def watch_redis_hash(
+    middleware: RateLimitMiddleware, redis: Any, key: str, interval: float = 5
+) -> None:
+    """
+    poll the redis hash `key` every `interval` seconds and
+    update the config of `middleware` when it changes.
+
+    Each field is a path pattern and its value is a JSON object like
+    `{"order": 0, "rules": [{"second": 1}]}`, patterns are matched
+    by ascending `order`.
+
+    Errors are logged and the current config is kept.
+    """
+    last_value: Optional[Dict[Any, Any]] = None
+    while True:
+        try:
+            value = await redis.hgetall(key)
+            if value != last_value:
+                fields = sorted(
+                    ((_decode(path), json.loads(data)) for path, data in value.items()),
+                    key=lambda field: field[1].get("order", 0),
+                )
+                config = parse_config({path: data["rules"] for path, data in fields})
+                middleware.update_config(config)
+                last_value = value
+        except Exception:
+            logger.exception("Failed to load rate limit config from redis %s", key)
+        await asyncio.sleep(interval)
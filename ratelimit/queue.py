@@ -0,0 +1,170 @@
+import asyncio
+import heapq
+import itertools
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+
+class _Waiter:
+    """
+    a blocked request, `future` is resolved with True when it may decide
+    again and with False when it is evicted or waited too long
+    """
+
+    __slots__ = ("priority", "order", "future", "done")
+
+    def __init__(
+        self, priority: int, order: int, future: "asyncio.Future[bool]"
+    ) -> None:
+        self.priority = priority
+        self.order = order
+        self.future = future
+        self.done = False
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        # the highest priority first, then the oldest
+        return (other.priority, self.order) < (self.priority, other.order)
+
+
+class _Line:
+    """
+    the requests blocked on the same key, only the first one decides
+    """
+
+    __slots__ = ("key", "waiters", "owner", "timer")
+
+    def __init__(self, key: str) -> None:
+        self.key = key
+        # heap of waiters, finished waiters are removed lazily
+        self.waiters: List[_Waiter] = []
+        # the waiter deciding now
+        self.owner: Optional[_Waiter] = None
+        # wakes the first waiter when the retry after has passed
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class AdmissionQueue:
+    """
+    delay blocked requests until they are admitted instead of rejecting them.
+
+    Requests blocked on the same key wait in line, by priority then arrival.
+    Only the first one is decided again when its retry after has passed,
+    the next one is decided as soon as it is admitted.
+
+    * max_wait: the longest time a request waits in total (seconds)
+    * maxsize: the number of requests waiting at the same time
+    * priorities: {group: priority}, groups not listed have priority 0.
+      When the queue is full, a request evicts the newest waiting request with
+      the lowest priority if it is lower than its own, otherwise it is rejected.
+    """
+
+    def __init__(
+        self,
+        max_wait: float,
+        maxsize: int = 1000,
+        priorities: Optional[Dict[str, int]] = None,
+    ) -> None:
+        self.max_wait = max_wait
+        self.maxsize = maxsize
+        self.priorities = priorities or {}
+        self._lines: Dict[str, _Line] = {}
+        # heap of (priority, -order, waiter) to evict the newest of the lowest
+        # priority, finished waiters are removed lazily
+        self._waiters: List[Tuple[int, int, _Waiter]] = []
+        self._counter = itertools.count()
+        self.size = 0
+
+    def _make_room(self, priority: int) -> bool:
+        if self.size < self.maxsize:
+            return True
+        while self._waiters and self._waiters[0][2].done:
+            heapq.heappop(self._waiters)
+        if not self._waiters or self._waiters[0][0] >= priority:
+            return False
+        waiter = self._waiters[0][2]
+        if waiter.future.done():
+            # it is deciding now
+            return False
+        heapq.heappop(self._waiters)
+        self._finish(waiter, False)
+        return True
+
+    def _finish(self, waiter: _Waiter, result: bool) -> None:
+        if not waiter.done:
+            waiter.done = True
+            self.size -= 1
+        if not waiter.future.done():
+            waiter.future.set_result(result)
+
+    def _schedule(self, line: _Line, delay: float) -> None:
+        # a line has a timer or an owner until it is empty, never both
+        loop = asyncio.get_event_loop()
+        line.timer = loop.call_later(delay, self._wake, line)
+
+    def _wake(self, line: _Line) -> None:
+        """
+        let the first waiter of `line` decide
+        """
+        line.timer = None
+        waiters = line.waiters
+        while waiters and waiters[0].done:
+            heapq.heappop(waiters)
+        if not waiters:
+            del self._lines[line.key]
+            return
+        line.owner = waiters[0]
+        waiters[0].future.set_result(True)
+
+    async def admit(
+        self,
+        group: str,
+        key: str,
+        retry_after: int,
+        decide: Callable[[], Awaitable[int]],
+    ) -> int:
+        """
+        wait in the line of `key` until `decide` admits the request,
+        return the last retry after, 0 if the request is admitted
+        """
+        priority = self.priorities.get(group, 0)
+        if retry_after > self.max_wait or not self._make_room(priority):
+            return retry_after
+
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + self.max_wait
+        waiter = _Waiter(priority, next(self._counter), loop.create_future())
+        self.size += 1
+        heapq.heappush(self._waiters, (priority, -waiter.order, waiter))
+        if len(self._waiters) > 2 * self.maxsize:
+            self._waiters = [item for item in self._waiters if not item[2].done]
+            heapq.heapify(self._waiters)
+
+        line = self._lines.get(key)
+        if line is None:
+            line = self._lines[key] = _Line(key)
+            self._schedule(line, retry_after)
+        heapq.heappush(line.waiters, waiter)
+        if len(line.waiters) > 2 * self.maxsize:
+            line.waiters = [item for item in line.waiters if not item.done]
+            heapq.heapify(line.waiters)
+
+        expire = loop.call_at(deadline, self._finish, waiter, False)
+        try:
+            while await waiter.future:
+                retry_after = await decide()
+                line.owner = None
+                if retry_after == 0:
+                    # the next waiter may be admitted too
+                    self._finish(waiter, True)
+                    self._wake(line)
+                    return 0
+                self._schedule(line, retry_after)
+                if loop.time() + retry_after > deadline:
+                    break
+                waiter.future = loop.create_future()
+            return retry_after
+        finally:
+            expire.cancel()
+            self._finish(waiter, False)
+            if line.owner is waiter:
+                line.owner = None
+                self._wake(line)
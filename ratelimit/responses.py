@@ -0,0 +1,72 @@
+from typing import Dict, Sequence, Tuple
+
+from .types import Receive, Scope, Send
+
+
+class BlockedResponse:
+    """
+    an ASGI app answering with a prebuilt response, the request body is never read
+    """
+
+    __slots__ = ("status", "headers", "body")
+
+    def __init__(
+        self, status: int, headers: Tuple[Tuple[bytes, bytes], ...], body: bytes
+    ) -> None:
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        # New messages and header list, other middlewares may modify them
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status,
+                "headers": list(self.headers),
+            }
+        )
+        await send({"type": "http.response.body", "body": self.body})
+
+
+class BlockedResponses:
+    """
+    build the response of blocked requests once for each retry after,
+    use it as `on_blocked` of `RateLimitMiddleware`.
+
+    * body: template of the body, formatted with `retry_after`
+    * headers: extra headers of every response
+    * maxsize: responses kept, all are dropped when it is reached
+    """
+
+    def __init__(
+        self,
+        body: str = "",
+        *,
+        status: int = 429,
+        content_type: bytes = b"text/plain; charset=utf-8",
+        headers: Sequence[Tuple[bytes, bytes]] = (),
+        maxsize: int = 1024,
+    ) -> None:
+        self.body = body
+        self.status = status
+        self.content_type = content_type
+        self.headers = tuple(headers)
+        self.maxsize = maxsize
+        self._responses: Dict[int, BlockedResponse] = {}
+
+    def __call__(self, retry_after: int) -> BlockedResponse:
+        response = self._responses.get(retry_after)
+        if response is None:
+            if len(self._responses) >= self.maxsize:
+                self._responses.clear()
+            response = self._responses[retry_after] = self.build(retry_after)
+        return response
+
+    def build(self, retry_after: int) -> BlockedResponse:
+        body = self.body.format(retry_after=retry_after).encode("utf8")
+        headers = [(b"retry-after", str(retry_after).encode("ascii"))]
+        if body:
+            headers.append((b"content-type", self.content_type))
+        headers.append((b"content-length", str(len(body)).encode("ascii")))
+        return BlockedResponse(self.status, (*headers, *self.headers), body)
@@ -1,5 +1,7 @@
 from dataclasses import dataclass
-from typing import Dict, Optional, Tuple
+from typing import Callable, Dict, Optional, Tuple
+
+from .types import Scope
 
 
 @dataclass
@@ -15,7 +17,30 @@ class Rule:
 
     block_time: Optional[int] = None
 
+    # Requests of the rule in flight at the same time, per user
+    concurrency: Optional[int] = None
+    # Seconds after which a slot that was never released is free again
+    lease: int = 60
+
     zone: Optional[str] = None
+    # How the key path is built when `zone` is None:
+    # "path" uses the request path, "pattern" uses the matched config pattern,
+    # "groups" uses the matched config pattern and its named groups.
+    path_key: str = "path"
+
+    # Units taken by each request
+    cost: int = 1
+    # Function of the scope returning the cost, called by the middleware
+    cost_function: Optional[Callable[[Scope], int]] = None
+
+    # Evaluate the rule but never block, see `RateLimitMiddleware.on_shadow_blocked`
+    shadow: bool = False
+
+    def __post_init__(self) -> None:
+        if self.path_key not in PATH_KEYS:
+            raise ValueError(f"invalid path_key: {self.path_key}")
+        if not isinstance(self.cost, int) or self.cost < 1:
+            raise ValueError(f"invalid cost: {self.cost}")
 
     def ruleset(self, path: str, user: str) -> Dict[str, Tuple[int, int]]:
         """
@@ -28,6 +53,12 @@ class Rule:
             if limit is not None
         }
 
+    def concurrency_key(self, path: str, user: str) -> str:
+        """
+        the key that counts the requests in flight
+        """
+        return f"{path}:{self.method}:{user}:concurrency"
+
 
 TTL = {
     "second": 1,
@@ -38,3 +69,5 @@ TTL = {
 }
 
 RULENAMES: Tuple[str, ...] = ("second", "minute", "hour", "day", "month")
+
+PATH_KEYS: Tuple[str, ...] = ("path", "pattern", "groups")
@@ -0,0 +1,166 @@
+"""
+Serve the decisions of a backend to `SidecarBackend` clients:
+
+    python -m ratelimit.sidecar myapp.limits:backend --unix /run/ratelimit.sock
+"""
+
+import argparse
+import asyncio
+import importlib
+import logging
+import signal
+from typing import Optional, Sequence, Set
+
+from .backends import BaseBackend
+from .backends.sidecar import (
+    ACQUIRE,
+    ERROR,
+    OK,
+    RELEASE,
+    RETRY_AFTER,
+    frame,
+    pack_retry_afters,
+    pack_str,
+    read_frame,
+    unpack_checks,
+    unpack_str,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Sidecar:
+    """
+    answer the requests of every connection concurrently, responses
+    are sent as soon as they are ready, tagged with the id of the request.
+
+    Requests still running when their connection is closed are completed,
+    the slots they acquire are released since the client can not.
+    """
+
+    def __init__(self, backend: BaseBackend) -> None:
+        self.backend = backend
+
+    async def handle(self, operation: int, payload: bytes) -> bytes:
+        checks, offset = unpack_checks(payload, 0)
+        if operation == RETRY_AFTER:
+            return pack_retry_afters(await self.backend.retry_after_many(checks))
+        if operation == ACQUIRE:
+            token = await self.backend.acquire(*checks[0])
+            return b"" if token is None else pack_str(token)
+        if operation == RELEASE:
+            await self.backend.release(*checks[0], unpack_str(payload, offset)[0])
+            return b""
+        raise ValueError(f"invalid operation: {operation}")
+
+    async def answer(
+        self,
+        writer: asyncio.StreamWriter,
+        request_id: int,
+        operation: int,
+        payload: bytes,
+    ) -> None:
+        try:
+            result = await self.handle(operation, payload)
+        except Exception as exc:
+            logger.exception("Failed to answer a rate limit request")
+            response = frame(request_id, ERROR, pack_str(repr(exc)))
+        else:
+            if writer.is_closing():
+                if operation == ACQUIRE and result:
+                    await self.release(payload + result)
+                return
+            response = frame(request_id, OK, result)
+        if not writer.is_closing():
+            writer.write(response)
+
+    async def release(self, payload: bytes) -> None:
+        """
+        release a slot acquired for a closed connection
+        """
+        try:
+            await self.handle(RELEASE, payload)
+        except Exception:
+            logger.exception("Failed to release a rate limit slot")
+
+    async def __call__(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        tasks: Set["asyncio.Future[None]"] = set()
+        try:
+            while True:
+                request_id, operation, payload = await read_frame(reader)
+                future = asyncio.ensure_future(
+                    self.answer(writer, request_id, operation, payload)
+                )
+                tasks.add(future)
+                future.add_done_callback(tasks.discard)
+                # Stop reading while the client does not read the responses
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            # Cancelling an acquire could leak its slot, let them finish
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def serve(
+    backend: BaseBackend,
+    *,
+    path: Optional[str] = None,
+    host: str = "127.0.0.1",
+    port: Optional[int] = None,
+) -> asyncio.AbstractServer:
+    """
+    start serving `backend` on the unix socket `path` or on `host`:`port`,
+    the caller is in charge of the startup and shutdown of the backend
+    """
+    if path is not None:
+        return await asyncio.start_unix_server(Sidecar(backend), path)
+    return await asyncio.start_server(Sidecar(backend), host, port)
+
+
+def load_backend(name: str) -> BaseBackend:
+    """
+    "module:attribute" of a backend or of a function returning one
+    """
+    module_name, _, attribute = name.partition(":")
+    backend = getattr(importlib.import_module(module_name), attribute)
+    if not isinstance(backend, BaseBackend):
+        backend = backend()
+    return backend
+
+
+async def run(args: argparse.Namespace, stop: Optional[asyncio.Event] = None) -> None:
+    """
+    serve until `stop` is set, or until SIGINT or SIGTERM if it is not given
+    """
+    backend = load_backend(args.backend)
+    await backend.startup()
+    server = await serve(backend, path=args.unix, host=args.host, port=args.port)
+    if stop is None:
+        stop = asyncio.Event()
+        loop = asyncio.get_event_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        server.close()
+        await server.wait_closed()
+        await backend.shutdown()
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("backend", help='"module:attribute" of the backend')
+    parser.add_argument("--unix", help="path of the unix socket")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    asyncio.run(run(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":  # pragma: no cover
+    logging.basicConfig(level=logging.INFO)
+    main()
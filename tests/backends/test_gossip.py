@@ -0,0 +1,210 @@
+import asyncio
+import json
+import sys
+
+import pytest
+
+from ratelimit import Rule
+from ratelimit.backends.gossip import MAX_DATAGRAM, GossipBackend, _batches
+
+NODE = """
+import asyncio
+from ratelimit import Rule
+from ratelimit.backends.gossip import GossipBackend
+
+async def main():
+    backend = GossipBackend(
+        "process", ("127.0.0.1", 0), [("127.0.0.1", {port})], secret=b"secret"
+    )
+    await backend.startup()
+    for _ in range(3):
+        await backend.retry_after("/gossip", "user", Rule(day=3))
+    await backend.shutdown()
+
+asyncio.run(main())
+"""
+
+
+async def start_nodes(count, **kwargs):
+    nodes = [
+        GossipBackend(f"node{index}", ("127.0.0.1", 0), [], **kwargs)
+        for index in range(count)
+    ]
+    for node in nodes:
+        await node.startup()
+        # started again by another middleware sharing the node
+        await node.startup()
+    addresses = [node._transport.get_extra_info("sockname") for node in nodes]
+    for node, address in zip(nodes, addresses):
+        node.peers = [peer for peer in addresses if peer != address]
+    return nodes
+
+
+@pytest.mark.asyncio
+async def test_gossip():
+    first, second, third = await start_nodes(3, interval=0.05, secret=b"secret")
+    rule = Rule(day=3)
+    assert await first.retry_after("/gossip", "user", rule) == 0
+    assert await second.retry_after("/gossip", "user", rule) == 0
+    await asyncio.sleep(0.2)
+    assert third.counters["/gossip:*:user:day"].value == 2
+    assert await third.retry_after("/gossip", "user", rule) == 0
+    assert await third.retry_after("/gossip", "user", rule) > 0
+    await asyncio.sleep(0.2)
+    assert await first.retry_after("/gossip", "user", rule) > 0
+
+    # blocked users are shared too
+    assert await first.retry_after("/block", "user", Rule(day=0, block_time=5)) == 5
+    await asyncio.sleep(0.2)
+    assert await second.retry_after("/gossip", "other", rule) == 0
+    assert await second.retry_after("/gossip", "user", Rule(day=10)) == 5
+
+    for node in (first, second, third):
+        await node.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_gossip_sync():
+    first, second = await start_nodes(2, interval=0.05, sync_every=3)
+    peers, first.peers = first.peers, []
+    await first.retry_after("/sync", "user", Rule(second=10, day=10))
+    await asyncio.sleep(0.1)
+    assert "/sync:*:user:day" not in second.counters
+    # the lost counts are sent again with all the others
+    first.peers = peers
+    await asyncio.sleep(0.2)
+    assert second.counters["/sync:*:user:day"].value == 1
+
+    first.blocked_users["user"] = 0
+    first.expire(10**10)
+    assert first.counters == {} and first.blocked_users == {}
+
+    # a late count of a past window is ignored
+    second.receive(
+        {"node": "late", "counts": [["/sync:*:user:day", 0, 5]], "blocked": []}
+    )
+    assert second.counters["/sync:*:user:day"].value == 1
+
+    await first.shutdown()
+    await second.shutdown()
+    await second.shutdown()
+    first.send(["/sync:*:user:day"], [])
+
+
+@pytest.mark.asyncio
+async def test_gossip_send_error(monkeypatch, caplog):
+    (node,) = await start_nodes(1, interval=0.01)
+
+    def send(keys, users):
+        raise OSError("network is unreachable")
+
+    monkeypatch.setattr(node, "send", send)
+    await asyncio.sleep(0.05)
+    # the gossip goes on after a failed batch
+    assert caplog.text.count("Failed to send rate limit gossip") > 1
+    monkeypatch.undo()
+    await node.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_gossip_retry_after_many():
+    (node,) = await start_nodes(1)
+    checks = [
+        ("/many", "user", Rule(day=1)),
+        ("tenant", "user", Rule(day=2, shadow=True)),
+        ("tenant", "user", Rule(day=3, block_time=5)),
+    ]
+    assert await node.retry_after_many(checks) == [0, 0, 0]
+    retry_afters = await node.retry_after_many(checks)
+    assert retry_afters[0] > 0 and retry_afters[1:] == [0, 0]
+    # the rejected request took nothing from the tenant counter
+    assert node.counters["tenant:*:user:day"].value == 2
+    # the shadow check rejects, the other one still takes its cost
+    retry_afters = await node.retry_after_many(checks[1:])
+    assert retry_afters[0] > 0 and retry_afters[1] == 0
+    assert node.counters["tenant:*:user:day"].value == 3
+    assert await node.retry_after_many(checks[2:]) == [5]
+    assert await node.retry_after("tenant", "other", Rule(day=1)) == 0
+    await node.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_gossip_concurrency():
+    first, second = await start_nodes(2)
+    rule = Rule(concurrency=1)
+    token = await first.acquire("/", "user", rule)
+    assert token is not None
+    assert await first.acquire("/", "user", rule) is None
+    # each node counts its own requests in flight
+    assert await second.acquire("/", "user", rule) is not None
+    await first.release("/", "user", rule, token)
+    assert first.concurrency == {}
+
+    rule = Rule(concurrency=2)
+    tokens = [await first.acquire("/", "user", rule) for _ in range(2)]
+    await first.release("/", "user", rule, tokens[0])
+    assert first.concurrency == {"/:*:user:concurrency": 1}
+    for node in (first, second):
+        await node.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_gossip_processes():
+    (node,) = await start_nodes(1, secret=b"secret")
+    _, port = node._transport.get_extra_info("sockname")
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-c", NODE.format(port=port)
+    )
+    assert await process.wait() == 0
+    await asyncio.sleep(0.1)
+    assert node.counters["/gossip:*:user:day"].counts == {"process": 3}
+    assert await node.retry_after("/gossip", "user", Rule(day=3)) > 0
+    await node.shutdown()
+
+
+def test_gossip_untrusted(caplog):
+    node = GossipBackend("node", ("127.0.0.1", 0), [], secret=b"secret")
+    address = ("127.0.0.1", 1)
+    message = json.dumps(
+        {"node": "evil", "counts": [["/:*:user:day", 0, 100]], "blocked": []}
+    ).encode("utf8")
+    node.receive_datagram(message, address)
+    node.receive_datagram(
+        GossipBackend("evil", address, [], secret=b"guess").sign(message) + message,
+        address,
+    )
+    assert node.counters == {}
+    assert caplog.text.count("Unauthenticated rate limit gossip") == 2
+
+    invalid = [
+        b"invalid",
+        b"[]",
+        b'{"node": 1, "counts": [], "blocked": []}',
+        b'{"node": "evil", "counts": [["/:*:user", 0, 1]], "blocked": []}',
+        b'{"node": "evil", "counts": [["/:*:user:day", 0]], "blocked": []}',
+        b'{"node": "evil", "counts": [], "blocked": [["user", "never"]]}',
+        b'{"node": "evil", "counts": []}',
+    ]
+    for message in invalid:
+        node.receive_datagram(node.sign(message) + message, address)
+    assert node.counters == {} and node.blocked_users == {}
+    assert caplog.text.count("Invalid rate limit gossip") == len(invalid)
+    assert "Traceback" not in caplog.text
+
+    message = b'{"node": "peer", "counts": [["/:*:user:day", 0, 1]], "blocked": []}'
+    node.receive_datagram(node.sign(message) + message, address)
+    assert node.counters["/:*:user:day"].counts == {"peer": 1}
+
+
+def test_batches():
+    counts = [[f"/{'x' * 100}:{index}", 1, index] for index in range(2000)]
+    blocked = [[f"user{index}", 1.5] for index in range(10)]
+    messages = _batches("node", counts, blocked)
+    assert len(messages) > 1
+    # room for the signature
+    assert all(len(message) + 32 <= MAX_DATAGRAM for message in messages)
+    decoded = [json.loads(message) for message in messages]
+    assert sum((message["counts"] for message in decoded), []) == counts
+    assert sum((message["blocked"] for message in decoded), []) == blocked
+    assert _batches("node", [], []) == []
+    assert len(_batches("node", [["/", 1, 1]], [["user", 1.5]] * 6000)) == 2
@@ -1,17 +1,25 @@
 import asyncio
 import datetime
 import logging
+import time
+from functools import partial
 
 import httpx
 import pytest
 from redis.asyncio import StrictRedis
+from redis.asyncio.retry import Retry
+from redis.backoff import NoBackoff
+from redis.exceptions import ConnectionError as RedisConnectionError, ResponseError
 
 from ratelimit import RateLimitMiddleware, Rule
-from ratelimit.backends.redis import RedisBackend
+from ratelimit.backends.redis import BlockCache, RedisBackend
 from ratelimit.backends.slidingredis import SlidingRedisBackend
+from ratelimit.rule import TTL
 
 from .backend_utils import auth_func, base_test_cases, hello_world
 
+HashRedisBackend = partial(RedisBackend, layout="hash")
+
 
 class TimeFilter(logging.Filter):
     def filter(self, record):
@@ -43,7 +51,9 @@ for handler in logger.handlers:
 
 
 @pytest.mark.asyncio
-@pytest.mark.parametrize("redis_backend", [SlidingRedisBackend, RedisBackend])
+@pytest.mark.parametrize(
+    "redis_backend", [SlidingRedisBackend, RedisBackend, HashRedisBackend]
+)
 async def test_redis(redis_backend):
     await StrictRedis().flushdb()
     rate_limit = RateLimitMiddleware(
@@ -63,7 +73,9 @@ async def test_redis(redis_backend):
 
 
 @pytest.mark.asyncio
-@pytest.mark.parametrize("redis_backend", [RedisBackend])
+@pytest.mark.parametrize(
+    "redis_backend", [SlidingRedisBackend, RedisBackend, HashRedisBackend]
+)
 async def test_multiple(redis_backend):
     await StrictRedis().flushdb()
     rate_limit = RateLimitMiddleware(
@@ -107,43 +119,498 @@ async def test_multiple(redis_backend):
 
 
 @pytest.mark.asyncio
-@pytest.mark.parametrize("redis_backend", [SlidingRedisBackend])
-async def test_multiple_with_punitive(redis_backend):
+@pytest.mark.parametrize(
+    "redis_backend", [SlidingRedisBackend, RedisBackend, HashRedisBackend]
+)
+async def test_retry_after_many(redis_backend):
     await StrictRedis().flushdb()
-    rate_limit = RateLimitMiddleware(
-        hello_world,
-        auth_func,
-        redis_backend(StrictRedis()),
-        {r"/multiple": [Rule(second=1, minute=3)]},
+    backend = redis_backend(StrictRedis())
+    # nothing to read or take, no round trip
+    assert await backend.retry_after_many([]) == []
+
+    checks = [
+        ("/many", "user", Rule(second=1)),
+        ("/many", "tenant", Rule(minute=5, block_time=5)),
+    ]
+    assert await backend.retry_after_many(checks) == [0, 0]
+    assert await backend.retry_after_many(checks) == [1, 0]
+    await asyncio.sleep(1)
+    assert await backend.retry_after_many(checks) == [0, 0]
+
+    checks = [
+        ("/many", "user", Rule(second=1)),
+        ("/many", "tenant", Rule(second=1, block_time=5)),
+    ]
+    await asyncio.sleep(1)
+    await backend.retry_after_many(checks[1:])
+    assert await backend.retry_after_many(checks) == [0, 5]
+    assert await backend.retry_after_many(checks) == [0, 5]
+
+    # checks sharing a key take the sum of their costs from it
+    checks = [
+        ("/shared", "user", Rule(minute=3)),
+        ("/shared", "user", Rule(minute=3)),
+    ]
+    assert await backend.retry_after_many(checks) == [0, 0]
+    retry_afters = await backend.retry_after_many(checks)
+    assert retry_afters[0] > 0 and retry_afters[1] > 0
+    assert await backend.retry_after("/shared", "user", Rule(minute=3)) == 0
+    assert await backend.retry_after("/shared", "user", Rule(minute=3)) > 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "redis_backend", [SlidingRedisBackend, RedisBackend, HashRedisBackend]
+)
+async def test_cost(redis_backend):
+    await StrictRedis().flushdb()
+    backend = redis_backend(StrictRedis())
+    assert await backend.retry_after("/cost", "user", Rule(minute=5, cost=3)) == 0
+    assert await backend.retry_after("/cost", "user", Rule(minute=5, cost=3)) > 0
+    assert await backend.retry_after("/cost", "user", Rule(minute=5, cost=2)) == 0
+    assert await backend.retry_after("/cost", "user", Rule(minute=5)) > 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "redis_backend", [SlidingRedisBackend, RedisBackend, HashRedisBackend]
+)
+async def test_shadow(redis_backend):
+    await StrictRedis().flushdb()
+    backend = redis_backend(StrictRedis())
+    checks = [
+        ("/shadow", "user", Rule(second=1, block_time=5, shadow=True)),
+        ("/enforce", "user", Rule(minute=2)),
+    ]
+    assert await backend.retry_after_many(checks) == [0, 0]
+    # the shadow rule rejects but the enforced rule still takes its cost
+    assert await backend.retry_after_many(checks) == [1, 0]
+    assert await backend.retry_after_many(checks) == [1, 60]
+    assert await backend.is_blocking("user") <= 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "redis_backend", [SlidingRedisBackend, RedisBackend, HashRedisBackend]
+)
+async def test_script_reload(redis_backend, monkeypatch):
+    redis = StrictRedis()
+    await redis.flushdb()
+    backend = redis_backend(redis, warm_connections=3)
+    await backend.startup()
+
+    loads = []
+    script_load = redis.script_load
+
+    async def counting_script_load(script):
+        loads.append(script)
+        return await script_load(script)
+
+    monkeypatch.setattr(redis, "script_load", counting_script_load)
+    await redis.script_flush()
+    retry_afters = await asyncio.gather(
+        *(backend.retry_after("/reload", f"user{i}", Rule(second=1)) for i in range(10))
     )
-    async with httpx.AsyncClient(
-        app=rate_limit, base_url="http://testserver"
-    ) as client:  # type: httpx.AsyncClient
-        # multiple 1/s and 3/min
-        # 1 3
-        response = await client.get(
-            "/multiple", headers={"user": "user", "group": "default"}
-        )
-        assert response.status_code == 200
-        # 1-1 3-1 = 0 2
-        response = await client.get(
-            "/multiple", headers={"user": "user", "group": "default"}
-        )
-        assert response.status_code == 429
-        await asyncio.sleep(1)
-        # 0+1 2-1 = 1 1
-        response = await client.get(
-            "/multiple", headers={"user": "user", "group": "default"}
-        )
-        assert response.status_code == 200
-        # 1-1 1-1 = 0 0
-        response = await client.get(
-            "/multiple", headers={"user": "user", "group": "default"}
-        )
-        assert response.status_code == 429
-        await asyncio.sleep(2)
-        # 0+1 0+0 = 1 0
-        response = await client.get(
-            "/multiple", headers={"user": "user", "group": "default"}
-        )
-        assert response.status_code == 429
+    assert retry_afters == [0] * 10
+    assert len(loads) == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("redis_backend", [SlidingRedisBackend, RedisBackend])
+async def test_concurrency(redis_backend):
+    await StrictRedis().flushdb()
+    backend = redis_backend(StrictRedis())
+    rule = Rule(concurrency=2, lease=1)
+    first = await backend.acquire("/", "user", rule)
+    second = await backend.acquire("/", "user", rule)
+    assert first and second
+    assert await backend.acquire("/", "user", rule) is None
+    await backend.release("/", "user", rule, first)
+    assert await backend.acquire("/", "user", rule)
+    assert await backend.acquire("/", "user", rule) is None
+    # slots of crashed workers are free after the lease
+    await asyncio.sleep(1.1)
+    assert await backend.acquire("/", "user", rule)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("redis_backend", [SlidingRedisBackend, RedisBackend])
+async def test_cache_blocks(redis_backend):
+    redis = StrictRedis()
+    await redis.flushdb()
+    backend = redis_backend(redis, cache_blocks=True)
+    other = redis_backend(redis, cache_blocks=True)
+    await backend.startup()
+    await other.startup()
+    if not (backend.block_cache.active and other.block_cache.active):
+        await backend.shutdown()
+        await other.shutdown()
+        pytest.skip("redis client tracking needs redis >= 6")
+
+    assert await backend.is_blocking("cached-user") <= 0
+    assert "cached-user" in backend.block_cache.users
+    # the block set by another node invalidates the cached block time
+    await other.set_block_time("cached-user", 60)
+    for _ in range(50):
+        if "cached-user" not in backend.block_cache.users:
+            break
+        await asyncio.sleep(0.01)
+    assert await backend.is_blocking("cached-user") == 60
+    assert await backend.is_blocking("cached-user") == 60
+    await backend.shutdown()
+    await other.shutdown()
+    assert not backend.block_cache.active
+    await redis.connection_pool.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_cache_blocks_fallback(caplog, monkeypatch):
+    redis = StrictRedis()
+    await redis.flushdb()
+    backend = RedisBackend(redis, cache_blocks=True)
+
+    async def start():
+        raise ResponseError("unknown command")
+
+    monkeypatch.setattr(backend.block_cache, "start", start)
+    await backend.startup()
+    assert "Redis client tracking is unavailable" in caplog.text
+
+    # without client tracking block times are read from redis
+    await backend.set_block_time("cached-user", 60)
+    assert backend.block_cache.users == {}
+    assert await backend.is_blocking("cached-user") == 60
+
+    # a node caches its own blocks at once
+    backend.block_cache.active = True
+    assert await backend.is_blocking("own-user") <= 0
+    # cached block times are not read again
+    assert await backend.retry_after("/", "own-user", Rule()) == 0
+    await backend.set_block_time("own-user", 60)
+    await redis.delete("blocking:own-user")
+    assert await backend.is_blocking("own-user") == 60
+    assert await backend.retry_after("/", "own-user", Rule(second=1)) == 60
+
+    # the block times read by the limit script are cached
+    await redis.set("blocking:new-user", 1, 60)
+    assert await backend.retry_after("/", "new-user", Rule(second=1)) == 60
+    assert backend.block_cache.get("new-user") == 60
+    assert await backend.retry_after("/", "free-user", Rule(second=1)) == 0
+    assert backend.block_cache.get("free-user") == 0
+    await backend.shutdown()
+    await redis.connection_pool.disconnect()
+
+
+class TrackingRedis(StrictRedis):
+    """
+    accepts CLIENT TRACKING, which the test server does not support
+    """
+
+    def client(self):
+        client = super().client()
+        execute_command = client.execute_command
+
+        async def tracking(*args, **options):
+            if args[:2] == ("CLIENT", "TRACKING"):
+                args = ("PING",)
+            return await execute_command(*args, **options)
+
+        client.execute_command = tracking
+        return client
+
+
+@pytest.mark.asyncio
+async def test_startup(caplog):
+    # the application starts while redis is down
+    down = StrictRedis(port=1, retry=Retry(NoBackoff(), 0))
+    backend = RedisBackend(down, cache_blocks=True)
+    await backend.startup()
+    assert "Failed to prepare the redis connections" in caplog.text
+    assert "Redis client tracking is unavailable" in caplog.text
+    await backend.shutdown()
+
+    redis = StrictRedis()
+    backend = RedisBackend(redis, replicas=StrictRedis())
+    await backend.startup()
+    task = backend.replicas._task
+    await backend.startup()
+    assert backend.replicas._task is task
+    await backend.shutdown()
+    await backend.shutdown()
+    await redis.connection_pool.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_block_cache_reconnect(caplog, monkeypatch):
+    cache = BlockCache(TrackingRedis())
+    await cache.start()
+    assert cache.active
+    cache.set("user", 10, cache.generation)
+
+    # a reset pubsub connection no longer receives the invalidations
+    pubsub = cache._pubsub
+    await pubsub.connection.disconnect()
+    await wait_until(lambda: not cache.active)
+    assert cache.users == {}
+    assert "Lost the redis connection tracking block keys" in caplog.text
+    await wait_until(lambda: cache.active, timeout=3)
+    assert cache._pubsub is not pubsub
+
+    async def connect():
+        raise RedisConnectionError("redis is down")
+
+    monkeypatch.setattr(cache, "connect", connect)
+    await cache._pubsub.connection.disconnect()
+    await wait_until(
+        lambda: "Failed to enable the redis client tracking" in caplog.text, timeout=3
+    )
+    assert not cache.active and cache._pubsub is None
+    await cache.stop()
+
+
+@pytest.mark.asyncio
+async def test_block_cache_run(monkeypatch):
+    cache = BlockCache(StrictRedis())
+    cache.active = True
+    cache.set("user", 10, cache.generation)
+    cache.set("other", 10, cache.generation)
+    seen = []
+
+    class PubSub:
+        async def listen(self):
+            yield {"type": "subscribe", "data": 1}
+            yield {"type": "message", "data": [b"blocking:user"]}
+            seen.append(set(cache.users))
+            # the pubsub stops listening once unsubscribed
+            yield {"type": "unsubscribe", "data": 0}
+
+        async def aclose(self):
+            pass
+
+        close = aclose
+
+    reconnected = asyncio.Event()
+
+    async def connect():
+        reconnected.set()
+
+    monkeypatch.setattr(cache, "connect", connect)
+    cache._pubsub = PubSub()
+    # a tracking client that has not opened its connection yet
+    cache._tracking = StrictRedis().client()
+    cache._task = asyncio.ensure_future(cache.run())
+    await asyncio.wait_for(reconnected.wait(), 3)
+    assert seen == [{"other"}]
+    assert cache.users == {} and cache._tracking is None
+    await cache.stop()
+
+
+@pytest.mark.asyncio
+async def test_block_cache_connect():
+    redis = StrictRedis()
+    pubsubs = []
+
+    def pubsub():
+        pubsub = StrictRedis.pubsub(redis)
+        execute_command = pubsub.execute_command
+
+        async def client_id(*args):
+            # the connection is open when redis < 5 refuses CLIENT ID
+            await execute_command("PING")
+            raise ResponseError("unknown subcommand 'ID'")
+
+        pubsub.execute_command = client_id
+        pubsubs.append(pubsub)
+        return pubsub
+
+    redis.pubsub = pubsub
+    cache = BlockCache(redis)
+    with pytest.raises(ResponseError):
+        await cache.start()
+    assert cache._pubsub is None and pubsubs[0].connection is None
+    await redis.connection_pool.disconnect()
+
+
+@pytest.mark.asyncio
+async def test_block_cache():
+    cache = BlockCache(StrictRedis(), maxsize=2)
+    cache.set("user", 10, cache.generation)
+    assert cache.get("user") is None
+
+    cache.active = True
+    cache.set("user", 10, cache.generation)
+    cache.set("other", -2, cache.generation)
+    assert cache.get("user") == 10
+    assert cache.get("other") == 0
+
+    # a block time read before an invalidation is stale
+    generation = cache.generation
+    cache.invalidate([b"blocking:user"])
+    cache.set("user", 10, generation)
+    assert cache.get("user") is None
+    assert cache.get("other") == 0
+
+    cache.set("user", 10, cache.generation)
+    cache.set("third", 10, cache.generation)
+    assert list(cache.users) == ["third"]
+    cache.invalidate(["blocking:third"])
+    cache.set("third", 10, cache.generation)
+    cache.invalidate(None)
+    assert cache.users == {}
+
+
+async def wait_until(condition, timeout=1):
+    for _ in range(int(timeout * 100)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("timed out")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "redis_backend", [SlidingRedisBackend, RedisBackend, HashRedisBackend]
+)
+async def test_round_trips(redis_backend):
+    redis = StrictRedis()
+    await redis.flushdb()
+    backend = redis_backend(redis)
+    await backend.startup()
+    commands = []
+    execute_command = redis.execute_command
+
+    async def counting(*args, **options):
+        commands.append(args[0])
+        return await execute_command(*args, **options)
+
+    redis.execute_command = counting
+    checks = [
+        ("/round-trips", "user", Rule(second=10)),
+        ("tenant", "other", Rule(second=10)),
+    ]
+    # the block times are read by the limit script
+    assert await backend.retry_after_many(checks) == [0, 0]
+    assert commands == ["EVALSHA"]
+
+    await redis.set("blocking:other", 1, 60)
+    commands.clear()
+    assert await backend.retry_after_many(checks) == [0, 60]
+    assert commands == ["EVALSHA"]
+    # a blocked request takes nothing
+    await redis.delete("blocking:other")
+    for _ in range(9):
+        assert await backend.retry_after_many(checks) == [0, 0]
+    assert (await backend.retry_after_many(checks))[0] > 0
+
+    # a rule without limits still reads the block time
+    await redis.set("blocking:user", 1, 60)
+    assert await backend.retry_after("/", "user", Rule()) == 60
+    await backend.shutdown()
+    await redis.connection_pool.disconnect()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("redis_backend", [SlidingRedisBackend, RedisBackend])
+async def test_replicas(redis_backend, monkeypatch, caplog):
+    redis = StrictRedis()
+    await redis.flushdb()
+    replica = StrictRedis()
+    backend = redis_backend(
+        redis,
+        replicas=[replica, StrictRedis(db=1)],
+        max_staleness=0.1,
+    )
+    await backend.set_block_time("replica-user", 60)
+    # replicas are used once they received the heartbeat of the last check
+    await backend.startup()
+    assert backend.replicas.healthy == []
+    assert await backend.is_blocking("replica-user") == 60
+    await wait_until(lambda: backend.replicas.healthy == [replica])
+    assert await backend.is_blocking("replica-user") == 60
+    backend.replicas.start()
+    # the heartbeat a replica received is too old when a check is late
+    written = backend.replicas._written
+    backend.replicas._written -= 1
+    assert backend.replicas.pick() is None
+    backend.replicas._written = written
+    backend.replicas.discard(StrictRedis(db=1))
+    assert backend.replicas.healthy == [replica]
+
+    def broken_pipeline(transaction):
+        raise RedisConnectionError()
+
+    monkeypatch.setattr(replica, "pipeline", broken_pipeline)
+    assert await backend.is_blocking("replica-user") == 60
+    assert backend.replicas.healthy == []
+
+    # the primary is read while the heartbeat fails
+    async def broken_incr(key):
+        raise RedisConnectionError()
+
+    monkeypatch.undo()
+    await wait_until(lambda: backend.replicas.healthy == [replica])
+    monkeypatch.setattr(redis, "incr", broken_incr)
+    await wait_until(lambda: backend.replicas.healthy == [])
+    assert "Failed to check the redis replicas" in caplog.text
+
+    await backend.shutdown()
+    assert backend.replicas._task is None
+    backend.replicas.stop()
+    assert redis_backend(redis, replicas=replica).replicas.replicas == [replica]
+
+
+@pytest.mark.asyncio
+async def test_hash_layout():
+    redis = StrictRedis()
+    await redis.flushdb()
+    backend = RedisBackend(redis, layout="hash")
+    rule = Rule(second=2, minute=3, hour=3, day=3, month=3)
+    assert await backend.retry_after("/hash", "user", rule) == 0
+    assert await backend.retry_after("/hash", "user", rule) == 0
+    assert await backend.retry_after("/hash", "user", rule) == 1
+    await asyncio.sleep(1)
+    assert await backend.retry_after("/hash", "user", rule) == 0
+    assert 55 < await backend.retry_after("/hash", "user", rule) <= 60
+    # all the periods are fields of one hash
+    assert await redis.keys() == [b"/hash:*:user"]
+    assert await redis.hget("/hash:*:user", "second") == b"1"
+    assert await redis.hget("/hash:*:user", "month") == b"3"
+    assert 0 < await redis.ttl("/hash:*:user") <= TTL["month"]
+
+    with pytest.raises(ValueError):
+        RedisBackend(redis, layout="keyspace")
+
+
+@pytest.mark.asyncio
+async def test_sliding_rejected_requests():
+    redis = StrictRedis()
+    await redis.flushdb()
+    backend = SlidingRedisBackend(redis)
+    rule = Rule(second=1, minute=2)
+    assert await backend.retry_after("/sliding", "user", rule) == 0
+    # rejected requests are not recorded in any window
+    for _ in range(3):
+        assert await backend.retry_after("/sliding", "user", rule) == 1
+    assert await redis.zcard("/sliding:*:user:minute") == 1
+    assert await redis.get("/sliding:*:user:minute:used") == b"1"
+    await asyncio.sleep(1)
+    assert await backend.retry_after("/sliding", "user", rule) == 0
+    await asyncio.sleep(1)
+    assert 55 < await backend.retry_after("/sliding", "user", rule) <= 60
+
+
+@pytest.mark.asyncio
+async def test_sliding_cost_retry_after():
+    redis = StrictRedis()
+    await redis.flushdb()
+    backend = SlidingRedisBackend(redis)
+    now = time.time()
+    key = "/sliding-cost:*:user:minute"
+    await redis.zadd(key, {f"{now - 50}:1:1": now - 50, f"{now - 10}:2:1": now - 10})
+    await redis.set(f"{key}:used", 2)
+    # both members must leave the window to free a cost of 2
+    retry_after = await backend.retry_after(
+        "/sliding-cost", "user", Rule(minute=2, cost=2)
+    )
+    assert 45 < retry_after <= 50
+    assert 5 < await backend.retry_after("/sliding-cost", "user", Rule(minute=2)) <= 10
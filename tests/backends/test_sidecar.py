@@ -0,0 +1,273 @@
+import asyncio
+import logging
+import os
+import signal
+import struct
+
+import pytest
+
+from ratelimit import Rule, sidecar
+from ratelimit.backends import BaseBackend
+from ratelimit.backends.sidecar import (
+    ACQUIRE,
+    SidecarBackend,
+    SidecarError,
+    frame,
+    pack_checks,
+    read_frame,
+    unpack_checks,
+)
+from ratelimit.backends.simple import MemoryBackend
+from ratelimit.sidecar import Sidecar, load_backend, main, run, serve
+
+
+class FailingBackend(BaseBackend):
+    async def retry_after(self, path, user, rule):
+        raise RuntimeError("backend is down")
+
+    async def acquire(self, path, user, rule):
+        raise RuntimeError("no slot table")
+
+
+class GatedBackend(MemoryBackend):
+    """
+    answers once `gate` is set
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.gate = asyncio.Event()
+
+    async def retry_after_many(self, checks):
+        await self.gate.wait()
+        return await super().retry_after_many(checks)
+
+    async def acquire(self, path, user, rule):
+        await self.gate.wait()
+        return await super().acquire(path, user, rule)
+
+
+def test_checks():
+    rule = Rule(
+        method="GET",
+        minute=10,
+        month=1000,
+        block_time=5,
+        concurrency=2,
+        lease=30,
+        cost=3,
+        shadow=True,
+    )
+    checks = [("/é", "user", rule), ("/", "other", Rule())]
+    data = pack_checks(checks)
+    assert unpack_checks(data, 0) == (checks, len(data))
+
+
+@pytest.mark.asyncio
+async def test_sidecar(tmp_path):
+    path = str(tmp_path / "ratelimit.sock")
+    server = await serve(MemoryBackend(), path=path)
+    client = SidecarBackend(path)
+    rule = Rule(second=5, block_time=5)
+
+    # concurrent requests are multiplexed on one connection
+    results = await asyncio.gather(
+        *(client.retry_after("/sidecar", "user", rule) for _ in range(6))
+    )
+    assert results.count(0) == 5 and results.count(5) == 1
+    assert len(client._waiters) == 0
+    assert await client.retry_after_many(
+        [("/sidecar", "other", rule), ("/sidecar", "user", rule)]
+    ) == [0, 5]
+
+    # the response of a cancelled request is dropped
+    task = asyncio.ensure_future(client.retry_after("/sidecar", "late", rule))
+    await asyncio.sleep(0)
+    task.cancel()
+    assert await client.retry_after("/sidecar", "user", rule) == 5
+
+    rule = Rule(concurrency=1)
+    token = await client.acquire("/sidecar", "user", rule)
+    assert token is not None
+    assert await client.acquire("/sidecar", "user", rule) is None
+    await client.release("/sidecar", "user", rule, token)
+    assert await client.acquire("/sidecar", "user", rule) is not None
+
+    await client.shutdown()
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_sidecar_errors():
+    server = await serve(FailingBackend(), port=0)
+    port = server.sockets[0].getsockname()[1]
+    client = SidecarBackend(port=port)
+    with pytest.raises(SidecarError, match="backend is down"):
+        await client.retry_after("/sidecar", "user", Rule(second=1))
+    with pytest.raises(SidecarError, match="no slot table"):
+        await client.acquire("/sidecar", "user", Rule(concurrency=1))
+
+    # unknown operations are answered with an error too
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(frame(7, 9, pack_checks([])))
+    request_id, status, _ = await read_frame(reader)
+    assert (request_id, status) == (7, 1)
+    writer.close()
+
+    # pending requests fail when the connection is lost, the next ones reconnect
+    writer = await client.connect()
+    waiter = asyncio.get_event_loop().create_future()
+    client._waiters[12345] = waiter
+    server.close()
+    await server.wait_closed()
+    writer.close()
+    with pytest.raises(ConnectionError):
+        await waiter
+    with pytest.raises(OSError):
+        await client.retry_after("/sidecar", "user", Rule(second=1))
+    await client.shutdown()
+
+    with pytest.raises(ValueError):
+        SidecarBackend()
+
+
+@pytest.mark.asyncio
+async def test_sidecar_disconnect(tmp_path):
+    path = str(tmp_path / "ratelimit.sock")
+    backend = GatedBackend()
+    server = await serve(backend, path=path)
+    client = SidecarBackend(path)
+    rule = Rule(concurrency=1)
+    tasks = [
+        asyncio.ensure_future(client.retry_after("/sidecar", "user", Rule())),
+        asyncio.ensure_future(client.acquire("/sidecar", "user", rule)),
+    ]
+    await asyncio.sleep(0.1)
+    # a cancelled request whose task did not resume yet
+    cancelled = asyncio.get_event_loop().create_future()
+    cancelled.cancel()
+    client._waiters[12345] = cancelled
+    await client.shutdown()
+    for task in tasks:
+        with pytest.raises(ConnectionError):
+            await task
+    assert client._waiters == {}
+    # a client that never connected has nothing to shut down
+    await SidecarBackend(path).shutdown()
+    # the requests of a closed connection complete, the slot is released
+    backend.gate.set()
+    for _ in range(100):
+        if not backend.concurrency:
+            break
+        await asyncio.sleep(0.01)
+    assert backend.concurrency == {}
+    server.close()
+    await server.wait_closed()
+
+    async def invalid(reader, writer):
+        request_id, _, _ = await read_frame(reader)
+        writer.write(frame(request_id, 1, b""))
+        writer.close()
+
+    server = await asyncio.start_unix_server(invalid, path)
+    # a response that can not be read fails the pending requests
+    with pytest.raises(struct.error):
+        await client.retry_after("/sidecar", "user", Rule())
+    await client.shutdown()
+    server.close()
+    await server.wait_closed()
+
+
+class ClosedWriter:
+    def __init__(self):
+        self.written = []
+
+    def is_closing(self):
+        return True
+
+    def write(self, data):
+        self.written.append(data)
+
+
+class LeakingBackend(MemoryBackend):
+    async def release(self, path, user, rule, token):
+        raise RuntimeError("slot table is gone")
+
+
+@pytest.mark.asyncio
+async def test_sidecar_closed(caplog):
+    writer = ClosedWriter()
+    payload = pack_checks([("/sidecar", "user", Rule(concurrency=1))])
+    await Sidecar(FailingBackend()).answer(writer, 1, ACQUIRE, payload)
+    # a slot that can not be released is logged
+    await Sidecar(LeakingBackend()).answer(writer, 2, ACQUIRE, payload)
+    assert writer.written == []
+    assert "Failed to release a rate limit slot" in caplog.text
+
+
+def arguments(path):
+    return type(
+        "Args",
+        (),
+        {
+            "backend": "ratelimit.backends.simple:MemoryBackend",
+            "unix": path,
+            "host": "127.0.0.1",
+            "port": None,
+        },
+    )
+
+
+@pytest.mark.asyncio
+async def test_run(tmp_path):
+    path = str(tmp_path / "ratelimit.sock")
+    stop = asyncio.Event()
+    task = asyncio.ensure_future(run(arguments(path), stop))
+    while not os.path.exists(path):
+        await asyncio.sleep(0.01)
+    client = SidecarBackend(path)
+    assert await client.retry_after("/sidecar", "user", Rule(second=1)) == 0
+    stop.set()
+    await task
+    await client.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_run_signals(tmp_path, monkeypatch):
+    signals = []
+
+    def add_signal_handler(signum, callback):
+        signals.append(signum)
+        callback()
+
+    loop = asyncio.get_event_loop()
+    monkeypatch.setattr(loop, "add_signal_handler", add_signal_handler)
+    # without an event, SIGINT and SIGTERM stop the sidecar
+    await run(arguments(str(tmp_path / "ratelimit.sock")))
+    assert signals == [signal.SIGINT, signal.SIGTERM]
+
+
+def test_main(monkeypatch):
+    calls = []
+
+    async def fake_run(args, stop=None):
+        calls.append(args)
+
+    monkeypatch.setattr(sidecar, "run", fake_run)
+    handlers = list(logging.getLogger().handlers)
+    main(["tests.backends.test_sidecar:FailingBackend", "--port", "0"])
+    (args,) = calls
+    assert args.backend == "tests.backends.test_sidecar:FailingBackend"
+    assert (args.unix, args.host, args.port) == (None, "127.0.0.1", 0)
+    # logging is configured by `python -m ratelimit.sidecar` only
+    assert logging.getLogger().handlers == handlers
+
+
+def test_load_backend():
+    backend = load_backend("ratelimit.backends.simple:MemoryBackend")
+    assert isinstance(backend, MemoryBackend)
+    assert load_backend("tests.backends.test_sidecar:BACKEND") is BACKEND
+
+
+BACKEND = MemoryBackend()
@@ -5,12 +5,14 @@ import pytest
 
 from ratelimit import RateLimitMiddleware, Rule
 from ratelimit.backends.simple import MemoryBackend
+from ratelimit.backends.sketch import SketchBackend
+from ratelimit.backends.slidingmemory import SlidingMemoryBackend, Window
 
 from .backend_utils import auth_func, base_test_cases, base_test_multi, hello_world
 
 
 @pytest.mark.asyncio
-@pytest.mark.parametrize("memory_backend", [MemoryBackend])
+@pytest.mark.parametrize("memory_backend", [MemoryBackend, SlidingMemoryBackend])
 async def test_simple(memory_backend):
     rate_limit = RateLimitMiddleware(
         hello_world,
@@ -64,3 +66,235 @@ async def test_other(memory_backend):
 
         response = await client.get(path)
         assert response.status_code == 200
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("memory_backend", [MemoryBackend, SlidingMemoryBackend])
+async def test_multiple(memory_backend):
+    backend = memory_backend()
+    rule = Rule(second=1, minute=3)
+    # 1/s and 3/min, a rejected request takes nothing
+    assert await backend.retry_after("/multiple", "user", rule) == 0
+    assert await backend.retry_after("/multiple", "user", rule) > 0
+    await asyncio.sleep(1)
+    assert await backend.retry_after("/multiple", "user", rule) == 0
+    assert await backend.retry_after("/multiple", "user", rule) > 0
+    await asyncio.sleep(1)
+    assert await backend.retry_after("/multiple", "user", rule) == 0
+    await asyncio.sleep(1)
+    assert await backend.retry_after("/multiple", "user", rule) > 30
+
+
+@pytest.mark.asyncio
+async def test_sliding_window():
+    backend = SlidingMemoryBackend(buckets=4)
+    rule = Rule(second=2)
+    assert await backend.retry_after("/sliding", "user", rule) == 0
+    await asyncio.sleep(0.5)
+    assert await backend.retry_after("/sliding", "user", rule) == 0
+    assert await backend.retry_after("/sliding", "user", rule) == 1
+    # the first request leaves the window, the second does not
+    await asyncio.sleep(0.55)
+    assert await backend.retry_after("/sliding", "user", rule) == 0
+    assert await backend.retry_after("/sliding", "user", rule) == 1
+    assert await backend.retry_after("/sliding", "user", Rule(second=2, cost=3)) == 1
+
+
+@pytest.mark.asyncio
+async def test_window_expire():
+    backend = SlidingMemoryBackend()
+    await backend.retry_after("/expire", "user", Rule(second=2))
+    await asyncio.sleep(0.5)
+    await backend.retry_after("/expire", "user", Rule(second=2))
+    await asyncio.sleep(0.6)
+    assert list(backend.windows) == ["/expire:*:user:second"]
+    await asyncio.sleep(1)
+    assert backend.windows == {}
+
+
+def test_window():
+    window = Window(4, 10)
+    window.add(2)
+    window.advance(12)
+    window.add(1)
+    assert list(window.buckets) == [1, 0, 2, 0] and window.total == 3
+    assert window.free_at(1) == 14
+    assert window.free_at(3) == 16
+    window.advance(11)
+    assert window.head == 12
+    window.advance(100)
+    assert window.total == 0 and not any(window.buckets)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "memory_backend", [MemoryBackend, SlidingMemoryBackend, SketchBackend]
+)
+async def test_retry_after_many(memory_backend):
+    backend = memory_backend()
+    checks = [
+        ("/many", "user", Rule(day=1)),
+        ("tenant", "user", Rule(day=2)),
+    ]
+    assert await backend.retry_after_many(checks) == [0, 0]
+    retry_afters = await backend.retry_after_many(checks)
+    assert retry_afters[0] > 0 and retry_afters[1] == 0
+    # the rejected request took nothing from the tenant limit
+    assert await backend.retry_after("tenant", "user", Rule(day=2)) == 0
+    assert await backend.retry_after("tenant", "user", Rule(day=2)) > 0
+
+    # checks sharing a key take the sum of their costs from it
+    checks = [
+        ("/shared", "user", Rule(day=3)),
+        ("/shared", "user", Rule(day=3)),
+    ]
+    assert await backend.retry_after_many(checks) == [0, 0]
+    retry_afters = await backend.retry_after_many(checks)
+    assert retry_afters[0] == 0 and retry_afters[1] > 0
+    assert await backend.retry_after("/shared", "user", Rule(day=3)) == 0
+
+
+@pytest.mark.asyncio
+async def test_cost():
+    backend = MemoryBackend()
+    assert await backend.retry_after("/cost", "user", Rule(minute=5, cost=3)) == 0
+    assert await backend.retry_after("/cost", "user", Rule(minute=5, cost=3)) > 0
+    assert await backend.retry_after("/cost", "user", Rule(minute=5, cost=2)) == 0
+    assert await backend.retry_after("/cost", "user", Rule(minute=5)) > 0
+    # backends use `cost`, `cost_function` is called by the middleware
+    rule = Rule(minute=5, cost_function=lambda scope: 3)
+    assert await backend.retry_after("/cost", "other", rule) == 0
+
+
+@pytest.mark.asyncio
+async def test_window_end():
+    backend = MemoryBackend()
+    backend.now = lambda: 100
+    rule = Rule(second=1)
+    assert await backend.retry_after("/end", "user", rule) == 0
+    # the window ending now is over, the request takes its cost from a new one
+    backend.now = lambda: 101
+    assert await backend.retry_after("/end", "user", rule) == 0
+    assert await backend.retry_after("/end", "user", rule) == 1
+
+
+@pytest.mark.asyncio
+async def test_concurrency():
+    backend = MemoryBackend()
+    rule = Rule(concurrency=2)
+    first = await backend.acquire("/", "user", rule)
+    second = await backend.acquire("/", "user", rule)
+    assert first and second
+    assert await backend.acquire("/", "user", rule) is None
+    await backend.release("/", "user", rule, first)
+    third = await backend.acquire("/", "user", rule)
+    assert third
+    await backend.release("/", "user", rule, second)
+    await backend.release("/", "user", rule, third)
+    assert backend.concurrency == {}
+
+
+@pytest.mark.asyncio
+async def test_snapshot(tmp_path):
+    path = str(tmp_path / "snapshot")
+    backend = MemoryBackend(snapshot_path=path)
+    await backend.startup()
+    await backend.retry_after("/snapshot", "user", Rule(minute=2))
+    await backend.retry_after("/snapshot", "blocked", Rule(minute=1, block_time=60))
+    await backend.retry_after("/snapshot", "blocked", Rule(minute=1, block_time=60))
+    await backend.shutdown()
+
+    restored = MemoryBackend(snapshot_path=path)
+    await restored.startup()
+    assert 59 <= restored.is_blocking("blocked") <= 60
+    assert await restored.retry_after("/snapshot", "user", Rule(minute=2)) == 0
+    assert await restored.retry_after("/snapshot", "user", Rule(minute=2)) > 0
+
+
+@pytest.mark.asyncio
+async def test_snapshot_skip_expired(tmp_path):
+    path = str(tmp_path / "snapshot")
+    backend = MemoryBackend()
+    await backend.retry_after("/snapshot", "user", Rule(second=1, block_time=1))
+    await backend.retry_after("/snapshot", "user", Rule(second=1, block_time=1))
+    data = backend.dumps()
+    await asyncio.sleep(1.1)
+    assert backend.dumps() == MemoryBackend().dumps()
+
+    restored = MemoryBackend()
+    restored.loads(data)
+    assert restored.blocked_users == {}
+    assert restored.blocks == {}
+
+    with pytest.raises(ValueError):
+        restored.loads(b"XXXX" + data[4:])
+
+    open(path, "wb").close()
+    restored.load(path)
+    assert restored.blocked_users == {}
+
+
+@pytest.mark.asyncio
+async def test_snapshot_invalid(tmp_path, caplog):
+    path = str(tmp_path / "snapshot")
+    backend = MemoryBackend()
+    await backend.retry_after("/snapshot", "blocked", Rule(minute=1, block_time=60))
+    await backend.retry_after("/snapshot", "blocked", Rule(minute=1, block_time=60))
+    data = backend.dumps()
+
+    for invalid in (data[:-4], data[:12], data[:2], b"XXXX" + data[4:]):
+        with open(path, "wb") as file:
+            file.write(invalid)
+        restored = MemoryBackend(snapshot_path=path)
+        await restored.startup()
+        assert restored.blocked_users == {}
+        assert restored.blocks == {}
+    assert "Invalid memory backend snapshot" in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_snapshot_long_key():
+    backend = MemoryBackend()
+    path = "/" + "x" * 70000
+    await backend.retry_after(path, "user", Rule(minute=2))
+    restored = MemoryBackend()
+    restored.loads(backend.dumps())
+    assert restored.blocks[path][f"{path}:*:user:minute"].count == 1
+
+
+@pytest.mark.asyncio
+async def test_snapshot_interval(tmp_path):
+    path = tmp_path / "snapshot"
+    backend = MemoryBackend(snapshot_path=str(path), snapshot_interval=0.1)
+    await backend.startup()
+    # the middlewares sharing the backend start it again
+    task = backend._snapshot_task
+    await backend.startup()
+    assert backend._snapshot_task is task
+    await backend.retry_after("/snapshot", "user", Rule(minute=2))
+    await asyncio.sleep(0.3)
+    restored = MemoryBackend()
+    restored.load(str(path))
+    assert restored.blocks["/snapshot"]["/snapshot:*:user:minute"].count == 1
+    await backend.shutdown()
+
+    # the periodic snapshot keeps running after an error
+    backend = MemoryBackend(snapshot_path=str(path), snapshot_interval=0.1)
+    await backend.startup()
+    failures = [OSError("disk full")]
+
+    def dumps():
+        if failures:
+            raise failures.pop()
+        return MemoryBackend.dumps(backend)
+
+    backend.dumps = dumps
+    path.unlink()
+    await asyncio.sleep(0.35)
+    assert failures == [] and path.exists()
+    await backend.shutdown()
+    path.unlink()
+    await backend.shutdown()
+    assert not path.exists()
+
+    await MemoryBackend().startup()
@@ -0,0 +1,61 @@
+import asyncio
+import random
+
+import pytest
+
+from ratelimit import Rule
+from ratelimit.backends.sketch import CountMinSketch, SketchBackend
+
+
+async def window_start():
+    # windows are aligned on the clock
+    loop = asyncio.get_event_loop()
+    await asyncio.sleep(1 - loop.time() % 1 + 0.01)
+
+
+def test_count_min_sketch():
+    sketch = CountMinSketch(50, 3)
+    counts = {}
+    for _ in range(2000):
+        key = f"user{random.randrange(500)}"
+        cost = random.randrange(1, 3)
+        counts[key] = counts.get(key, 0) + cost
+        sketch.add(sketch.indexes(key), cost)
+    for key, count in counts.items():
+        assert sketch.estimate(sketch.indexes(key)) >= count
+    sketch.clear()
+    assert not any(sketch.counters)
+
+
+@pytest.mark.asyncio
+async def test_sketch_backend():
+    backend = SketchBackend(error=0.01, confidence=0.9)
+    assert (backend.width, backend.depth) == (272, 3)
+
+    await window_start()
+    rule = Rule(second=2, day=3)
+    assert await backend.retry_after("/sketch", "user", rule) == 0
+    assert await backend.retry_after("/sketch", "user", rule) == 0
+    assert await backend.retry_after("/sketch", "user", rule) == 1
+    assert await backend.retry_after("/sketch", "other", rule) == 0
+
+    await window_start()
+    assert await backend.retry_after("/sketch", "user", rule) == 0
+    # the day limit rejects, the second limit is not taken
+    assert await backend.retry_after("/sketch", "user", rule) > 1
+    assert await backend.retry_after("/sketch", "user", Rule(second=2)) == 0
+    # the sketch of the last second is cleared for the next one
+    await asyncio.sleep(0)
+    _, _, spare = backend.sketches[1]
+    assert not any(spare.counters)
+
+
+@pytest.mark.asyncio
+async def test_sketch_block_time():
+    backend = SketchBackend()
+    await window_start()
+    rule = Rule(second=1, block_time=5)
+    assert await backend.retry_after("/sketch", "user", rule) == 0
+    assert await backend.retry_after("/sketch", "user", rule) == 5
+    await window_start()
+    assert await backend.retry_after("/sketch", "user", rule) == 4
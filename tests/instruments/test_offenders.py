@@ -0,0 +1,84 @@
+import asyncio
+
+import httpx
+import pytest
+
+from ratelimit import RateLimitMiddleware, Rule
+from ratelimit.backends.simple import MemoryBackend
+from ratelimit.instruments.offenders import OffendersInstrument, SpaceSaving
+
+from ..backends.backend_utils import auth_func, hello_world
+
+
+def test_space_saving():
+    counter = SpaceSaving(3)
+    for key in ["a", "b", "a", "c", "a", "b"]:
+        counter.add(key)
+    assert counter.top(2) == [("a", 3, 0), ("b", 2, 0)]
+    assert counter.min_count == 1
+
+    # "d" replaces "c", the key with the lowest count
+    counter.add("d")
+    assert counter.top(5) == [("a", 3, 0), ("b", 2, 0), ("d", 2, 1)]
+    assert counter.min_count == 2
+
+    for _ in range(100):
+        counter.add("heavy")
+        counter.add(f"light{_}")
+    assert counter.top(1)[0][0] == "heavy"
+    assert sum(len(keys) for keys in counter.buckets.values()) == 3
+    assert counter.min_count == min(counter.buckets)
+
+
+@pytest.mark.asyncio
+async def test_offenders():
+    instrument = OffendersInstrument(max_blocked=1, max_zones=3)
+    rate_limit = RateLimitMiddleware(
+        hello_world,
+        auth_func,
+        MemoryBackend(),
+        {
+            r"/second": [Rule(second=1)],
+            r"/block": [Rule(second=1, block_time=1, zone="block")],
+            r"/pattern/\d+": [Rule(second=1, path_key="pattern")],
+            r"/shadow": [Rule(method="get", second=1, block_time=1, shadow=True)],
+            r"/full": [Rule(second=1, zone="full")],
+        },
+        instrument=instrument,
+    )
+    async with httpx.AsyncClient(
+        app=rate_limit, base_url="http://testserver"
+    ) as client:  # type: httpx.AsyncClient
+        for user, count in [("a", 4), ("b", 2), ("c", 1)]:
+            for _ in range(count):
+                await client.get("/second", headers={"user": user})
+        # the paths of a rule without zone share one zone
+        for index in range(3):
+            await client.get(f"/second/{index}", headers={"user": "c"})
+        assert await instrument.top(2) == {"default:*": [("a", 3), ("b", 1)]}
+
+        for index in range(2):
+            await client.get(f"/pattern/{index}", headers={"user": "a"})
+        assert (await instrument.top())[r"/pattern/\d+"] == [("a", 1)]
+
+        # shadow rules never block nor reject
+        for _ in range(2):
+            await client.get("/shadow", headers={"user": "a"})
+        assert await instrument.blocked() == {}
+        assert len(instrument.zones) == 2
+
+        for user in ["a", "b"]:
+            for _ in range(2):
+                await client.get("/block", headers={"user": user})
+        assert await instrument.blocked() == {"a": 1}
+        assert (await instrument.top())["block"] == [("a", 1), ("b", 1)]
+
+        # no more zones are tracked
+        for _ in range(2):
+            await client.get("/full", headers={"user": "a"})
+        assert "full" not in instrument.zones
+
+        await asyncio.sleep(1)
+        await client.get("/block", headers={"user": "b"})
+        await client.get("/block", headers={"user": "b"})
+        assert await instrument.blocked() == {"b": 1}
@@ -0,0 +1,30 @@
+import prometheus_client
+
+from ratelimit import Rule
+from ratelimit.instruments.prometheus import PrometheusInstrument
+
+
+def test_prometheus():
+    registry = prometheus_client.CollectorRegistry()
+    instrument = PrometheusInstrument(registry=registry)
+
+    instrument.on_request(0.001, 0.0001)
+    instrument.on_backend(0.002)
+    instrument.on_check("/", "user", Rule(second=1), 0)
+    instrument.on_check("/", "user", Rule(second=1), 1)
+    instrument.on_backend_error(ConnectionError())
+
+    def value(name, **labels):
+        return registry.get_sample_value(name, labels)
+
+    assert value("ratelimit_decision_seconds_count", stage="backend") == 1
+    assert value("ratelimit_backend_batches_total") == 1
+    assert (
+        value("ratelimit_decisions_total", zone="/", group="default", result="allowed")
+        == 1
+    )
+    assert (
+        value("ratelimit_decisions_total", zone="/", group="default", result="blocked")
+        == 1
+    )
+    assert value("ratelimit_backend_errors_total", error="ConnectionError") == 1
@@ -0,0 +1,153 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from ratelimit import RateLimitMiddleware, Rule
+from ratelimit.adaptive import AdaptiveController
+from ratelimit.backends.simple import MemoryBackend
+
+from .test_core import auth_func, hello_world
+
+
+def test_scale():
+    controller = AdaptiveController(groups=["default"])
+    rule = Rule(second=10, minute=3)
+    assert controller.scale(rule) is rule
+
+    controller.adjust(True)
+    assert controller.factors == {"default": 0.5}
+    assert controller.scale(rule) == Rule(second=5, minute=1)
+    assert controller.scale(Rule(group="admin", second=10)).second == 10
+
+    for _ in range(10):
+        controller.adjust(True)
+    assert controller.factors == {"default": 0.1}
+    assert controller.scale(rule) == Rule(second=1, minute=1)
+    assert controller.scale(Rule(second=0, minute=3)) == Rule(second=0, minute=1)
+
+    for _ in range(10):
+        controller.adjust(False)
+    assert controller.factors == {"default": 1.0}
+
+
+@pytest.mark.asyncio
+async def test_observe_latency():
+    controller = AdaptiveController(target_lag=None, target_latency=0.1, interval=0)
+    controller.observe_latency(5)
+    assert controller.factors["default"] == 0.5
+    controller.latency = 0
+    controller.observe_latency(0)
+    assert controller.factors["default"] == 0.6
+
+    controller.target_latency = None
+    controller.observe_latency(5)
+    assert controller.factors["default"] == 0.6
+
+    # adjusted at most once per interval
+    controller = AdaptiveController(target_lag=None, target_latency=0.1, interval=60)
+    controller.observe_latency(5)
+    controller.observe_latency(5)
+    assert controller.factors["default"] == 0.5
+
+
+@pytest.mark.asyncio
+async def test_sample_lag():
+    controller = AdaptiveController(target_lag=0.05, interval=0.05)
+    controller.start()
+    await asyncio.sleep(0.01)
+    time.sleep(0.2)
+    await asyncio.sleep(0.1)
+    assert controller.factors["default"] < 1
+    controller.stop()
+    controller.stop()
+
+
+@pytest.mark.asyncio
+async def test_lifespan():
+    async def app(scope, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+                # the lag is sampled between startup and shutdown
+                assert controller._task is not None
+            else:
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    controller = AdaptiveController(target_lag=0.1)
+    rate_limit = RateLimitMiddleware(
+        app, auth_func, MemoryBackend(), {}, controller=controller
+    )
+    messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        pass
+
+    await rate_limit({"type": "lifespan"}, receive, send)
+    assert controller._task is None
+
+
+@pytest.mark.asyncio
+async def test_middleware():
+    controller = AdaptiveController(target_lag=None, target_latency=10)
+    controller.adjust(True)
+    rate_limit = RateLimitMiddleware(
+        hello_world,
+        auth_func,
+        MemoryBackend(),
+        {r"/": [Rule(minute=2)]},
+        controller=controller,
+    )
+    async with httpx.AsyncClient(
+        app=rate_limit,
+        base_url="http://testserver",
+        headers={"user": "user", "group": "default"},
+    ) as client:  # type: httpx.AsyncClient
+        response = await client.get("/")
+        assert response.status_code == 200
+        response = await client.get("/")
+        assert response.status_code == 429
+    assert 0 < controller.latency < 10
+
+
+@pytest.mark.asyncio
+async def test_new_window():
+    controller = AdaptiveController(target_lag=None)
+    backend = MemoryBackend()
+    backend.now = lambda: 100
+    rate_limit = RateLimitMiddleware(
+        hello_world,
+        auth_func,
+        backend,
+        {r"/": [Rule(minute=4)]},
+        controller=controller,
+    )
+    async with httpx.AsyncClient(
+        app=rate_limit,
+        base_url="http://testserver",
+        headers={"user": "user", "group": "default"},
+    ) as client:  # type: httpx.AsyncClient
+        response = await client.get("/")
+        assert response.status_code == 200
+
+        # the window started with 4 units keeps them
+        controller.adjust(True)
+        for _ in range(3):
+            response = await client.get("/")
+            assert response.status_code == 200
+        response = await client.get("/")
+        assert response.status_code == 429
+
+        # the next window starts with the scaled limit
+        backend.now = lambda: 160
+        for _ in range(2):
+            response = await client.get("/")
+            assert response.status_code == 200
+        response = await client.get("/")
+        assert response.status_code == 429
@@ -0,0 +1,37 @@
+import pytest
+
+from ratelimit import Bypass
+
+
+def make_scope(path="/", method="GET", client=("1.1.1.1", 8000), headers=()):
+    return {"path": path, "method": method, "client": client, "headers": headers}
+
+
+@pytest.mark.parametrize(
+    "scope, bypassed",
+    [
+        (make_scope(), False),
+        (make_scope(client=None), False),
+        (make_scope(client=("unix-socket", 0)), False),
+        (make_scope(path="/static/app.js"), True),
+        (make_scope(path="/health"), True),
+        (make_scope(path="/healthy"), True),
+        (make_scope(method="OPTIONS"), True),
+        (make_scope(client=("10.1.2.3", 8000)), True),
+        (make_scope(client=("fd00::1", 8000)), True),
+        (make_scope(headers=((b"x-internal", b"1"),)), True),
+        (make_scope(headers=((b"x-other", b"1"),)), False),
+    ],
+)
+def test_bypass(scope, bypassed):
+    bypass = Bypass(
+        paths=["/static/", "/health"],
+        methods=["options"],
+        clients=["10.0.0.0/8", "fd00::/8"],
+        headers=["X-Internal"],
+    )
+    assert bypass(scope) is bypassed
+
+
+def test_empty_bypass():
+    assert Bypass()(make_scope(path="/static/app.js")) is False
@@ -1,12 +1,16 @@
+import asyncio
 import re
 
 import httpx
 import pytest
 from redis.asyncio import StrictRedis
 
-from ratelimit import RateLimitMiddleware, Rule
+from ratelimit import BlockedResponses, Bypass, RateLimitMiddleware, Rule
 from ratelimit.auths import EmptyInformation
+from ratelimit.backends import BaseBackend
 from ratelimit.backends.redis import RedisBackend
+from ratelimit.backends.simple import MemoryBackend
+from ratelimit.instruments import Instrument
 from ratelimit.types import Receive, Scope, Send
 
 
@@ -87,7 +91,7 @@ async def test_on_auth_error_default():
         auth_func,
         RedisBackend(StrictRedis()),
         {
-            r"/": [Rule(group="admin")],
+            r"/": [Rule(group="admin", second=1)],
         },
     )
     async with httpx.AsyncClient(
@@ -113,7 +117,7 @@ async def test_on_auth_error_with_handler():
         auth_func,
         RedisBackend(StrictRedis()),
         {
-            r"/": [Rule(group="admin")],
+            r"/": [Rule(group="admin", second=1)],
         },
         on_auth_error=handle_auth_error,
     )
@@ -164,6 +168,46 @@ async def test_custom_blocked():
         assert response.content == b"custom 429 page"
 
 
+@pytest.mark.asyncio
+async def test_blocked_responses():
+    on_blocked = BlockedResponses(
+        "retry in {retry_after}s", headers=[(b"x-ratelimit", b"1")]
+    )
+    rate_limit = RateLimitMiddleware(
+        hello_world,
+        authenticate=auth_func,
+        backend=MemoryBackend(),
+        config={r"/": [Rule(minute=1)]},
+        on_blocked=on_blocked,
+    )
+
+    async with httpx.AsyncClient(
+        app=rate_limit, base_url="http://testserver"
+    ) as client:  # type: httpx.AsyncClient
+        response = await client.get("/", headers={"user": "user", "group": "default"})
+        assert response.status_code == 200
+
+        for _ in range(2):
+            response = await client.get(
+                "/", headers={"user": "user", "group": "default"}
+            )
+            retry_after = response.headers["retry-after"]
+            assert response.status_code == 429
+            assert response.text == f"retry in {retry_after}s"
+            assert response.headers["content-length"] == str(len(response.content))
+            assert response.headers["x-ratelimit"] == "1"
+
+    responses = BlockedResponses(maxsize=2)
+    assert responses(1) is responses(1)
+    responses(2)
+    responses(3)
+    assert list(responses._responses) == [3]
+    assert responses(5).headers == (
+        (b"retry-after", b"5"),
+        (b"content-length", b"0"),
+    )
+
+
 @pytest.mark.asyncio
 async def test_rule_zone():
     rate_limit = RateLimitMiddleware(
@@ -236,3 +280,836 @@ async def test_rule_method():
             "/towns", headers={"user": "user", "group": "default"}
         )
         assert response.status_code == 429
+
+
+def test_invalid_rule_path_key():
+    with pytest.raises(ValueError):
+        Rule(second=1, path_key="url")
+
+
+def test_invalid_rule_cost():
+    with pytest.raises(ValueError):
+        Rule(second=1, cost=0)
+    with pytest.raises(ValueError):
+        Rule(second=1, cost=export_cost)
+
+
+@pytest.mark.asyncio
+async def test_rule_path_key():
+    backend = MemoryBackend()
+    rate_limit = RateLimitMiddleware(
+        hello_world,
+        auth_func,
+        backend,
+        {
+            r"^/users/\d+": [Rule(second=1, path_key="pattern")],
+            r"^/teams/(?P<team>\w+)/\d+": [Rule(second=1, path_key="groups")],
+            r"^/towns/\d+": [Rule(second=1)],
+        },
+    )
+    async with httpx.AsyncClient(
+        app=rate_limit,
+        base_url="http://testserver",
+        headers={"user": "user", "group": "default"},
+    ) as client:  # type: httpx.AsyncClient
+        response = await client.get("/users/1")
+        assert response.status_code == 200
+        response = await client.get("/users/2")
+        assert response.status_code == 429
+
+        response = await client.get("/teams/a/1")
+        assert response.status_code == 200
+        response = await client.get("/teams/a/2")
+        assert response.status_code == 429
+        response = await client.get("/teams/b/1")
+        assert response.status_code == 200
+
+        response = await client.get("/towns/1")
+        assert response.status_code == 200
+        response = await client.get("/towns/2")
+        assert response.status_code == 200
+
+    assert set(backend.blocks) == {
+        r"^/users/\d+",
+        r"^/teams/(?P<team>\w+)/\d+:team=a",
+        r"^/teams/(?P<team>\w+)/\d+:team=b",
+        "/towns/1",
+        "/towns/2",
+    }
+
+
+async def global_auth(scope):
+    return "global", "default"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "make_backend", [MemoryBackend, lambda: RedisBackend(StrictRedis())]
+)
+async def test_layers(make_backend):
+    await StrictRedis().flushdb()
+    backend = make_backend()
+    rate_limit = RateLimitMiddleware(
+        hello_world,
+        auth_func,
+        backend,
+        {r"/": [Rule(minute=1), Rule(group="admin")]},
+        layers=[(global_auth, {r"/": [Rule(minute=2, zone="global")]})],
+    )
+    async with httpx.AsyncClient(
+        app=rate_limit, base_url="http://testserver"
+    ) as client:  # type: httpx.AsyncClient
+        response = await client.get("/", headers={"user": "a", "group": "default"})
+        assert response.status_code == 200
+        response = await client.get("/", headers={"user": "a", "group": "default"})
+        assert response.status_code == 429
+
+        # the request rejected by the user limit took nothing from the global one
+        response = await client.get("/", headers={"user": "b", "group": "admin"})
+        assert response.status_code == 200
+        response = await client.get("/", headers={"user": "c", "group": "default"})
+        assert response.status_code == 429
+
+    # and the request rejected by the global limit took nothing from the user one
+    assert await backend.retry_after("/", "c", Rule(minute=1)) == 0
+    assert await backend.retry_after("/", "c", Rule(minute=1)) > 0
+
+    with pytest.raises(ValueError):
+        RateLimitMiddleware(
+            hello_world,
+            auth_func,
+            MemoryBackend(),
+            {r"/": [Rule(second=1)]},
+            layers=[("123", {r"/": [Rule(second=1)]})],
+        )
+
+
+def export_cost(scope):
+    return 3 if scope["path"] == "/export" else 1
+
+
+@pytest.mark.asyncio
+async def test_rule_cost():
+    rate_limit = RateLimitMiddleware(
+        hello_world,
+        auth_func,
+        MemoryBackend(),
+        {r"/": [Rule(minute=4, zone="api", cost_function=export_cost)]},
+    )
+    async with httpx.AsyncClient(
+        app=rate_limit,
+        base_url="http://testserver",
+        headers={"user": "user", "group": "default"},
+    ) as client:  # type: httpx.AsyncClient
+        response = await client.get("/export")
+        assert response.status_code == 200
+        response = await client.get("/export")
+        assert response.status_code == 429
+        response = await client.get("/towns")
+        assert response.status_code == 200
+        response = await client.get("/towns")
+        assert response.status_code == 429
+
+
+class RecordInstrument(Instrument):
+    def __init__(self):
+        self.requests = []
+        self.backend_calls = 0
+        self.checks = []
+        self.errors = []
+
+    def on_request(self, authenticate, match):
+        self.requests.append((authenticate, match))
+
+    def on_backend(self, seconds):
+        self.backend_calls += 1
+
+    def on_check(self, path, user, rule, retry_after):
+        self.checks.append((path, user, rule.group, retry_after))
+
+    def on_backend_error(self, exc):
+        self.errors.append(exc)
+
+
+class BrokenBackend(MemoryBackend):
+    async def retry_after_many(self, checks):
+        raise RuntimeError("broken")
+
+
+@pytest.mark.asyncio
+async def test_instrument():
+    instrument = RecordInstrument()
+    rate_limit = RateLimitMiddleware(
+        hello_world,
+        auth_func,
+        MemoryBackend(),
+        {r"/": [Rule(second=1)]},
+        instrument=instrument,
+    )
+    async with httpx.AsyncClient(
+        app=rate_limit,
+        base_url="http://testserver",
+        headers={"user": "user", "group": "default"},
+    ) as client:  # type: httpx.AsyncClient
+        response = await client.get("/")
+        assert response.status_code == 200
+        response = await client.get("/")
+        assert response.status_code == 429
+
+    assert len(instrument.requests) == 2
+    assert instrument.backend_calls == 2
+    assert instrument.checks == [
+        ("/", "user", "default", 0),
+        ("/", "user", "default", 1),
+    ]
+
+    rate_limit = RateLimitMiddleware(
+        hello_world,
+        auth_func,
+        BrokenBackend(),
+        {r"/": [Rule(second=1)]},
+        instrument=instrument,
+    )
+    async with httpx.AsyncClient(
+        app=rate_limit,
+        base_url="http://testserver",
+        headers={"user": "user", "group": "default"},
+    ) as client:  # type: httpx.AsyncClient
+        with pytest.raises(RuntimeError):
+            await client.get("/")
+    assert len(instrument.errors) == 1
+
+
+@pytest.mark.asyncio
+async def test_update_config():
+    rate_limit = RateLimitMiddleware(
+        hello_world,
+        auth_func,
+        MemoryBackend(),
+        {r"/": [Rule(second=1)]},
+        layers=[(global_auth, {r"/": [Rule(second=2, zone="global")]})],
+    )
+    layers = rate_limit.layers
+    async with httpx.AsyncClient(
+        app=rate_limit,
+        base_url="http://testserver",
+        headers={"user": "user", "group": "default"},
+    ) as client:  # type: httpx.AsyncClient
+        response = await client.get("/")
+        assert response.status_code == 200
+        response = await client.get("/")
+        assert response.status_code == 429
+
+        rate_limit.update_config({r"/": [Rule(second=3)]})
+        assert rate_limit.layers is not layers
+        assert rate_limit.layers[1] is layers[1]
+        assert rate_limit.authenticate is auth_func
+        response = await client.get("/")
+        assert response.status_code == 429
+
+        rate_limit.update_config({r"/": [Rule(second=3)]}, layers=[])
+        await asyncio.sleep(1)
+        for _ in range(3):
+            response = await client.get("/")
+            assert response.status_code == 200
+        assert len(rate_limit.layers) == 1
+
+
+@pytest.mark.asyncio
+async def test_shadow():
+    shadow_blocked = []
+
+    def on_shadow_blocked(scope, path, user, rule, retry_after):
+        shadow_blocked.append((scope["path"], path, user, retry_after))
+
+    rate_limit = RateLimitMiddleware(
+        hello_world,
+        auth_func,
+        MemoryBackend(),
+        {
+            r"/new": [Rule(second=1, block_time=5, shadow=True)],
+            r"/": [Rule(second=1)],
+        },
+        on_shadow_blocked=on_shadow_blocked,
+    )
+    async with httpx.AsyncClient(
+        app=rate_limit,
+        base_url="http://testserver",
+        headers={"user": "user", "group": "default"},
+    ) as client:  # type: httpx.AsyncClient
+        for _ in range(3):
+            response = await client.get("/new")
+            assert response.status_code == 200
+        assert shadow_blocked == [("/new", "/new", "user", 1)] * 2
+
+        # shadow rules never block the user
+        response = await client.get("/")
+        assert response.status_code == 200
+        response = await client.get("/")
+        assert response.status_code == 429
+
+        rate_limit.shadow = True
+        response = await client.get("/")
+        assert response.status_code == 200
+        assert shadow_blocked[-1] == ("/", "/", "user", 1)
+
+
+@pytest.mark.asyncio
+async def test_shadow_without_callback():
+    rate_limit = RateLimitMiddleware(
+        hello_world, auth_func, MemoryBackend(), {r"/": [Rule(second=1, shadow=True)]}
+    )
+    async with httpx.AsyncClient(
+        app=rate_limit,
+        base_url="http://testserver",
+        headers={"user": "user", "group": "default"},
+    ) as client:  # type: httpx.AsyncClient
+        for _ in range(3):
+            response = await client.get("/")
+            assert response.status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_blocked_in_every_layer():
+    rate_limit = RateLimitMiddleware(
+        hello_world,
+        auth_func,
+        MemoryBackend(),
+        {r"/": [Rule(second=1, block_time=60)]},
+        layers=[(auth_func, {r"/": [Rule(minute=10, zone="global")]})],
+    )
+    async with httpx.AsyncClient(
+        app=rate_limit,
+        base_url="http://testserver",
+        headers={"user": "user", "group": "default"},
+    ) as client:  # type: httpx.AsyncClient
+        response = await client.get("/")
+        assert response.status_code == 200
+        response = await client.get("/")
+        assert response.status_code == 429
+        assert response.headers["retry-after"] == "60"
+        # the blocked user is refused by both layers with the same retry after
+        response = await client.get("/")
+        assert response.status_code == 429
+        assert response.headers["retry-after"] == "60"
+
+
+@pytest.mark.asyncio
+async def test_shadow_block_time():
+    backend = MemoryBackend()
+    config = {r"/": [Rule(second=1, block_time=60)]}
+    shadow = RateLimitMiddleware(hello_world, auth_func, backend, config, shadow=True)
+    enforcing = RateLimitMiddleware(hello_world, auth_func, backend, config)
+    headers = {"user": "user", "group": "default"}
+    async with httpx.AsyncClient(
+        app=shadow, base_url="http://testserver", headers=headers
+    ) as client:  # type: httpx.AsyncClient
+        for _ in range(3):
+            response = await client.get("/shadow")
+            assert response.status_code == 200
+
+    # the shadow middleware has not blocked the user in the shared backend
+    async with httpx.AsyncClient(
+        app=enforcing, base_url="http://testserver", headers=headers
+    ) as client:  # type: httpx.AsyncClient
+        response = await client.get("/enforcing")
+        assert response.status_code == 200
+
+
+async def counting_auth(scope):
+    scope["app"].authenticated += 1
+    return await auth_func(scope)
+
+
+@pytest.mark.asyncio
+async def test_skip_authenticate():
+    rate_limit = RateLimitMiddleware(
+        hello_world,
+        counting_auth,
+        MemoryBackend(),
+        {
+            r"/health": [Rule(group="admin")],
+            r"/towns/admin": [Rule(group="admin")],
+            r"/towns": [Rule(second=1)],
+        },
+        bypass=Bypass(paths=["/static/"]),
+    )
+    rate_limit.authenticated = 0
+
+    async def app(scope, receive, send):
+        scope["app"] = rate_limit
+        await rate_limit(scope, receive, send)
+
+    async with httpx.AsyncClient(
+        app=app,
+        base_url="http://testserver",
+        headers={"user": "user", "group": "default"},
+    ) as client:  # type: httpx.AsyncClient
+        for path in ["/health", "/static/a.js", "/static/a.js"]:
+            response = await client.get(path)
+            assert response.status_code == 200
+        assert rate_limit.authenticated == 0
+
+        # a later pattern can still limit the request
+        response = await client.get("/towns/admin")
+        assert response.status_code == 200
+        assert rate_limit.authenticated == 1
+        response = await client.get("/towns/admin")
+        assert response.status_code == 429
+
+
+class LifespanBackend(MemoryBackend):
+    def __init__(self):
+        super().__init__()
+        self.events = []
+
+    async def startup(self):
+        self.events.append("startup")
+
+    async def shutdown(self):
+        self.events.append("shutdown")
+
+
+@pytest.mark.asyncio
+async def test_lifespan():
+    async def app(scope, receive, send):
+        assert scope["type"] == "lifespan"
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            else:
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    backend = LifespanBackend()
+    rate_limit = RateLimitMiddleware(app, auth_func, backend, {})
+    messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message["type"])
+
+    await rate_limit({"type": "lifespan"}, receive, send)
+    assert backend.events == ["startup", "shutdown"]
+    assert sent == ["lifespan.startup.complete", "lifespan.shutdown.complete"]
+
+
+@pytest.mark.asyncio
+async def test_lifespan_other_message():
+    received = []
+
+    async def app(scope, receive, send):
+        received.append(await receive())
+
+    backend = LifespanBackend()
+    rate_limit = RateLimitMiddleware(app, auth_func, backend, {})
+
+    async def receive():
+        return {"type": "lifespan.other"}
+
+    async def send(message):
+        pass
+
+    await rate_limit({"type": "lifespan"}, receive, send)
+    # messages other than startup and shutdown are passed through untouched
+    assert received == [{"type": "lifespan.other"}]
+    assert backend.events == []
+
+
+async def echo_websocket(scope, receive, send):
+    assert scope["type"] == "websocket"
+    message = await receive()
+    assert message["type"] == "websocket.connect"
+    await send({"type": "websocket.accept"})
+    while True:
+        message = await receive()
+        if message["type"] == "websocket.disconnect":
+            return
+        await send({"type": "websocket.send", "text": message["text"]})
+
+
+async def websocket_session(app, user, texts, extensions=None):
+    messages = [{"type": "websocket.connect"}]
+    messages += [{"type": "websocket.receive", "text": text} for text in texts]
+    messages.append({"type": "websocket.disconnect", "code": 1000})
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "websocket",
+        "path": "/ws",
+        "headers": [(b"group", b"default")],
+    }
+    if user is not None:
+        scope["headers"].append((b"user", user.encode()))
+    if extensions is not None:
+        scope["extensions"] = extensions
+    await app(scope, receive, send)
+    return sent
+
+
+@pytest.mark.asyncio
+async def test_websocket():
+    rate_limit = RateLimitMiddleware(
+        echo_websocket,
+        auth_func,
+        MemoryBackend(),
+        {
+            r"/ws": [
+                Rule(minute=1, method="websocket"),
+                Rule(minute=5, method="message"),
+            ]
+        },
+        websocket_batch=2,
+    )
+
+    sent = await websocket_session(rate_limit, "user", ["1", "2", "3", "4", "5", "6"])
+    assert sent[0] == {"type": "websocket.accept"}
+    assert [message["text"] for message in sent[1:-1]] == ["1", "2", "3", "4", "5"]
+    assert sent[-1] == {"type": "websocket.close", "code": 1008}
+
+    # connection limit, the close code is sent after accepting the connection
+    sent = await websocket_session(rate_limit, "user", [])
+    assert sent == [
+        {"type": "websocket.accept"},
+        {"type": "websocket.close", "code": 1008},
+    ]
+
+    # the blocked response is sent if the server supports it
+    sent = await websocket_session(
+        rate_limit, "user", [], extensions={"websocket.http.response": {}}
+    )
+    assert sent[0]["type"] == "websocket.http.response.start"
+    assert sent[0]["status"] == 429
+    assert sent[1]["type"] == "websocket.http.response.body"
+
+    sent = await websocket_session(rate_limit, "other", ["1"])
+    assert sent == [
+        {"type": "websocket.accept"},
+        {"type": "websocket.send", "text": "1"},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_websocket_carry_over():
+    rate_limit = RateLimitMiddleware(
+        echo_websocket,
+        auth_func,
+        MemoryBackend(),
+        {r"/ws": [Rule(minute=4, method="message")]},
+        websocket_batch=2,
+    )
+
+    rate_limit.websocket_tokens[("expired",)] = (1, 0.0)
+    sent = await websocket_session(rate_limit, "user", ["1"])
+    assert [message["text"] for message in sent[1:]] == ["1"]
+    assert [tokens for tokens, _ in rate_limit.websocket_tokens.values()] == [1]
+
+    # the batch of another user is kept beside the one that has not expired
+    await websocket_session(rate_limit, "other", ["1"])
+    assert [tokens for tokens, _ in rate_limit.websocket_tokens.values()] == [1, 1]
+
+    # the message left in the batch of the first connection is used
+    sent = await websocket_session(rate_limit, "user", ["2", "3", "4", "5"])
+    assert [message["text"] for message in sent[1:-1]] == ["2", "3", "4"]
+    assert sent[-1] == {"type": "websocket.close", "code": 1008}
+    assert [tokens for tokens, _ in rate_limit.websocket_tokens.values()] == [1]
+
+    # the application is disconnected if it receives after the close
+    checks = await rate_limit.find_checks(
+        {
+            "type": "websocket",
+            "path": "/ws",
+            "headers": [(b"user", b"user"), (b"group", b"default")],
+        },
+        ("message",),
+        {},
+    )
+    messages = [{"type": "websocket.receive", "text": "6"}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    receive, finish = rate_limit.websocket_receive({}, receive, send, checks)
+    assert (await receive())["type"] == "websocket.disconnect"
+    assert (await receive())["type"] == "websocket.disconnect"
+    finish()
+    assert sent == [{"type": "websocket.close", "code": 1008}]
+
+
+@pytest.mark.asyncio
+async def test_websocket_block_time():
+    backend = MemoryBackend()
+    rate_limit = RateLimitMiddleware(
+        echo_websocket,
+        auth_func,
+        backend,
+        {r"/ws": [Rule(minute=15, method="message", block_time=60)]},
+    )
+    # messages are taken one by one, a refused batch would block the user
+    texts = [str(index) for index in range(12)]
+    sent = await websocket_session(rate_limit, "user", texts)
+    assert [message["text"] for message in sent[1:]] == texts
+    assert backend.is_blocking("user") == 0
+
+    sent = await websocket_session(rate_limit, "user", ["12", "13", "14", "15"])
+    assert [message["text"] for message in sent[1:-1]] == ["12", "13", "14"]
+    assert sent[-1] == {"type": "websocket.close", "code": 1008}
+    assert backend.is_blocking("user") > 0
+
+
+@pytest.mark.asyncio
+async def test_websocket_overlap():
+    rate_limit = RateLimitMiddleware(
+        echo_websocket,
+        auth_func,
+        MemoryBackend(),
+        {r"/ws": [Rule(minute=10, method="message")]},
+        websocket_batch=4,
+    )
+    scope = {
+        "type": "websocket",
+        "path": "/ws",
+        "headers": [(b"user", b"user"), (b"group", b"default")],
+    }
+    checks = await rate_limit.find_checks(scope, ("message",), {})
+
+    async def receive():
+        return {"type": "websocket.receive", "text": "1"}
+
+    async def send(message):
+        pass
+
+    first, finish_first = rate_limit.websocket_receive(scope, receive, send, checks)
+    second, finish_second = rate_limit.websocket_receive(scope, receive, send, checks)
+    await first()
+    await second()
+    finish_first()
+    ((key, (tokens, _)),) = rate_limit.websocket_tokens.items()
+    assert tokens == 3
+    # the tokens of the first connection expire before the second one ends
+    rate_limit.websocket_tokens[key] = (tokens, 0.0)
+    finish_second()
+    assert [tokens for tokens, _ in rate_limit.websocket_tokens.values()] == [3]
+
+
+@pytest.mark.asyncio
+async def test_websocket_opt_in():
+    rate_limit = RateLimitMiddleware(
+        echo_websocket, auth_func, MemoryBackend(), {r"/ws": [Rule(minute=1)]}
+    )
+    for _ in range(2):
+        sent = await websocket_session(rate_limit, "user", ["1"])
+        assert sent[0] == {"type": "websocket.accept"}
+
+
+@pytest.mark.asyncio
+async def test_websocket_auth_error():
+    rate_limit = RateLimitMiddleware(
+        echo_websocket,
+        auth_func,
+        MemoryBackend(),
+        {r"/ws": [Rule(minute=1, method="websocket")]},
+        on_auth_error=handle_auth_error,
+    )
+    # closed before it is accepted, the server answers 403
+    sent = await websocket_session(rate_limit, None, [])
+    assert sent == [{"type": "websocket.close"}]
+
+    sent = await websocket_session(
+        rate_limit, None, [], extensions={"websocket.http.response": {}}
+    )
+    assert [message["type"] for message in sent] == [
+        "websocket.http.response.start",
+        "websocket.http.response.body",
+    ]
+    assert sent[0]["status"] == 401
+
+    # the client left before the connection was refused
+    async def receive():
+        return {"type": "websocket.disconnect", "code": 1000}
+
+    async def send(message):
+        raise AssertionError("nothing to send")
+
+    await rate_limit.refuse_websocket({}, receive, send, hello_world, 1008)
+
+
+@pytest.mark.asyncio
+async def test_concurrency():
+    event = asyncio.Event()
+
+    async def slow_app(scope, receive, send):
+        await event.wait()
+        await hello_world(scope, receive, send)
+
+    backend = MemoryBackend()
+    rate_limit = RateLimitMiddleware(
+        slow_app, auth_func, backend, {r"/": [Rule(concurrency=1)]}
+    )
+    async with httpx.AsyncClient(
+        app=rate_limit,
+        base_url="http://testserver",
+        headers={"user": "user", "group": "default"},
+    ) as client:  # type: httpx.AsyncClient
+        first = asyncio.ensure_future(client.get("/"))
+        await asyncio.sleep(0.1)
+        response = await client.get("/")
+        assert response.status_code == 429
+        assert response.headers["retry-after"] == "1"
+
+        event.set()
+        assert (await first).status_code == 200
+        assert backend.concurrency == {}
+
+        response = await client.get("/")
+        assert response.status_code == 200
+
+
+class CountingBackend(MemoryBackend):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    async def retry_after_many(self, checks):
+        self.calls += 1
+        return await super().retry_after_many(checks)
+
+
+@pytest.mark.asyncio
+async def test_concurrency_before_rate():
+    event = asyncio.Event()
+
+    async def slow_app(scope, receive, send):
+        await event.wait()
+        await hello_world(scope, receive, send)
+
+    backend = CountingBackend()
+    rate_limit = RateLimitMiddleware(
+        slow_app,
+        auth_func,
+        backend,
+        {
+            r"/only": [Rule(concurrency=1)],
+            r"/": [Rule(minute=2, concurrency=1)],
+        },
+    )
+    async with httpx.AsyncClient(
+        app=rate_limit,
+        base_url="http://testserver",
+        headers={"user": "user", "group": "default"},
+    ) as client:  # type: httpx.AsyncClient
+        first = asyncio.ensure_future(client.get("/"))
+        await asyncio.sleep(0.1)
+        # refused for concurrency without taking from the rate limit
+        response = await client.get("/")
+        assert response.status_code == 429
+        assert backend.calls == 1
+
+        event.set()
+        assert (await first).status_code == 200
+        response = await client.get("/")
+        assert response.status_code == 200
+        # refused by the rate limit, the slot is given back
+        response = await client.get("/")
+        assert response.status_code == 429
+        assert backend.concurrency == {}
+
+        # concurrency rules alone never call the rate limits
+        calls = backend.calls
+        response = await client.get("/only")
+        assert response.status_code == 200
+        assert backend.calls == calls
+
+
+@pytest.mark.asyncio
+async def test_concurrency_websocket():
+    backend = MemoryBackend()
+
+    async def app(scope, receive, send):
+        assert backend.concurrency == {"/ws:websocket:user:concurrency": 1}
+        await echo_websocket(scope, receive, send)
+
+    rate_limit = RateLimitMiddleware(
+        app,
+        auth_func,
+        backend,
+        {r"/ws": [Rule(concurrency=1, method="websocket")]},
+    )
+    sent = await websocket_session(rate_limit, "user", ["1"])
+    assert sent[0] == {"type": "websocket.accept"}
+    assert backend.concurrency == {}
+
+
+class RateOnlyBackend(BaseBackend):
+    async def retry_after(self, path, user, rule):
+        return 0
+
+
+@pytest.mark.asyncio
+async def test_concurrency_shadow():
+    shadow_blocked = []
+    backend = MemoryBackend()
+    rate_limit = RateLimitMiddleware(
+        hello_world,
+        auth_func,
+        backend,
+        {r"/": [Rule(concurrency=1, shadow=True)]},
+        on_shadow_blocked=lambda *args: shadow_blocked.append(args[1:]),
+    )
+    # a request of the user is in flight
+    backend.concurrency["/:*:user:concurrency"] = 1
+    async with httpx.AsyncClient(
+        app=rate_limit,
+        base_url="http://testserver",
+        headers={"user": "user", "group": "default"},
+    ) as client:  # type: httpx.AsyncClient
+        response = await client.get("/")
+        assert response.status_code == 200
+    assert shadow_blocked == [("/", "user", Rule(concurrency=1, shadow=True), 1)]
+
+
+@pytest.mark.asyncio
+async def test_concurrency_shadow_without_callback():
+    backend = MemoryBackend()
+    rate_limit = RateLimitMiddleware(
+        hello_world, auth_func, backend, {r"/": [Rule(concurrency=1, shadow=True)]}
+    )
+    backend.concurrency["/:*:user:concurrency"] = 1
+    async with httpx.AsyncClient(
+        app=rate_limit,
+        base_url="http://testserver",
+        headers={"user": "user", "group": "default"},
+    ) as client:  # type: httpx.AsyncClient
+        response = await client.get("/")
+        assert response.status_code == 200
+    # the slot of the shadow rule was not taken
+    assert backend.concurrency["/:*:user:concurrency"] == 1
+
+
+def test_concurrency_unsupported():
+    with pytest.raises(ValueError, match="RateOnlyBackend"):
+        RateLimitMiddleware(
+            hello_world, auth_func, RateOnlyBackend(), {r"/": [Rule(concurrency=1)]}
+        )
+
+    rate_limit = RateLimitMiddleware(
+        hello_world, auth_func, RateOnlyBackend(), {r"/": [Rule(second=1)]}
+    )
+    with pytest.raises(ValueError, match="concurrency"):
+        rate_limit.update_config(
+            {}, layers=[(auth_func, {r"/": [Rule(concurrency=1)]})]
+        )
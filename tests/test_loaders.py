@@ -0,0 +1,64 @@
+import asyncio
+import json
+
+import pytest
+from redis.asyncio import StrictRedis
+
+from ratelimit import RateLimitMiddleware, Rule
+from ratelimit.backends.simple import MemoryBackend
+from ratelimit.loaders import parse_config, watch_file, watch_redis_hash
+
+from .test_core import auth_func, hello_world
+
+
+def test_parse_config():
+    assert parse_config({"^/towns": [{"second": 1}, {"group": "admin"}]}) == {
+        "^/towns": [Rule(second=1), Rule(group="admin")]
+    }
+
+
+@pytest.mark.asyncio
+async def test_watch_file(tmp_path):
+    path = tmp_path / "ratelimit.json"
+    path.write_text(json.dumps({"^/towns": [{"second": 1}]}))
+    rate_limit = RateLimitMiddleware(hello_world, auth_func, MemoryBackend(), {})
+
+    task = asyncio.ensure_future(watch_file(rate_limit, str(path), interval=0.01))
+    try:
+        await asyncio.sleep(0.1)
+        assert list(rate_limit.config.values()) == [[Rule(second=1)]]
+
+        path.write_text("invalid json")
+        await asyncio.sleep(0.1)
+        assert list(rate_limit.config.values()) == [[Rule(second=1)]]
+    finally:
+        task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_watch_redis_hash(caplog):
+    redis = StrictRedis()
+    await redis.delete("ratelimit-config")
+    await redis.hset(
+        "ratelimit-config",
+        mapping={
+            "^/": json.dumps({"order": 1, "rules": [{"minute": 1}]}),
+            "^/towns": json.dumps({"order": 0, "rules": [{"second": 1}]}),
+        },
+    )
+    rate_limit = RateLimitMiddleware(hello_world, auth_func, MemoryBackend(), {})
+
+    task = asyncio.ensure_future(
+        watch_redis_hash(rate_limit, redis, "ratelimit-config", interval=0.01)
+    )
+    try:
+        await asyncio.sleep(0.1)
+        assert [pattern.pattern for pattern in rate_limit.config] == ["^/towns", "^/"]
+
+        # an invalid config is logged and the current one is kept
+        await redis.hset("ratelimit-config", "^/towns", "invalid json")
+        await asyncio.sleep(0.1)
+        assert [pattern.pattern for pattern in rate_limit.config] == ["^/towns", "^/"]
+        assert "Failed to load rate limit config from redis" in caplog.text
+    finally:
+        task.cancel()
@@ -0,0 +1,194 @@
+import asyncio
+
+import httpx
+import pytest
+
+from ratelimit import RateLimitMiddleware, Rule
+from ratelimit.backends.simple import MemoryBackend
+from ratelimit.queue import AdmissionQueue
+
+from .test_core import auth_func, hello_world
+
+
+class Capacity:
+    """
+    admits `free` requests, the others are retried after 0.05 seconds
+    """
+
+    def __init__(self):
+        self.free = 0
+        self.calls = []
+
+    def decide(self, name):
+        async def decide():
+            self.calls.append(name)
+            if self.free > 0:
+                self.free -= 1
+                return 0
+            return 0.05
+
+        return decide
+
+
+@pytest.mark.asyncio
+async def test_admit_in_order():
+    queue = AdmissionQueue(max_wait=1, priorities={"admin": 1})
+    capacity = Capacity()
+    admitted = []
+
+    async def request(group, name):
+        retry_after = await queue.admit(group, "key", 0.05, capacity.decide(name))
+        admitted.append((name, retry_after))
+
+    tasks = [
+        asyncio.ensure_future(request(group, name))
+        for group, name in [("default", "a"), ("admin", "b"), ("default", "c")]
+    ]
+    await asyncio.sleep(0.07)
+    # only the first of the line is decided again
+    assert capacity.calls == ["b"]
+    assert queue.size == 3
+
+    capacity.free = 2
+    await asyncio.sleep(0.05)
+    # a release wakes the next one, which is admitted at once
+    assert admitted == [("b", 0), ("a", 0)]
+    assert capacity.calls == ["b", "b", "a", "c"]
+
+    capacity.free = 1
+    await asyncio.gather(*tasks)
+    assert admitted[-1] == ("c", 0)
+    assert queue.size == 0 and queue._lines == {}
+
+    # other keys wait in their own line
+    other = asyncio.ensure_future(
+        queue.admit("default", "other", 0.05, capacity.decide("d"))
+    )
+    capacity.free = 1
+    assert await other == 0
+
+
+@pytest.mark.asyncio
+async def test_admit_rejected():
+    queue = AdmissionQueue(max_wait=0.2, maxsize=2, priorities={"admin": 1})
+    capacity = Capacity()
+
+    # longer than max_wait
+    assert await queue.admit("default", "key", 1, capacity.decide("a")) == 1
+
+    first = asyncio.ensure_future(
+        queue.admit("default", "key", 0.05, capacity.decide("a"))
+    )
+    second = asyncio.ensure_future(
+        queue.admit("default", "key", 0.05, capacity.decide("b"))
+    )
+    await asyncio.sleep(0)
+    assert queue.size == 2
+    # full of requests with the same priority
+    assert await queue.admit("default", "key", 0.05, capacity.decide("c")) == 0.05
+    # evicts the newest request with a lower priority
+    admin = asyncio.ensure_future(
+        queue.admit("admin", "key", 0.05, capacity.decide("d"))
+    )
+    await asyncio.sleep(0)
+    assert queue.size == 2
+    assert await second == 0.05
+    assert "b" not in capacity.calls
+
+    # rejected after max_wait
+    assert await asyncio.gather(first, admin) == [0.05, 0.05]
+    assert queue.size == 0
+    assert len(capacity.calls) < 5
+
+    # a cancelled request lets the next one decide
+    async def slow():
+        await asyncio.sleep(1)
+        return 0
+
+    queue = AdmissionQueue(max_wait=1)
+    first = asyncio.ensure_future(queue.admit("default", "key", 0.01, slow))
+    second = asyncio.ensure_future(
+        queue.admit("default", "key", 0.01, capacity.decide("e"))
+    )
+    await asyncio.sleep(0.05)
+    first.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await first
+    capacity.free = 1
+    assert await second == 0
+    assert queue.size == 0
+
+
+@pytest.mark.asyncio
+async def test_admit_cleanup():
+    queue = AdmissionQueue(max_wait=1, maxsize=2, priorities={"admin": 1, "low": -1})
+    capacity = Capacity()
+    capacity.free = 3
+    for name in "abc":
+        assert await queue.admit("default", name, 0.01, capacity.decide(name)) == 0
+    assert queue._lines == {}
+
+    # the line of a slow decision keeps the requests cancelled behind it
+    decided = asyncio.Event()
+
+    async def slow():
+        decided.set()
+        await asyncio.sleep(0.1)
+        return 0
+
+    first = asyncio.ensure_future(queue.admit("default", "key", 0.01, slow))
+    await decided.wait()
+    for _ in range(4):
+        task = asyncio.ensure_future(
+            queue.admit("default", "key", 0.01, capacity.decide("d"))
+        )
+        await asyncio.sleep(0)
+        task.cancel()
+    assert len(queue._lines["key"].waiters) <= 4
+    assert len(queue._waiters) <= 4
+    # the finished requests are skipped when the queue is full
+    task = asyncio.ensure_future(queue.admit("low", "key", 0.01, capacity.decide("d")))
+    await asyncio.sleep(0)
+    task.cancel()
+    second = asyncio.ensure_future(
+        queue.admit("default", "key", 0.01, capacity.decide("e"))
+    )
+    await asyncio.sleep(0)
+    admin = asyncio.ensure_future(
+        queue.admit("admin", "key", 0.01, capacity.decide("f"))
+    )
+    capacity.free = 1
+    assert await asyncio.gather(first, second, admin) == [0, 0.01, 0]
+
+    # a request deciding now is never evicted
+    queue = AdmissionQueue(max_wait=1, maxsize=1, priorities={"admin": 1})
+    decided.clear()
+    first = asyncio.ensure_future(queue.admit("default", "key", 0.01, slow))
+    await decided.wait()
+    assert await queue.admit("admin", "key", 0.01, capacity.decide("g")) == 0.01
+    assert await first == 0
+
+
+@pytest.mark.asyncio
+async def test_middleware():
+    rate_limit = RateLimitMiddleware(
+        hello_world,
+        auth_func,
+        MemoryBackend(),
+        {r"/wait": [Rule(second=1)], r"/block": [Rule(minute=1)]},
+        queue=AdmissionQueue(max_wait=2),
+    )
+    async with httpx.AsyncClient(
+        app=rate_limit,
+        base_url="http://testserver",
+        headers={"user": "user", "group": "default"},
+    ) as client:  # type: httpx.AsyncClient
+        response = await client.get("/wait")
+        assert response.status_code == 200
+        response = await client.get("/wait")
+        assert response.status_code == 200
+
+        response = await client.get("/block")
+        assert response.status_code == 200
+        response = await client.get("/block")
+        assert response.status_code == 429